@@ -1,20 +1,30 @@
 import logging
 import atexit
-import boto3
 import json
+import queue
+import time
+import gevent
 from flask import Flask, request, Response
 from flask_cors import CORS
 from decouple import config
 
 from ecs import create_desktop_instance, destroy_desktop_instance
-from groups import get_groups_and_roles
+from groups import get_groups_and_roles, get_group_role_map
 from entitlements import get_entitlements_for_roles
 from machinedef import get_machine_def
-from instance import get_instances_by_username, get_instances_by_username_and_id, stop_instance, start_instance
+from instance import get_instances_by_username, get_instances_by_username_and_id, stop_instance, start_instance, suspend_instance
 from security import secured, admin_only
-from utils import success_json_response, check_for_keys, get_rand_string, format_sse
-from errors import error_handler, ResourceNotFoundException, BadRequestException, NoAvailableCapacity
+from loadshed import limited
+from utils import success_json_response, check_for_keys, get_rand_string, encode_retry, encode_comment
+from errors import error_handler, ResourceNotFoundException, BadRequestException, NoAvailableCapacity, ServiceUnavailableException
 from messageprocessor import get_processor
+from aws import get_client, SERVICES
+from settings import snapshot, setting
+import registry
+import warmpool
+import prestart
+import usage
+import tasks
 
 # setup app
 app = Flask(__name__)
@@ -23,8 +33,29 @@ CORS(app)
 # set logging
 logger = logging.getLogger(__name__)
 
-# pre-cache useful data
-get_groups_and_roles()
+def warm_up():
+  """
+  Pre-cache useful data and create AWS clients, all concurrently
+  Everything here is also created lazily on first use, so this is only to
+  take the cost off the first requests a worker serves
+  """
+  snapshot()
+  jobs = [gevent.spawn(get_client, service) for service in SERVICES]
+  jobs.append(gevent.spawn(get_group_role_map))
+  gevent.joinall(jobs)
+  for job in jobs:
+    if job.exception:
+      logger.warning("Warm up job failed: %s", job.exception)
+
+def track_task(task_arn, username, desktop_id, mode):
+  """
+  Tracks a started task, the task runs either way so a failure here only
+  costs the user's listeners their progress events
+  """
+  try:
+    tasks.track(task_arn, username, desktop_id, mode)
+  except Exception as err:
+    logger.error("Could not track task %s for desktop %s of %s: %s", task_arn, desktop_id, username, err)
 
 @app.route("/", methods=["GET"])
 @error_handler
@@ -38,18 +69,39 @@ def root(username, roles):
 
 @app.route("/event", methods=["GET"])
 @error_handler
+@limited("sse")
 @secured
 def listen(username, roles):
+  processor = get_processor()
+  if processor.draining:
+    raise ServiceUnavailableException("This server is restarting", retry_after=max(1, round(processor.retry_after_ms() / 1000)))
+  q = processor.listen(username=username)
+  # keeps pre-started desktops the user is about to use running
+  prestart.mark_seen(username)
+  heartbeat = setting("SSE_HEARTBEAT_SECONDS", default=15, cast=float)
   def stream():
-    q = get_processor().listen(username=username)
     while True:
-      message = q.get()
-      logger.info(f"Event for {username} : {message}")
-      yield format_sse(message, "message")
-  return Response(stream(), mimetype="text/event-stream")
+      try:
+        # already formatted, may hold several events
+        message = q.get(timeout=heartbeat)
+      except queue.Empty:
+        # a write to a closed connection fails, which ends the stream
+        yield encode_comment("heartbeat")
+        continue
+      if message is None:
+        # the worker is draining or the stream was replaced, reconnect after a random delay
+        yield encode_retry(processor.retry_after_ms())
+        return
+      logger.debug("Event for %s : %s", username, message)
+      yield message
+  response = Response(stream(), mimetype="text/event-stream")
+  # the server closes the response however the stream ends, even if it never started
+  response.call_on_close(lambda: processor.unlisten(username, q))
+  return response
 
 @app.route("/_refresh", methods=["GET"])
 @error_handler
+@limited("read")
 @secured
 @admin_only
 def refresh_config(username, roles):
@@ -58,14 +110,44 @@ def refresh_config(username, roles):
     "status": "okay"
   })
 
+@app.route("/usage", methods=["GET"])
+@error_handler
+@limited("read")
+@secured
+@admin_only
+def get_usage(username, roles):
+  today = usage.day_of(time.time())
+  return success_json_response(usage.get_usage(request.args.get("from", today), request.args.get("to", today)))
+
 @app.route("/entitlement", methods=["GET"])
 @error_handler
+@limited("read")
 @secured
 def get_entitlements(username, roles):
   return success_json_response(get_entitlements_for_roles(roles, username))
 
+@app.route("/prestart", methods=["GET"])
+@error_handler
+@limited("read")
+@secured
+def get_prestart(username, roles):
+  return success_json_response(prestart.get_status(username))
+
+@app.route("/prestart", methods=["PUT"])
+@error_handler
+@limited("read")
+@secured
+def change_prestart(username, roles):
+  if not request.json:
+    raise BadRequestException("Request should be JSON")
+  if not isinstance(request.json.get("enabled"), bool):
+    raise BadRequestException("The enabled key should be true or false")
+  prestart.set_opted_out(username, not request.json["enabled"])
+  return success_json_response(prestart.get_status(username))
+
 @app.route("/instance", methods=["GET"])
 @error_handler
+@limited("read")
 @secured
 def get_instances(username, roles):
   instances = get_instances_by_username(username)
@@ -73,6 +155,7 @@ def get_instances(username, roles):
 
 @app.route("/instance", methods=["POST"])
 @error_handler
+@limited("provision")
 @secured
 def create_instance(username, roles):
   # check if the request is JSON
@@ -88,8 +171,8 @@ def create_instance(username, roles):
         raise BadRequestException("Invalid action")
       if request.json["screen_geometry"] not in ["1920x1080", "1280x720"]:
         raise BadRequestException("Invalid screen geometry")
-      # get entitlements
-      entitlements = get_entitlements_for_roles(roles, username)
+      # get entitlements, not from the read cache as this is the capacity check
+      entitlements = get_entitlements_for_roles.fresh(roles, username)
       selected_entitlement = None
       for entitlement in entitlements:
         if entitlement["machine_def_id"] == request.json["machine_def_id"]:
@@ -103,6 +186,14 @@ def create_instance(username, roles):
           # if an override id was set then use it
           if "desktop_id" in request.json:
             desktop_id = request.json["desktop_id"]
+          # a desktop from the warm pool only needs starting
+          if warmpool.pool_enabled() and machine_def.get("warm_pool_size", 0) > 0:
+            if warmpool.claim(username, desktop_id, machine_def, request.json["screen_geometry"]):
+              return success_json_response({
+                "desktop_id": desktop_id,
+                "status": "okay",
+                "message": "starting instance from warm pool"
+              })
           # create task to provision
           response = create_desktop_instance(
             desktop_id=desktop_id,
@@ -114,6 +205,15 @@ def create_instance(username, roles):
             user_data=machine_def["user_data"]
           )
           if response:
+            if registry.registry_enabled():
+              registry.register_desktop(
+                username=username,
+                desktop_id=desktop_id,
+                machine_def_id=selected_entitlement["machine_def_id"],
+                screen_geometry=request.json["screen_geometry"]
+              )
+            # progress is pushed to the user's listeners from here
+            track_task(response, username, desktop_id, "apply")
             return success_json_response({
               "desktop_id": desktop_id,
               "status": "okay",
@@ -132,10 +232,11 @@ def create_instance(username, roles):
 
 @app.route("/instance/<instanceid>", methods=["GET"])
 @error_handler
+@limited("read")
 @secured
 def get_instance(username, roles, instanceid):
   instance = get_instances_by_username_and_id(username=username, instanceid=instanceid)
-  logger.info(f"Got instance data {instance}")
+  logger.debug("Got instance data %s", instance)
   if len(instance) > 0:
     return success_json_response(instance[instanceid])
   else:
@@ -143,10 +244,11 @@ def get_instance(username, roles, instanceid):
 
 @app.route("/instance/<instanceid>", methods=["PATCH"])
 @error_handler
+@limited("provision")
 @secured
 def change_instance(username, roles, instanceid):
   instance = get_instances_by_username_and_id(username=username, instanceid=instanceid)
-  logger.info(f"Got instance data {instance}")
+  logger.debug("Got instance data %s", instance)
   if len(instance) > 0:
     # check request is valid
     if request.json:
@@ -157,7 +259,7 @@ def change_instance(username, roles, instanceid):
       if missing:
         raise BadRequestException(f"The following keys are missing from the request: {missing}")
       else:
-        if request.json["state"] not in ["stopped", "running"]:
+        if request.json["state"] not in ["stopped", "running", "suspended"]:
           raise BadRequestException("Invalid state request")
         else:
           if request.json["state"] == "stopped":
@@ -178,6 +280,17 @@ def change_instance(username, roles, instanceid):
               "status": "okay",
               "message": "starting instance"
             })
+          elif request.json["state"] == "suspended":
+            # instances launched without hibernation configured are just stopped
+            hibernating = suspend_instance(
+              instanceid = instance[instanceid]["instanceid"],
+              hibernation = instance[instanceid].get("hibernation")
+            )
+            return success_json_response({
+              "desktop_id": instanceid,
+              "status": "okay",
+              "message": "suspending instance" if hibernating else "stopping instance, hibernation is not supported"
+            })
     else:
       raise BadRequestException("Request should be JSON")
   else:
@@ -185,25 +298,29 @@ def change_instance(username, roles, instanceid):
 
 @app.route("/instance/<instanceid>", methods=["DELETE"])
 @error_handler
+@limited("provision")
 @secured
 def delete_instance(username, roles, instanceid):
   instances = get_instances_by_username_and_id(username=username, instanceid=instanceid)
-  logger.info(f"Got instance data {instances}")
+  logger.debug("Got instance data %s", instances)
   if instanceid in instances:
     # need to trigger delete
     instance = instances[instanceid]
     machine_def = get_machine_def(machine_def_id=instance["machine_def_id"])
+    # warm pool desktops were built under a different id and username
+    provisioned_id, provisioned_username = warmpool.provisioned_as(instance["instanceid"], instanceid, username)
     # create task to provision
     response = destroy_desktop_instance(
-      desktop_id=instanceid,
+      desktop_id=provisioned_id,
       ami_id=machine_def["ami_id"],
-      machine_username=username,
+      machine_username=provisioned_username,
       screen_geometry=instance["screengeometry"],
       machine_def_id=instance["machine_def_id"],
       instance_type=machine_def["instance_type"],
       user_data=machine_def["user_data"]
     )
     if response:
+      track_task(response, username, instanceid, "destroy")
       return success_json_response({
         "desktop_id": instanceid,
         "status": "okay",
@@ -0,0 +1,42 @@
+"""
+aws.py
+
+Lazily created boto3 clients shared by the whole worker
+Unless GOVERNOR_ENABLED is false they are wrapped by governor.GovernedClient
+"""
+import logging
+from gevent.lock import BoundedSemaphore
+from governor import GovernedClient, governor_enabled, client_config
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ["dynamodb", "ec2", "ecs", "sqs", "sns"]
+
+clients = {}
+lock = BoundedSemaphore(1)
+
+def get_client(service_name):
+  """
+  Gets the client for a service, creating it on first use
+  boto3 is only imported the first time a client is needed
+  """
+  client = clients.get(service_name)
+  if client is None:
+    with lock:
+      client = clients.get(service_name)
+      if client is None:
+        import boto3
+        logger.info("Creating %s client", service_name)
+        if governor_enabled():
+          client = GovernedClient(boto3.client(service_name, config=client_config()), service_name)
+        else:
+          client = boto3.client(service_name)
+        clients[service_name] = client
+  return client
+
+def reset_clients():
+  """
+  Drop all clients so they are created again on next use
+  """
+  with lock:
+    clients.clear()
@@ -1,25 +1,58 @@
-
 """
 data.py
 
 Contains low level methods for accessing the data layer
 """
-import boto3
 import logging
+from collections import namedtuple
+from functools import lru_cache
+from aws import get_client
 
 logger = logging.getLogger(__name__)
 
+# how find_ddb_items reads, operation is "query" or "scan", index None for the table itself
+QueryPlan = namedtuple("QueryPlan", ["operation", "index", "params"])
+OPERATORS = {
+  "eq": "{name} = {values}",
+  "ne": "{name} <> {values}",
+  "lt": "{name} < {values}",
+  "lte": "{name} <= {values}",
+  "gt": "{name} > {values}",
+  "gte": "{name} >= {values}",
+  "between": "{name} BETWEEN {low} AND {high}",
+  "in": "{name} IN ({values})",
+  "begins_with": "begins_with({name}, {values})",
+  "exists": "attribute_exists({name})",
+  "not_exists": "attribute_not_exists({name})",
+  # used by the update helpers rather than as conditions in kwargs
+  "newer_or_equal": "(attribute_not_exists({name}) OR {name} <= {values})",
+  "newer": "(attribute_not_exists({name}) OR {name} < {values})",
+  "set": "{name} = {values}",
+  "add": "{name} {values}"
+}
+# operators parse_condition does not accept from callers
+INTERNAL_OPERATORS = {"not_exists", "newer_or_equal", "newer", "set", "add"}
+# the operators a key condition can use on a range key
+KEY_OPERATORS = {"eq", "lt", "lte", "gt", "gte", "between", "begins_with"}
+# keys of the config table, used if describe_table is not allowed
+DEFAULT_KEYS = ("domain", "sub_id")
+table_keys = {}
+
 def dh_wrap_field(field):
   """
   Wraps a field value for DynamoDB
   """
   if isinstance(field, str):
     return {"S": field}
+  elif isinstance(field, bool):
+    return {"BOOL": field}
   elif isinstance(field, list):
     wrapped_list = []
     for item in field:
       wrapped_list.append(dh_wrap_field(item))
     return {"L": wrapped_list}
+  elif isinstance(field, dict):
+    return {"M": {key: dh_wrap_field(value) for key, value in field.items()}}
   else:
     return {"N": str(field)}
 
@@ -44,11 +77,15 @@ def flatten(item):
     return item["S"]
   if "N" in item:
     return int(item["N"])
+  if "BOOL" in item:
+    return item["BOOL"]
   if "L" in item:
     flattened_list = []
     for i in item["L"]:
       flattened_list.append(flatten(i))
     return flattened_list
+  if "M" in item:
+    return {key: flatten(value) for key, value in item["M"].items()}
 
 def summarise_dict(table, field):
   """
@@ -70,49 +107,153 @@ def filter_dict(table, allowed_fields):
     filtered_rows.append({key: row[key] for key in allowed_fields})
   return filtered_rows
 
-def ddb_create(table, **kwargs):
+def is_condition_failure(err):
+  return getattr(err, "response", {}).get("Error", {}).get("Code") == "ConditionalCheckFailedException"
+
+def ddb_create(table, only_if_absent=False, **kwargs):
   """
   Creates an item containing the fields in kwargs
+  With only_if_absent an existing item is left alone
+  Returns True if the item was written
   """
-  ddb = boto3.client("dynamodb")
+  ddb = get_client("dynamodb")
   attributes = {split_name(k):dh_wrap_field(v) for (k,v) in kwargs.items()}
   params = {
     "TableName": table,
     "Item": attributes
   }
-  logger.info("About to put item, params={p}".format(p=params))
-  ddb.put_item(**params)
-  logger.info("Item created.")
+  if only_if_absent:
+    # every item has the partition key, so this is true only if there is no item
+    params.update({
+      "ConditionExpression": "attribute_not_exists(#nkey)",
+      "ExpressionAttributeNames": {"#nkey": split_name(next(iter(kwargs)))}
+    })
+  logger.debug("About to put item, params=%s", params)
+  try:
+    ddb.put_item(**params)
+  except Exception as err:
+    if is_condition_failure(err):
+      logger.debug("Item not created, it already exists")
+      return False
+    raise
+  logger.debug("Item created.")
+  return True
+
+def update_ddb_item(table, keys, only_if_newer=None, allow_equal=True, expected=None, **kwargs):
+  """
+  Sets the fields in kwargs on the item with the given keys, creating it if needed
+  If only_if_newer names a numeric field in kwargs, the update is skipped when
+  the stored item already has a higher value for it (used to drop stale events)
+  With allow_equal False an equal value is skipped too, so of several hosts
+  writing the same value only the first succeeds
+  With expected the update is also skipped unless the stored item has those field values
+  Returns True if the item was written
+  """
+  ddb = get_client("dynamodb")
+  update_expression, names, values = bind_expression(
+    "u", [(split_name(key), "set", (value,)) for key, value in kwargs.items()], ", ")
+  params = {
+    "TableName": table,
+    "Key": {split_name(k): dh_wrap_field(v) for (k,v) in keys.items()},
+    "UpdateExpression": "SET " + update_expression
+  }
+  conditions = [(split_name(key), "eq", (value,)) for key, value in (expected or {}).items()]
+  if only_if_newer:
+    conditions.insert(0, (split_name(only_if_newer), "newer_or_equal" if allow_equal else "newer", (kwargs[only_if_newer],)))
+  if conditions:
+    condition_expression, condition_names, condition_values = bind_expression("c", conditions)
+    params["ConditionExpression"] = condition_expression
+    names.update(condition_names)
+    values.update(condition_values)
+  params.update({
+    "ExpressionAttributeValues": values,
+    "ExpressionAttributeNames": names
+  })
+  logger.debug("Updating item using params %s", params)
+  try:
+    ddb.update_item(**params)
+  except Exception as err:
+    if is_condition_failure(err):
+      logger.debug("Item not updated, stored item is newer or not as expected")
+      return False
+    raise
+  return True
+
+def add_ddb_counters(table, keys, **kwargs):
+  """
+  Adds the numbers in kwargs to fields of the item with the given keys
+  Missing items and fields start at zero, and as DynamoDB does the addition
+  hosts adding to the same item at once do not lose each other's counts
+  """
+  ddb = get_client("dynamodb")
+  expression, names, values = bind_expression(
+    "u", [(split_name(key), "add", (value,)) for key, value in kwargs.items()], ", ")
+  params = {
+    "TableName": table,
+    "Key": {split_name(k): dh_wrap_field(v) for (k,v) in keys.items()},
+    "UpdateExpression": "ADD " + expression,
+    "ExpressionAttributeValues": values,
+    "ExpressionAttributeNames": names
+  }
+  logger.debug("Adding to item using params %s", params)
+  ddb.update_item(**params)
 
 def del_ddb_item(table, **kwargs):
   """
   Delete item from ddb table using keys (expected to be in kwargs)
   """
-  ddb = boto3.client("dynamodb")
+  ddb = get_client("dynamodb")
   keys_for_dynamo = {split_name(k): dh_wrap_field(v) for (k,v) in kwargs.items()}
   params = {
     "TableName": table,
     "Key": keys_for_dynamo
   }
-  logger.info("Getting item using params {p}".format(p=params))
+  logger.debug("Deleting item using params %s", params)
   response = ddb.delete_item(**params)
-  logger.info("Item deleted.")
+  logger.debug("Item deleted.")
+
+def claim_ddb_item(table, expected, **kwargs):
+  """
+  Deletes an item using keys in kwargs, only if it has the field values in expected
+  Returns the deleted item, None if it was missing or did not match, so when
+  greenlets or hosts race for the same item only one of them gets it
+  """
+  ddb = get_client("dynamodb")
+  expression, names, values = bind_expression(
+    "c", [(split_name(key), "eq", (value,)) for key, value in expected.items()])
+  params = {
+    "TableName": table,
+    "Key": {split_name(k): dh_wrap_field(v) for (k,v) in kwargs.items()},
+    "ConditionExpression": expression,
+    "ExpressionAttributeValues": values,
+    "ExpressionAttributeNames": names,
+    "ReturnValues": "ALL_OLD"
+  }
+  logger.debug("Claiming item using params %s", params)
+  try:
+    response = ddb.delete_item(**params)
+  except Exception as err:
+    if is_condition_failure(err):
+      logger.debug("Item not claimed")
+      return None
+    raise
+  return {key: flatten(value) for key, value in response.get("Attributes", {}).items()} or None
 
 def get_ddb_item(table, **kwargs):
   """
   Get item from ddb table using keys (expected to be in kwargs)
   Uses a consistent read
   """
-  ddb = boto3.client("dynamodb")
+  ddb = get_client("dynamodb")
   keys_for_dynamo = {split_name(k): dh_wrap_field(v) for (k,v) in kwargs.items()}
   params = {
     "TableName": table,
     "Key": keys_for_dynamo
   }
-  logger.info("Getting item using params {p}".format(p=params))
+  logger.debug("Getting item using params %s", params)
   response = ddb.get_item(**params)
   if "Item" in response:
-    logger.info("Got an item")
+    logger.debug("Got an item")
     flattened_item = {}
     for key, value in response["Item"].items():
       flattened_item.update({
@@ -122,119 +263,160 @@ def get_ddb_item(table, **kwargs):
   else:
     return None
 
-def get_ddb_items_with_keys(table, **kwargs):
+def get_table_keys(table):
   """
-  Queries a table for items based on key values
-  Cheaper than scanning when you know the keys
+  Gets the keys a table can be queried on, [(index name, hash key, range key)]
+  with None as the name of the table's own keys, read once with describe_table
+  Only indexes which project every attribute are used, others would return partial items
   """
-  ddb = boto3.client("dynamodb")
-  params = {
-    "TableName": table,
-    "Limit": 100,
-    "ConsistentRead": False
-  }
-  expression_bits = []
-  attributes = {}
-  attributenames = {}
-  chr_counter = 65
-  if len(kwargs) > 0:
-    # create filter expression
-    for key in [key for key in list(kwargs.keys())]:
-      logger.info("working on field {key}".format(key=key))
-      expression_bits.append("#n{key} = :{val}".format(key=split_name(key), val=chr(chr_counter)))
-      attributes.update({
-        ":{key}".format(key=chr(chr_counter)): dh_wrap_field(kwargs[key])
-      })
-      attributenames.update({
-        "#n{key}".format(key=split_name(key)): "{key}".format(key=split_name(key))
-      })
-      chr_counter = chr_counter +  1
-    filter_expression = " AND ".join(expression_bits)
-    params.update({
-      "KeyConditionExpression": filter_expression,
-      "ExpressionAttributeValues": attributes,
-      "ExpressionAttributeNames": attributenames
-    })
-  keep_scanning = True
-  logger.info("Starting query...")
-  logger.info(params)
-  items = []
-  while keep_scanning:
-    response = ddb.query(**params)
-    items = items + response["Items"]
-    if "LastEvaluatedKey" in response:
-      params.update({
-          "ExclusiveStartKey": response["LastEvaluatedKey"]
-      })
-    else:
-      keep_scanning = False
-  logger.info("Finished scan, got {l} items".format(l=len(items)))
-  flattened_items = []
-  for item in items:
-    flattened_item = {}
-    for key, value in item.items():
-      flattened_item.update({
-        key: flatten(value)
-      })
+  if table not in table_keys:
+    try:
+      description = get_client("dynamodb").describe_table(TableName=table)["Table"]
+    except Exception as err:
+      logger.warning("Could not describe table %s, assuming the usual keys: %s", table, err)
+      table_keys[table] = [(None,) + DEFAULT_KEYS]
+      return table_keys[table]
 
-    flattened_items.append(flattened_item)
-  return flattened_items
+    def keys_of(schema):
+      keys = {key["KeyType"]: key["AttributeName"] for key in schema}
+      return keys["HASH"], keys.get("RANGE")
 
-def get_ddb_items(table, **kwargs):
+    keys = [(None,) + keys_of(description["KeySchema"])]
+    for index in description.get("GlobalSecondaryIndexes", []):
+      if index.get("Projection", {}).get("ProjectionType") == "ALL":
+        keys.append((index["IndexName"],) + keys_of(index["KeySchema"]))
+    table_keys[table] = keys
+  return table_keys[table]
+
+def parse_condition(key, value):
   """
-  Scan table to get items which match kwargs
-  Can be an expensive method to call.
+  Splits a condition such as state_time__gt=10 into (field, operator, values)
+  A key without an operator is an equality test
   """
-  ddb = boto3.client("dynamodb")
-  params = {
-    "TableName": table,
-    "Limit": 100,
-    "ConsistentRead": False
-  }
-  # check if we need to filter
-  expression_bits = []
-  attributes = {}
-  attributenames = {}
-  chr_counter = 65
-  if len(kwargs) > 0:
-    # create filter expression
-    for key in [key for key in list(kwargs.keys())]:
-      logger.info("working on field {key}".format(key=key))
-      expression_bits.append("#n{key} = :{val}".format(key=split_name(key), val=chr(chr_counter)))
-      attributes.update({
-        ":{key}".format(key=chr(chr_counter)): dh_wrap_field(kwargs[key])
-      })
-      attributenames.update({
-        "#n{key}".format(key=split_name(key)): "{key}".format(key=split_name(key))
-      })
-      chr_counter = chr_counter +  1
-    filter_expression = " AND ".join(expression_bits)
-    params.update({
-      "FilterExpression": filter_expression,
-      "ExpressionAttributeValues": attributes,
-      "ExpressionAttributeNames": attributenames
-    })
-  keep_scanning = True
-  logger.info("Starting scan...")
-  logger.info(params)
+  field, _, op = key.partition("__")
+  op = op or "eq"
+  if op not in OPERATORS or op in INTERNAL_OPERATORS:
+    raise ValueError(f"Unknown condition {op} on {field}")
+  if op == "exists":
+    return split_name(field), "exists" if value else "not_exists", ()
+  if op == "in":
+    if not value:
+      # "IN ()" is not valid, and nothing could match it anyway
+      raise ValueError(f"Empty list for in condition on {field}")
+    return split_name(field), op, tuple(value)
+  if op == "between":
+    low, high = value
+    return split_name(field), op, (low, high)
+  return split_name(field), op, (value,)
+
+@lru_cache(maxsize=256)
+def compile_expression(prefix, shape, separator=" AND "):
+  """
+  Builds the expression for conditions of the given shape, ((field, operator, number of values), ...)
+  Placeholders are numbered in order under prefix, so the same shape always
+  compiles to the same expression and only the values change between calls
+  The parts are joined with separator, ", " for the clauses of an update
+  Returns (expression, attribute names)
+  """
+  bits = []
+  names = {}
+  counter = 0
+  for n, (field, op, count) in enumerate(shape):
+    name = f"#{prefix}{n}"
+    names[name] = field
+    values = [f":{prefix}{counter + i}" for i in range(count)]
+    counter = counter + count
+    bits.append(OPERATORS[op].format(name=name, values=", ".join(values), low=values[0] if values else None, high=values[-1] if values else None))
+  return separator.join(bits), names
+
+def bind_expression(prefix, conditions, separator=" AND "):
+  """
+  Gets the compiled expression, names and values for parsed conditions
+  """
+  shape = tuple((field, op, len(values)) for field, op, values in conditions)
+  expression, names = compile_expression(prefix, shape, separator)
+  placeholders = [value for _, _, values in conditions for value in values]
+  # a copy, the cached names must not be changed by callers merging expressions
+  return expression, dict(names), {f":{prefix}{n}": dh_wrap_field(value) for n, value in enumerate(placeholders)}
+
+def plan_ddb_query(table, **kwargs):
+  """
+  Works out how to find the items matching the conditions in kwargs
+  The table or index with an equality condition on its hash key, and
+  preferably a condition on its range key, is queried and the other
+  conditions filter the results. With no such key the table is scanned.
+  Conditions are field=value for equality or field__<operator>=value where
+  operator is one of eq, ne, lt, lte, gt, gte, between (a pair), in (a list),
+  begins_with or exists (True or False)
+  Returns a QueryPlan, its operation and index say which path was chosen
+  """
+  conditions = [parse_condition(key, value) for key, value in kwargs.items()]
+  best = None
+  for index, hash_key, range_key in get_table_keys(table):
+    hash_condition = next((c for c in conditions if c[0] == hash_key and c[1] == "eq"), None)
+    if hash_condition is None:
+      continue
+    range_condition = next((c for c in conditions if range_key and c[0] == range_key and c[1] in KEY_OPERATORS), None)
+    score = 2 if range_condition else 1
+    # the table wins a tie, an index is written after it and can lag behind
+    if best is None or score > best[0]:
+      best = (score, index, [c for c in (hash_condition, range_condition) if c])
+  params = {"TableName": table}
+  names = {}
+  values = {}
+  key_conditions = best[2] if best else []
+  if best:
+    key_expression, key_names, key_values = bind_expression("k", key_conditions)
+    params["KeyConditionExpression"] = key_expression
+    names.update(key_names)
+    values.update(key_values)
+    if best[1]:
+      params["IndexName"] = best[1]
+  filter_conditions = [c for c in conditions if c not in key_conditions]
+  if filter_conditions:
+    filter_expression, filter_names, filter_values = bind_expression("f", filter_conditions)
+    params["FilterExpression"] = filter_expression
+    names.update(filter_names)
+    values.update(filter_values)
+  if names:
+    params["ExpressionAttributeNames"] = names
+  if values:
+    params["ExpressionAttributeValues"] = values
+  return QueryPlan("query" if best else "scan", best[1] if best else None, params)
+
+def find_ddb_items(table, **kwargs):
+  """
+  Gets the items matching the conditions in kwargs, see plan_ddb_query
+  """
+  plan = plan_ddb_query(table, **kwargs)
+  if plan.operation == "scan" and kwargs:
+    logger.info("No key matches %s, scanning %s", list(kwargs), table)
+  ddb = get_client("dynamodb")
+  params = dict(plan.params, Limit=100, ConsistentRead=False)
+  read = ddb.query if plan.operation == "query" else ddb.scan
+  logger.debug("Starting %s with params %s", plan.operation, params)
   items = []
-  while keep_scanning:
-    response = ddb.scan(**params)
+  while True:
+    response = read(**params)
     items = items + response["Items"]
-    if "LastEvaluatedKey" in response:
-      params.update({
-          "ExclusiveStartKey": response["LastEvaluatedKey"]
-      })
-    else:
-      keep_scanning = False
-  logger.info("Finished scan, got {l} items".format(l=len(items)))
-  flattened_items = []
-  for item in items:
-    flattened_item = {}
-    for key, value in item.items():
-      flattened_item.update({
-        key: flatten(value)
-      })
+    if "LastEvaluatedKey" not in response:
+      break
+    params.update({
+      "ExclusiveStartKey": response["LastEvaluatedKey"]
+    })
+  logger.info("Finished %s, got %d items", plan.operation, len(items))
+  return [{key: flatten(value) for key, value in item.items()} for item in items]
 
-    flattened_items.append(flattened_item)
-  return flattened_items
+def get_ddb_items_with_keys(table, **kwargs):
+  """
+  Queries a table for items based on key values
+  Cheaper than scanning when you know the keys
+  """
+  return find_ddb_items(table, **kwargs)
+
+def get_ddb_items(table, **kwargs):
+  """
+  Gets the items which match kwargs, querying when they include a key
+  Without one this is a scan and can be expensive
+  """
+  return find_ddb_items(table, **kwargs)
@@ -1,21 +1,51 @@
 """
 Code to create ECS/fargate tasks for creating/destroying instances
+
+PROVISION_BACKEND=queue hands the work to long-running workers instead (see
+workqueue.py), the returned job id is used like a task ARN.
+
+With PROVISION_BATCH_MS set, requests are gathered for that long (or until
+PROVISION_BATCH_SIZE of them) and started as one task. A batch of more than
+one desktop is written to a manifest in the config table and the task gets
+MODE=batch and MANIFEST_ID instead of the per-desktop variables:
+
+| partition key | sort key    |
+| manifest      | manifest id | {desktops: [environment, ...], user_data: {machine_def_id: B64_USER_DATA}, created, expires, results: {desktop_id: "ok" or error}}
+
+User data is the bulk of an environment and the same for every desktop of a
+machine definition, so the manifest holds it once per machine definition and
+the desktops' environments leave B64_USER_DATA out. A batch is also started
+early once its manifest would pass PROVISION_MANIFEST_MAX_BYTES, as an item
+cannot be larger than 400KB.
+
+The instance-manager records the outcome for each desktop in results, which
+is how failures are reported per desktop (see tasks.py). expires can be used
+as the table's TTL attribute.
 """
-import boto3
+import json
+import time
 import logging
-from decouple import config
+import gevent
+from gevent.event import AsyncResult
 
-CLUSTER_NAME = config("CLUSTER_NAME")
-SEC_GROUP_ID = config("SECURITY_GROUP")
-TASK_ARN = config("TASK_ARN")
-SUBNETS = config("SUBNETS")
+from aws import get_client
+from settings import setting
+from data import ddb_create, get_ddb_item
+from utils import get_rand_string
+import workqueue
 
-ecs = boto3.client("ecs")
 logger = logging.getLogger(__name__)
 
+MANIFEST_DOMAIN = "manifest"
+MANIFEST_TTL_SECONDS = 86400
+
+# the batch being gathered, (environment, AsyncResult) pairs
+current_batch = None
+
 def destroy_desktop_instance(desktop_id, ami_id, machine_username, screen_geometry, machine_def_id, instance_type, user_data):
   """
   Create a task to destroy an instance
+  Returns the task ARN, None if the task was not created
   """
   environment = {
     "MODE": "destroy",
@@ -27,17 +57,12 @@ def destroy_desktop_instance(desktop_id, ami_id, machine_username, screen_geomet
     "INSTANCE_TYPE": instance_type,
     "B64_USER_DATA": user_data
   }
-  return start_standalone_task(
-    task_arn = TASK_ARN,
-    cluster = CLUSTER_NAME,
-    subnets = SUBNETS.split(","),
-    security_group = SEC_GROUP_ID,
-    environment = environment
-  )
+  return start_desktop_task(environment)
 
 def create_desktop_instance(desktop_id, ami_id, machine_username, screen_geometry, machine_def_id, instance_type, user_data):
   """
   Create a task to create an instance
+  Returns the task ARN, None if the task was not created
   """
   environment = {
     "MODE": "apply",
@@ -49,19 +74,123 @@ def create_desktop_instance(desktop_id, ami_id, machine_username, screen_geometr
     "INSTANCE_TYPE": instance_type,
     "B64_USER_DATA": user_data
   }
+  return start_desktop_task(environment)
+
+def batch_window():
+  return setting("PROVISION_BATCH_MS", default=0, cast=int) / 1000.0
+
+def start_desktop_task(environment):
+  """
+  Starts a task for one desktop, or adds it to the batch being gathered and
+  waits for that to start
+  Returns the task ARN, None if the task was not created
+  """
+  global current_batch
+  window = batch_window()
+  if not window:
+    return start_task(environment)
+  result = AsyncResult()
+  if current_batch and manifest_size([e for e, _ in current_batch] + [environment]) > setting("PROVISION_MANIFEST_MAX_BYTES", default=350000, cast=int):
+    # start what has been gathered, this desktop begins the next batch
+    gevent.spawn(flush_batch, current_batch)
+    current_batch = None
+  if current_batch is None:
+    current_batch = []
+    gevent.spawn_later(window, flush_batch, current_batch)
+  batch = current_batch
+  batch.append((environment, result))
+  if len(batch) >= setting("PROVISION_BATCH_SIZE", default=25, cast=int):
+    # full, later desktops must start a new batch before flush_batch runs
+    current_batch = None
+    gevent.spawn(flush_batch, batch)
+  return result.get()
+
+def flush_batch(batch):
+  """
+  Starts the task for a batch, the window timer and a full batch can both get here
+  """
+  global current_batch
+  if current_batch is batch:
+    current_batch = None
+  entries = batch[:]
+  del batch[:]
+  if not entries:
+    return
+  try:
+    if len(entries) == 1:
+      task = start_task(entries[0][0])
+    else:
+      manifest_id = write_manifest([environment for environment, _ in entries])
+      logger.info("Starting one task for %d desktops, manifest %s", len(entries), manifest_id)
+      task = start_task({"MODE": "batch", "MANIFEST_ID": manifest_id})
+  except Exception as err:
+    for _, result in entries:
+      result.set_exception(err)
+    return
+  for _, result in entries:
+    result.set(task)
+
+def manifest_desktops(environments):
+  """
+  Splits environments into the desktops and user_data of a manifest
+  """
+  desktops = []
+  user_data = {}
+  for environment in environments:
+    desktop = dict(environment)
+    user_data[desktop["MACHINE_DEF_ID"]] = desktop.pop("B64_USER_DATA")
+    desktops.append(desktop)
+  return desktops, user_data
+
+def manifest_size(environments):
+  """
+  Roughly how many bytes the manifest of these environments takes in DynamoDB
+  """
+  desktops, user_data = manifest_desktops(environments)
+  return len(json.dumps(desktops)) + len(json.dumps(user_data))
+
+def write_manifest(environments):
+  manifest_id = get_rand_string(16)
+  now = int(time.time())
+  desktops, user_data = manifest_desktops(environments)
+  ddb_create(
+    setting("TABLE_NAME"),
+    domain=MANIFEST_DOMAIN,
+    sub_id=manifest_id,
+    desktops=desktops,
+    user_data=user_data,
+    created=now,
+    expires=now + MANIFEST_TTL_SECONDS
+  )
+  return manifest_id
+
+def get_manifest_results(manifest_id):
+  """
+  Outcome of each desktop in a batch so far, keyed by desktop id
+  """
+  manifest = get_ddb_item(setting("TABLE_NAME"), domain=MANIFEST_DOMAIN, sub_id=manifest_id)
+  return (manifest or {}).get("results", {})
+
+def start_task(environment):
+  """
+  Starts a task, or queues a job for the provisioning workers, see workqueue.py
+  """
+  if workqueue.queue_enabled():
+    return workqueue.enqueue(environment)
   return start_standalone_task(
-    task_arn = TASK_ARN,
-    cluster = CLUSTER_NAME,
-    subnets = SUBNETS.split(","),
-    security_group = SEC_GROUP_ID,
+    task_arn = setting("TASK_ARN"),
+    cluster = setting("CLUSTER_NAME"),
+    subnets = setting("SUBNETS").split(","),
+    security_group = setting("SECURITY_GROUP"),
     environment = environment
   )
 
 def start_standalone_task(task_arn, cluster, subnets, security_group, environment):
   """
   Start a standalone task
+  Returns the task ARN, None if the task was not created
   """
-  logger.info(f"Will use subnets: {subnets}")
+  logger.debug("Will use subnets: %s", subnets)
   environmentOverrides = []
   for key, value in environment.items():
     environmentOverrides.append({
@@ -89,11 +218,11 @@ def start_standalone_task(task_arn, cluster, subnets, security_group, environmen
     },
     "taskDefinition": task_arn
   }
-  logger.info(f"About to create this task {params}")
-  response = ecs.run_task(**params)
+  logger.debug("About to create this task %s", params)
+  response = get_client("ecs").run_task(**params)
   if len(response["tasks"]) > 0:
     logger.info("Task was created")
-    return True
+    return response["tasks"][0]["taskArn"]
   else:
-    logger.info("Task was not created")
-    return False
\ No newline at end of file
+    logger.info("Task was not created: %s", response.get("failures"))
+    return None
\ No newline at end of file
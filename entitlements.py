@@ -1,39 +1,55 @@
-from decouple import config
 import logging
+from settings import setting
 from data import get_ddb_items_with_keys, get_ddb_item
 from instance import scan_for_instances_with_tags
-
-TABLE_NAME = config("TABLE_NAME")
+from singleflight import shared
+import registry
 
 logger = logging.getLogger(__name__)
 
+@shared("entitlements.get_role")
+def get_role(role):
+  return get_ddb_item(setting("TABLE_NAME"), domain="role", sub_id=role)
+
+@shared("entitlements.get_entitlement")
+def get_entitlement(entitlement_id):
+  return get_ddb_item(setting("TABLE_NAME"), domain="entitlement", sub_id=entitlement_id)
+
+@shared("entitlements.get_entitlements_for_roles", scope="username")
 def get_entitlements_for_roles(roles, username):
   """
   Gets entitlements for a set of toles
   """
-  logger.info("Getting entitlements for roles: {roles}".format(roles=roles))
+  logger.info("Getting entitlements for roles: %s", roles)
   flattened_entitlements = []
+  # one query for all of the user's desktops, including ones being provisioned
+  desktops = None
+  if registry.registry_ready():
+    desktops = registry.list_desktops(username)
   for role in roles:
-    role_record = get_ddb_item(TABLE_NAME, domain="role", sub_id=role)
+    role_record = get_role(role)
     if role_record:
       if "entitlements" in role_record:
         entitlements = role_record["entitlements"]
         for entitlement in entitlements:
-          entitlement = get_ddb_item(TABLE_NAME, domain="entitlement", sub_id=entitlement)
-          instances = scan_for_instances_with_tags([
-            {
-              "name": "MachineDef",
-              "value": entitlement["machine_def"]
-            },
-            {
-              "name": "MachineType",
-              "value": "Desktop"
-            },
-            {
-              "name": "Username",
-              "value": username
-            }
-          ])
+          entitlement = get_entitlement(entitlement)
+          if desktops is not None:
+            instances = [d for d in desktops if d.get("machine_def_id") == entitlement["machine_def"]]
+          else:
+            instances = scan_for_instances_with_tags([
+              {
+                "name": "MachineDef",
+                "value": entitlement["machine_def"]
+              },
+              {
+                "name": "MachineType",
+                "value": "Desktop"
+              },
+              {
+                "name": "Username",
+                "value": username
+              }
+            ])
           flattened_entitlements.append({
             "machine_def_id": entitlement["machine_def"],
             "total_allowed_instances": entitlement["machine_count"],
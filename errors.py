@@ -27,6 +27,15 @@ class AccessDeniedException(Exception):
     def __init__(self, *args, **kwargs):
         Exception.__init__(self, *args, **kwargs)
 
+class ServiceUnavailableException(Exception):
+    """Error thrown when this server or an AWS service we depend on cannot take the request now"""
+    def __init__(self, *args, retry_after=1, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+        self.retry_after = retry_after
+
+class AWSUnavailableException(ServiceUnavailableException):
+    """Error thrown when an AWS service we depend on is throttling us or is unavailable"""
+
 def error_handler(f):
     """
     Function to manage errors coming back to webservice calls
@@ -46,6 +55,10 @@ def error_handler(f):
             return exception_to_json_response(err, 429)
         except AccessDeniedException as err:
             return exception_to_json_response(err, 403)
+        except ServiceUnavailableException as err:
+            resp = exception_to_json_response(err, 503)
+            resp.headers["Retry-After"] = str(err.retry_after)
+            return resp
         #except Exception as err:
         #    logger.error(err, exc_info=True)
         #    return generic_exception_json_response(500)
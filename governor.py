@@ -0,0 +1,304 @@
+"""
+governor.py
+
+Keeps the worker's AWS calls under the API rate limits.
+
+Every call made through a governed client first takes a token from a bucket
+for its service and operation, shared by all greenlets in the worker. When AWS
+answers with a throttling error the bucket's rate is halved and the call is
+retried after a jittered backoff; successful calls let the rate climb back to
+the configured one. Server errors and connection failures are retried with
+the same backoff, botocore's own retries are off. A call still failing after
+GOVERNOR_MAX_RETRIES raises AWSUnavailableException (503 with Retry-After).
+Each service also has a circuit breaker, after repeated throttling, server
+errors or connection failures calls fail fast until the breaker lets a trial
+call through. Errors raised before a request is sent, such as invalid
+parameters, are bugs rather than outages and do not count.
+
+Settings:
+  GOVERNOR_ENABLED           wrap clients at all (default True)
+  GOVERNOR_RATES             calls/second, e.g. "ec2=20,ecs.run_task=1"
+  GOVERNOR_DEFAULT_RATE      for anything not in GOVERNOR_RATES (default 0,
+                             no limit until AWS throttles the operation)
+  GOVERNOR_MAX_RETRIES       retries of a throttled or failing call (default 3)
+  GOVERNOR_BREAKER_FAILURES  consecutive failures to open a breaker (default 5)
+  GOVERNOR_BREAKER_SECONDS   how long a breaker stays open (default 15)
+"""
+import math
+import time
+import random
+import logging
+import gevent
+
+from settings import setting
+from errors import AWSUnavailableException
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_CODES = {
+  "Throttling",
+  "ThrottlingException",
+  "ThrottledException",
+  "RequestThrottled",
+  "RequestThrottledException",
+  "RequestLimitExceeded",
+  "TooManyRequestsException",
+  "ProvisionedThroughputExceededException",
+  "SlowDown"
+}
+
+# client attributes which are not API calls
+NOT_OPERATIONS = {"can_paginate", "get_paginator", "get_waiter", "generate_presigned_url", "close"}
+
+buckets = {}
+breakers = {}
+
+def parse_rates(text):
+  """
+  Turn "ec2=20,ecs.run_task=1" into {"ec2": 20.0, "ecs.run_task": 1.0}
+  """
+  rates = {}
+  for part in filter(None, (text or "").split(",")):
+    name, _, rate = part.partition("=")
+    rates[name.strip()] = float(rate)
+  return rates
+
+def error_code(err):
+  return getattr(err, "response", {}).get("Error", {}).get("Code")
+
+def is_throttle(err):
+  return error_code(err) in THROTTLE_CODES
+
+def is_outage(err):
+  """
+  True for errors which say the service is degraded rather than the request bad:
+  server errors, and connections which failed or timed out
+  """
+  response = getattr(err, "response", None)
+  if response is None:
+    from botocore.exceptions import ConnectionError, HTTPClientError
+    return isinstance(err, (ConnectionError, HTTPClientError))
+  return response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+
+class TokenBucket():
+  """
+  Rate limiter which also adapts its rate to throttling responses
+  A bucket without a rate lets every call through until the first throttling
+  response, then limits calls to half the rate they were made at and climbs
+  back until it no longer needs a limit
+  """
+  def __init__(self, rate=None):
+    self.max_rate = rate
+    self.rate = rate
+    self.tokens = max(1.0, rate or 1.0)
+    self.updated = time.monotonic()
+    self.adjusted = 0
+    # rate AWS throttled us at, and calls counted to measure it, for buckets without a rate
+    self.ceiling = None
+    self.calls = 0
+    self.observed = 0.0
+
+  def reserve(self):
+    """
+    Takes a token, returns how long the caller has to wait for it
+    Tokens can go negative so waiting callers queue in order
+    """
+    now = time.monotonic()
+    if self.rate is None:
+      # count the calls made in each second, a throttled bucket starts from that
+      if now - self.updated >= 1:
+        self.observed = self.calls / (now - self.updated)
+        self.calls = 0
+        self.updated = now
+      self.calls += 1
+      return 0
+    self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    self.tokens -= 1
+    return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+  def throttled(self):
+    # a burst of calls gets throttled together, count that as one signal
+    now = time.monotonic()
+    if self.rate is None:
+      elapsed = now - self.updated
+      self.ceiling = max(1.0, self.observed, self.calls / elapsed if elapsed >= 1 else self.calls)
+      self.rate = self.ceiling / 2
+      self.tokens = 0
+      self.updated = now
+      self.adjusted = now
+    elif now - self.adjusted > 1:
+      self.rate = max((self.max_rate or self.ceiling) / 64, self.rate / 2)
+      self.adjusted = now
+    self.tokens = min(self.tokens, 0)
+
+  def succeeded(self):
+    # climb back by 5% of the configured (or throttled) rate per second without throttling
+    if self.rate is None:
+      return
+    top = self.max_rate or self.ceiling
+    if self.rate < top:
+      now = time.monotonic()
+      self.rate = min(top, self.rate + (now - self.adjusted) * top / 20)
+      self.adjusted = now
+    elif self.max_rate is None:
+      # back where AWS throttled us without being throttled again, stop limiting
+      self.rate = None
+      self.calls = 0
+      self.updated = time.monotonic()
+
+class CircuitBreaker():
+  """
+  Opens after a run of failures, then lets one trial call through at a time
+  once it has been open for open_seconds
+  """
+  def __init__(self, service, failures, open_seconds):
+    self.service = service
+    self.max_failures = failures
+    self.open_seconds = open_seconds
+    self.failures = 0
+    self.opened_at = None
+    self.trial = False
+
+  def retry_after(self):
+    return max(1, math.ceil(self.opened_at + self.open_seconds - time.monotonic()))
+
+  def before_call(self):
+    """
+    Raises if calls are not allowed, returns True if this call is the trial
+    call, which has to be ended with end_trial however it finishes
+    """
+    if self.opened_at is None:
+      return False
+    if time.monotonic() - self.opened_at < self.open_seconds or self.trial:
+      raise AWSUnavailableException(
+        f"The {self.service} service is unavailable, try again later",
+        retry_after=self.retry_after()
+      )
+    self.trial = True
+    return True
+
+  def end_trial(self):
+    # succeeded or failed have already run if the call got an answer
+    self.trial = False
+
+  def succeeded(self):
+    if self.opened_at is not None:
+      logger.warning("Circuit breaker for %s closed", self.service)
+    self.failures = 0
+    self.opened_at = None
+    self.trial = False
+
+  def failed(self):
+    self.failures += 1
+    if self.trial or (self.opened_at is None and self.failures >= self.max_failures):
+      logger.warning("Circuit breaker for %s opened after %d failures", self.service, self.failures)
+      self.opened_at = time.monotonic()
+    self.trial = False
+
+def get_bucket(service, operation):
+  key = f"{service}.{operation}"
+  bucket = buckets.get(key)
+  if bucket is None:
+    rates = parse_rates(setting("GOVERNOR_RATES", default=""))
+    rate = rates.get(key, rates.get(service, setting("GOVERNOR_DEFAULT_RATE", default=0, cast=float)))
+    bucket = buckets[key] = TokenBucket(rate or None)
+  return bucket
+
+def get_breaker(service):
+  breaker = breakers.get(service)
+  if breaker is None:
+    breaker = breakers[service] = CircuitBreaker(
+      service,
+      setting("GOVERNOR_BREAKER_FAILURES", default=5, cast=int),
+      setting("GOVERNOR_BREAKER_SECONDS", default=15, cast=float)
+    )
+  return breaker
+
+def call(service, operation, method, args, kwargs):
+  """
+  Makes an API call within the service's limits
+  args and kwargs are passed as they are, API parameters such as ECS's
+  service would clash with our own names if unpacked here
+  """
+  bucket = get_bucket(service, operation)
+  breaker = get_breaker(service)
+  max_retries = setting("GOVERNOR_MAX_RETRIES", default=3, cast=int)
+  attempt = 0
+  # checked once per call, retries belong to the same call
+  trial = breaker.before_call()
+  try:
+    while True:
+      wait = bucket.reserve()
+      if wait:
+        gevent.sleep(wait)
+      try:
+        response = method(*args, **kwargs)
+      except Exception as err:
+        throttled = is_throttle(err)
+        if not throttled and not is_outage(err):
+          if getattr(err, "response", None) is not None:
+            # the service answered, it is up
+            breaker.succeeded()
+          raise
+        if throttled:
+          bucket.throttled()
+        if attempt < max_retries:
+          attempt += 1
+          # full jitter so the greenlets which failed together spread out
+          gevent.sleep(random.uniform(0, min(2.0, 0.1 * 2 ** attempt)))
+          continue
+        breaker.failed()
+        if throttled:
+          logger.warning("%s.%s still throttled after %d retries", service, operation, max_retries)
+          raise AWSUnavailableException(
+            f"The {service} service is busy, try again later",
+            retry_after=max(1, math.ceil(1 / bucket.rate))
+          ) from err
+        logger.warning("%s.%s still failing after %d retries: %s", service, operation, max_retries, err)
+        raise AWSUnavailableException(
+          f"The {service} service is unavailable, try again later",
+          retry_after=breaker.retry_after() if breaker.opened_at is not None else 1
+        ) from err
+      bucket.succeeded()
+      breaker.succeeded()
+      return response
+  finally:
+    if trial:
+      breaker.end_trial()
+
+class GovernedClient():
+  """
+  Wraps a boto3 client so every API call goes through call()
+  """
+  def __init__(self, client, service):
+    self._client = client
+    self._service = service
+    self._methods = {}
+
+  def __getattr__(self, name):
+    method = self._methods.get(name)
+    if method is not None:
+      return method
+    attribute = getattr(self._client, name)
+    if name.startswith("_") or name in NOT_OPERATIONS or not callable(attribute):
+      return attribute
+    def method(*args, **kwargs):
+      return call(self._service, name, attribute, args, kwargs)
+    self._methods[name] = method
+    return method
+
+def governor_enabled():
+  return setting("GOVERNOR_ENABLED", default=True, cast=bool)
+
+def client_config():
+  """
+  botocore config for governed clients, retries are left to the governor so
+  a failed call is not retried both by botocore and by us
+  """
+  from botocore.config import Config
+  return Config(retries={"mode": "standard", "max_attempts": 1})
+
+def reset():
+  buckets.clear()
+  breakers.clear()
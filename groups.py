@@ -1,20 +1,65 @@
-from decouple import config
+import time
 import logging
+from gevent.lock import BoundedSemaphore
+from settings import setting
 from data import get_ddb_items_with_keys
+import localcache
+
+CACHE_NAMESPACE = "config"
+CACHE_KEY = "group_role_map"
 
-TABLE_NAME = config("TABLE_NAME")
 group_role_map = {}
+loaded_version = None
+checked_at = 0
+lock = BoundedSemaphore(1)
 
 logger = logging.getLogger(__name__)
 
 def get_groups_and_roles():
   """
   Gets group and role mapping from database
+  Also shares it with the other workers on this host through the local cache
   """
+  global loaded_version
   logger.info("Getting group/role map")
-  groups = get_ddb_items_with_keys(TABLE_NAME, domain="group")
+  groups = get_ddb_items_with_keys(setting("TABLE_NAME"), domain="group")
   group_role_map.clear()
   for group in groups:
     group_role_map.update({
       group["sub_id"]: group["roles"]
-    })
\ No newline at end of file
+    })
+  localcache.put(CACHE_NAMESPACE, CACHE_KEY, group_role_map)
+  loaded_version = localcache.get_updated(CACHE_NAMESPACE, CACHE_KEY) or time.time()
+
+def load_from_local_cache():
+  """
+  Replaces the map with the local cache copy if that is newer than ours
+  """
+  global loaded_version
+  entry = localcache.get_entry(CACHE_NAMESPACE, CACHE_KEY)
+  if entry and (loaded_version is None or entry[1] > loaded_version):
+    logger.info("Loading group/role map from local cache")
+    group_role_map.clear()
+    group_role_map.update(entry[0])
+    loaded_version = entry[1]
+    return True
+  return False
+
+def get_group_role_map():
+  """
+  Gets the group/role map
+  Served from the local cache when it has a copy, which is checked at most
+  every LOCAL_CACHE_CHECK_SECONDS for changes made by other workers, and only
+  loaded from the database when there is no copy at all
+  """
+  global checked_at
+  now = time.time()
+  if loaded_version is None or now - checked_at > setting("LOCAL_CACHE_CHECK_SECONDS", default=5, cast=int):
+    with lock:
+      if loaded_version is None or now - checked_at > setting("LOCAL_CACHE_CHECK_SECONDS", default=5, cast=int):
+        if not load_from_local_cache() and loaded_version is None:
+          get_groups_and_roles()
+        checked_at = now
+  return group_role_map
+
+localcache.register_refresh("group_role_map", get_groups_and_roles)
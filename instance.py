@@ -2,37 +2,68 @@
 Code to deal with EC2 instances
 """
 import logging
-import boto3
-from decouple import config
-
-env_key = config("ENV_KEY")
+from aws import get_client
+from settings import setting
+from singleflight import shared
+from records import Desktop
+import registry
 
 logger = logging.getLogger(__name__)
-ec2 = boto3.client("ec2")
+
+# errors from a hibernate request which a plain stop avoids
+HIBERNATE_UNSUPPORTED_CODES = {"UnsupportedHibernationConfiguration", "UnsupportedOperation"}
 
 def start_instance(instanceid, hibernate = False):
   """
   Start and EC2 instance
   """
-  response = ec2.start_instances(
+  response = get_client("ec2").start_instances(
     InstanceIds = [instanceid]
   )
-  logging.info(f"Got response from EC2 api {response}")
+  logger.debug("Got response from EC2 api %s", response)
 
 def stop_instance(instanceid, hibernate = False):
   """
   Stop an EC2 instance
   """
-  response = ec2.stop_instances(
+  response = get_client("ec2").stop_instances(
     InstanceIds = [instanceid],
     Hibernate = hibernate
   )
-  logging.info(f"Got response from EC2 api {response}")
+  logger.debug("Got response from EC2 api %s", response)
 
+def suspend_instance(instanceid, hibernation=None):
+  """
+  Hibernate an EC2 instance, or stop it if it was not launched with
+  hibernation configured (hibernation None means not known, so look it up)
+  Returns True if the instance is hibernating
+  """
+  if hibernation is None:
+    details = get_instance_details(instanceid)
+    hibernation = bool(details and details["hibernation"])
+  if hibernation:
+    try:
+      stop_instance(instanceid, hibernate=True)
+      return True
+    except Exception as err:
+      code = getattr(err, "response", {}).get("Error", {}).get("Code")
+      if code not in HIBERNATE_UNSUPPORTED_CODES:
+        raise
+      logger.warning("Could not hibernate %s (%s), stopping it instead", instanceid, code)
+  stop_instance(instanceid)
+  return False
+
+@shared("instance.get_instances_by_username_and_id", scope="username")
 def get_instances_by_username_and_id(username, instanceid):
   """
   Helper method to find an instance which belongs to a given user and which has a specific ID
+  Uses the desktop registry once it is ready, EC2 before that
   """
+  if registry.registry_ready():
+    record = registry.get_desktop(username, instanceid)
+    if record and record.get("instanceid"):
+      return {instanceid: registry.to_instance(record)}
+    return {}
   instances = scan_for_instances_with_tags([
     {
       "name": "MachineType",
@@ -48,16 +79,25 @@ def get_instances_by_username_and_id(username, instanceid):
     },
     {
       "name": "EnvKey",
-      "value": env_key
+      "value": setting("ENV_KEY")
     }
   ])
   return clean_up_instances(instances)
 
 
+@shared("instance.get_instances_by_username", scope="username")
 def get_instances_by_username(username):
   """
   Helper method to search for instances belonging to a given user
-  """
+  Uses the desktop registry once it is ready, EC2 before that
+  Desktops still being provisioned (no instance yet) are not included
+  """
+  if registry.registry_ready():
+    return {
+      record["sub_id"]: registry.to_instance(record)
+      for record in registry.list_desktops(username)
+      if record.get("instanceid")
+    }
   instances = scan_for_instances_with_tags([
     {
       "name": "MachineType",
@@ -69,28 +109,16 @@ def get_instances_by_username(username):
     },
     {
       "name": "EnvKey",
-      "value": env_key
+      "value": setting("ENV_KEY")
     }
   ])
   return clean_up_instances(instances)
 
 def clean_up_instances(instances):
   """
-  Cleans the instance raw data up to send back to client
-  """
-  cleansed_instances = {}
-  for instance in instances:
-    cleansed_instances.update({
-      instance["tags"]["DesktopId"]: {
-        "instanceid": instance["instanceid"],
-        "dns": instance["dns"],
-        "launchtime": instance["launchtime"],
-        "state": instance["state"],
-        "screengeometry": instance["tags"]["ScreenGeometry"],
-        "machine_def_id": instance["tags"]["MachineDef"]
-      }
-    })
-  return cleansed_instances
+  Keys desktop records by desktop id to send back to client
+  """
+  return {instance.desktop_id: instance for instance in instances if instance.desktop_id}
 
 def tag_list_to_dict(tags):
   """
@@ -107,6 +135,7 @@ def scan_for_instances_with_tags(tags):
   """
   Scan for instances with specific tags
   Does not return terminated instances
+  Returns Desktop records
   """
   custom_filter = [{
     "Name": "instance-state-name",
@@ -117,27 +146,50 @@ def scan_for_instances_with_tags(tags):
       "Name":   "tag:{tag}".format(tag = tag["name"]),
       "Values": [tag["value"]]
     })
-  response = ec2.describe_instances(Filters=custom_filter)
+  params = {"Filters": custom_filter}
   instances = []
-  if len(response["Reservations"]) > 0:
+  while True:
+    response = get_client("ec2").describe_instances(**params)
     for reservation in response["Reservations"]:
       if "Instances" in reservation:
         for instance in reservation["Instances"]:
-          instances.append({
-            "instanceid": instance["InstanceId"],
-            "dns": instance["PrivateDnsName"],
-            "launchtime": instance["LaunchTime"],
-            "state": instance["State"]["Name"],
-            "tags": tag_list_to_dict(instance["Tags"]),
-            "securitygroups": instance["SecurityGroups"]
-          })
+          instances.append(Desktop.from_ec2(instance))
+    if response.get("NextToken"):
+      params["NextToken"] = response["NextToken"]
+    else:
+      break
   return instances
 
+def instance_details(instance):
+  """
+  Picks the fields we use out of an EC2 instance description
+  """
+  return {
+    "instanceid": instance["InstanceId"],
+    "dns": instance["PrivateDnsName"],
+    "launchtime": instance["LaunchTime"],
+    "state": instance["State"]["Name"],
+    "tags": tag_list_to_dict(instance.get("Tags", [])),
+    "hibernation": instance.get("HibernationOptions", {}).get("Configured", False)
+  }
+
+def get_instance_details(instance_id):
+  """
+  Get the details (including tags) for a single instance, None if not found
+  """
+  response = get_client("ec2").describe_instances(
+    InstanceIds=[instance_id]
+  )
+  for reservation in response.get("Reservations", []):
+    for instance in reservation.get("Instances", []):
+      return instance_details(instance)
+  return None
+
 def get_tags_for_instance(instance_id):
   """
   Get the tags for an instance
   """
-  response = ec2.describe_instances(
+  response = get_client("ec2").describe_instances(
     InstanceIds=[instance_id]
   )
   if "Reservations" in response:
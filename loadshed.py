@@ -0,0 +1,159 @@
+"""
+loadshed.py
+
+Turns requests away early when the worker is overloaded.
+
+Each route belongs to a class with its own concurrency limit:
+
+  read       cheap lookups and settings, e.g. GET /instance, PUT /prestart
+  provision  routes which start, stop, build or destroy desktops
+  sse        opening an event stream
+
+GET / does no real work and is not limited. A request over its class's
+limit gets a 503 with Retry-After straight away, before any AWS call is
+made, instead of waiting in a pile of greenlets behind a slow AWS API.
+Classes do not share limits, so slow provisioning calls cannot use up the
+room cheap reads need.
+
+An event stream holds its slot until the connection closes, so the sse
+limit caps open streams rather than how fast they are opened.
+
+Limits adapt to latency. Each route remembers the fastest it has recently
+answered, and while a class's requests take more than LOADSHED_TOLERANCE
+times that, or AWS reports itself unavailable, the class's limit is cut by
+a fifth at most once a second down to LOADSHED_MIN_LIMIT. Other 503s, such
+as a draining worker's, say nothing about AWS and do not count. Requests
+which answer in time let it climb back to the configured maximum.
+
+Settings:
+  LOADSHED_ENABLED    shed load at all (default True)
+  LOADSHED_LIMITS     maximum concurrent requests per class (default "read=200,provision=32,sse=100")
+  LOADSHED_MIN_LIMIT  lowest a limit is cut to (default 4)
+  LOADSHED_TOLERANCE  latency over a route's fastest before limits are cut (default 3)
+"""
+import math
+import time
+import random
+import logging
+from functools import wraps
+
+from settings import setting
+from errors import ServiceUnavailableException, AWSUnavailableException
+from governor import parse_rates
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = "read=200,provision=32,sse=100"
+# the fastest time remembered for a route drifts up by a factor of e this
+# often, so a lasting slowdown becomes the new normal after a few minutes
+BASELINE_SECONDS = 60
+# routes answered from cache vary too much below this to judge a slowdown by
+MIN_BASELINE = 0.01
+
+limits = {}
+
+class AdaptiveLimit():
+  """
+  Concurrency limit for a class of routes, cut when its requests slow down
+  """
+  def __init__(self, route_class, max_limit, min_limit, tolerance):
+    self.route_class = route_class
+    self.max_limit = max_limit
+    self.min_limit = min(min_limit, max_limit)
+    self.tolerance = tolerance
+    self.limit = float(max_limit)
+    self.in_flight = 0
+    # (fastest recent time, when) of each route, and smoothed times over those
+    self.baselines = {}
+    self.slowdown = 1.0
+    self.latency = 0.0
+    self.adjusted = 0
+
+  def retry_after(self):
+    # spread the retries over a couple of the current request times
+    return max(1, math.ceil(self.latency * random.uniform(1, 3)))
+
+  def acquire(self):
+    if self.in_flight >= int(self.limit):
+      logger.debug("Shedding %s request, %d in flight", self.route_class, self.in_flight)
+      raise ServiceUnavailableException(
+        "This server is busy, try again later",
+        retry_after=self.retry_after()
+      )
+    self.in_flight += 1
+
+  def release(self):
+    self.in_flight -= 1
+
+  def record(self, route, elapsed, overloaded=False):
+    """
+    Adjusts the limit for how long a request to route took
+    """
+    now = time.monotonic()
+    baseline, updated = self.baselines.get(route, (elapsed, now))
+    baseline = min(elapsed, baseline * (1 + (now - updated) / BASELINE_SECONDS))
+    self.baselines[route] = (baseline, now)
+    self.slowdown = self.slowdown * 0.9 + elapsed / max(baseline, MIN_BASELINE) * 0.1
+    self.latency = self.latency * 0.9 + elapsed * 0.1
+    if overloaded or self.slowdown > self.tolerance:
+      self.slowed()
+    elif self.limit < self.max_limit:
+      # about one more each time the whole limit's worth of requests answer in time
+      self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+  def slowed(self):
+    # a burst of slow requests finish together, count that as one signal
+    now = time.monotonic()
+    if now - self.adjusted > 1 and self.limit > self.min_limit:
+      self.limit = max(self.min_limit, self.limit * 0.8)
+      self.adjusted = now
+      logger.info("Cut %s limit to %d, requests are %.1fx slower", self.route_class, self.limit, self.slowdown)
+
+def loadshed_enabled():
+  return setting("LOADSHED_ENABLED", default=True, cast=bool)
+
+def get_limit(route_class):
+  limit = limits.get(route_class)
+  if limit is None:
+    configured = parse_rates(setting("LOADSHED_LIMITS", default=DEFAULT_LIMITS))
+    limit = limits[route_class] = AdaptiveLimit(
+      route_class,
+      int(configured.get(route_class, parse_rates(DEFAULT_LIMITS)[route_class])),
+      setting("LOADSHED_MIN_LIMIT", default=4, cast=int),
+      setting("LOADSHED_TOLERANCE", default=3, cast=float)
+    )
+  return limit
+
+def limited(route_class):
+  """
+  Decorator which holds a route to its class's concurrency limit
+  Goes below error_handler so a shed request becomes a 503
+  """
+  def decorator(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+      if not loadshed_enabled():
+        return f(*args, **kwargs)
+      limit = get_limit(route_class)
+      limit.acquire()
+      started = time.monotonic()
+      overloaded = False
+      response = None
+      try:
+        response = f(*args, **kwargs)
+        return response
+      except AWSUnavailableException:
+        overloaded = True
+        raise
+      finally:
+        limit.record(f.__name__, time.monotonic() - started, overloaded)
+        if getattr(response, "is_streamed", False):
+          # held while the stream is open, the server closes the response however it ends
+          response.call_on_close(limit.release)
+        else:
+          limit.release()
+    return decorated_function
+  return decorator
+
+def reset():
+  limits.clear()
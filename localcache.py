@@ -0,0 +1,222 @@
+"""
+localcache.py
+
+An on-disk cache shared by every worker on a host, kept across restarts.
+
+Backed by SQLite in WAL mode so readers never block each other or the
+writer. Values are stored as JSON under a (namespace, key) pair. One worker
+per host holds the writer lock and runs the registered refresh jobs, the
+others only read. Set LOCAL_CACHE_PATH to an empty string to turn it off.
+
+SQLite calls run on a thread so a worker waiting on another's write does not
+stall its greenlets, and give up after LOCAL_CACHE_TIMEOUT_SECONDS, callers
+then carry on as if the entry was missing. Entries kept per instance go when
+it terminates, or once not written for LOCAL_CACHE_MAX_AGE_SECONDS.
+"""
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import logging
+import tempfile
+import gevent
+from gevent.threadpool import ThreadPool
+
+from settings import setting
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+  namespace TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  updated REAL NOT NULL,
+  PRIMARY KEY (namespace, key)
+)
+"""
+# what is kept per instance, dropped when it terminates or after LOCAL_CACHE_MAX_AGE_SECONDS
+INSTANCE_NAMESPACES = ("instance_tags",)
+
+connection = None
+connection_pid = None
+pool = None
+pool_pid = None
+writer_lock_file = None
+refresh_jobs = {}
+
+def cache_path():
+  return setting("LOCAL_CACHE_PATH", default=os.path.join(tempfile.gettempdir(), "cloudworkstation-cache.db"))
+
+def get_connection():
+  """
+  Gets this process' connection, connections are not shared across a fork
+  Only used on the cache thread, see execute
+  """
+  global connection, connection_pid
+  path = cache_path()
+  if not path:
+    return None
+  if connection is None or connection_pid != os.getpid():
+    connection = sqlite3.connect(
+      path,
+      timeout=setting("LOCAL_CACHE_TIMEOUT_SECONDS", default=1, cast=float),
+      isolation_level=None,
+      check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(SCHEMA)
+    connection_pid = os.getpid()
+  return connection
+
+def execute(sql, params=()):
+  """
+  Runs a statement and returns its rows, or the number of rows it changed if
+  it returns none, None if the cache is turned off
+  SQLite calls block, and can wait up to LOCAL_CACHE_TIMEOUT_SECONDS for
+  another worker's write, so they run on a thread rather than the gevent hub.
+  One thread per process keeps the connection on a single thread and the
+  calls in order.
+  """
+  global pool, pool_pid
+  if not cache_path():
+    return None
+  if pool is None or pool_pid != os.getpid():
+    pool = ThreadPool(1)
+    pool_pid = os.getpid()
+  return pool.apply(run_statement, (sql, params))
+
+def run_statement(sql, params):
+  cursor = get_connection().execute(sql, params)
+  return cursor.fetchall() if cursor.description else cursor.rowcount
+
+def get_entry(namespace, key, max_age=None):
+  """
+  Gets (value, updated) for a key, None if missing or older than max_age seconds
+  """
+  try:
+    rows = execute("SELECT value, updated FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+  except sqlite3.Error as err:
+    logger.warning("Local cache read failed: %s", err)
+    return None
+  if not rows:
+    return None
+  value, updated = rows[0]
+  if max_age is not None and time.time() - updated > max_age:
+    return None
+  return json.loads(value), updated
+
+def get(namespace, key, max_age=None):
+  """
+  Gets a value, None if missing or older than max_age seconds
+  """
+  entry = get_entry(namespace, key, max_age)
+  return entry[0] if entry else None
+
+def get_updated(namespace, key):
+  """
+  Gets when a key was last written, None if it is missing
+  """
+  try:
+    rows = execute("SELECT updated FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+  except sqlite3.Error as err:
+    logger.warning("Local cache read failed: %s", err)
+    return None
+  return rows[0][0] if rows else None
+
+def put(namespace, key, value):
+  """
+  Stores a value (must be JSON serialisable)
+  """
+  try:
+    execute(
+      "INSERT OR REPLACE INTO cache (namespace, key, value, updated) VALUES (?, ?, ?, ?)",
+      (namespace, key, json.dumps(value, default=str), time.time())
+    )
+  except sqlite3.Error as err:
+    logger.warning("Local cache write failed: %s", err)
+
+def delete(namespace, key):
+  try:
+    execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+  except sqlite3.Error as err:
+    logger.warning("Local cache delete failed: %s", err)
+
+def forget_instance(instance_id):
+  """
+  Drops what is cached about an instance, called once it has terminated
+  """
+  for namespace in INSTANCE_NAMESPACES:
+    delete(namespace, instance_id)
+
+def prune():
+  """
+  Drops instance entries nothing has written for LOCAL_CACHE_MAX_AGE_SECONDS,
+  they are read from EC2 again if the instance is still about
+  """
+  max_age = setting("LOCAL_CACHE_MAX_AGE_SECONDS", default=7 * 86400, cast=int)
+  marks = ", ".join("?" for _ in INSTANCE_NAMESPACES)
+  pruned = execute(
+    f"DELETE FROM cache WHERE namespace IN ({marks}) AND updated < ?",
+    INSTANCE_NAMESPACES + (time.time() - max_age,)
+  )
+  if pruned:
+    logger.info("Pruned %d instance entries from the local cache", pruned)
+
+def reset():
+  """
+  Closes this process' connection, the next call opens it again
+  """
+  global connection
+  if connection is not None:
+    connection.close()
+    connection = None
+
+def is_writer():
+  return writer_lock_file is not None
+
+def try_become_writer():
+  """
+  Takes the per-host writer lock if no other worker holds it
+  The lock is released by the OS if this process dies
+  """
+  global writer_lock_file
+  if writer_lock_file is not None:
+    return True
+  path = cache_path()
+  if not path:
+    return False
+  lock_file = open(f"{path}.lock", "a")
+  try:
+    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except OSError:
+    lock_file.close()
+    return False
+  writer_lock_file = lock_file
+  logger.info("This worker (pid %s) is now the local cache writer", os.getpid())
+  return True
+
+def register_refresh(name, job):
+  """
+  Registers a function the writer calls to keep part of the cache fresh
+  """
+  refresh_jobs[name] = job
+
+def run_writer():
+  """
+  Loop run in every worker, whichever holds the writer lock runs the refresh
+  jobs, the rest keep trying to take over in case the writer goes away
+  """
+  interval = setting("LOCAL_CACHE_REFRESH_SECONDS", default=300, cast=int)
+  while True:
+    if try_become_writer():
+      for name, job in list(refresh_jobs.items()):
+        try:
+          job()
+        except Exception as err:
+          logger.warning("Local cache refresh job %s failed: %s", name, err)
+    gevent.sleep(interval)
+
+register_refresh("prune", prune)
@@ -0,0 +1,299 @@
+"""
+logconfig.py
+
+Sets up logging so that formatting and I/O happen off the request greenlets.
+
+Records are put on a queue by the calling greenlet, and a real OS thread takes
+them off, formats them (as JSON by default) and writes them to stderr. The
+message is built from its arguments before the record is queued, as they may
+change or not be safe to read from another thread by the time it is written.
+Large fields are truncated, sensitive ones redacted, and high volume modules
+can be sampled at a configurable rate.
+"""
+import os
+import sys
+import copy
+import json
+import random
+import atexit
+import logging
+import datetime
+from collections.abc import Mapping
+from logging.handlers import QueueHandler, QueueListener
+from decouple import Csv
+
+from settings import setting
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] (%(threadName)-10s) %(message)s"
+
+# attributes every LogRecord has, anything else came in via extra={}
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+REDACTED = "<redacted>"
+
+listener = None
+queue_handler = None
+fork_hook_registered = False
+
+def originals():
+  """
+  Gets the real thread primitives even when gevent has monkey patched them
+  """
+  try:
+    from gevent import monkey
+    if monkey.is_module_patched("threading"):
+      return (
+        monkey.get_original("_thread", "start_new_thread"),
+        monkey.get_original("_thread", "allocate_lock"),
+        monkey.get_original("queue", "SimpleQueue")
+      )
+  except ImportError:
+    pass
+  import _thread
+  import queue
+  return _thread.start_new_thread, _thread.allocate_lock, queue.SimpleQueue
+
+def parse_rates(text):
+  """
+  Turn "messageprocessor=0.1,security=0.05" into {"messageprocessor": 0.1, ...}
+  """
+  rates = {}
+  for part in filter(None, (text or "").split(",")):
+    name, _, rate = part.partition("=")
+    rates[name.strip()] = float(rate)
+  return rates
+
+def redact(value, keys, max_length, depth=0):
+  """
+  Returns a copy of value with sensitive keys masked and long strings cut
+  """
+  if depth > 6:
+    return "..."
+  if isinstance(value, str):
+    if max_length and len(value) > max_length:
+      return f"{value[:max_length]}...<{len(value) - max_length} more chars>"
+    return value
+  if isinstance(value, Mapping):
+    # boto3 style {"name": "B64_USER_DATA", "value": "..."} pairs
+    if value.get("name") in keys and "value" in value:
+      return dict(value, value=REDACTED)
+    return {
+      k: (REDACTED if k in keys else redact(v, keys, max_length, depth + 1))
+      for k, v in value.items()
+    }
+  if isinstance(value, (list, tuple)):
+    return type(value)(redact(v, keys, max_length, depth + 1) for v in value)
+  return value
+
+def to_json_safe(value, max_length):
+  """
+  Make an arbitrary value (possibly already redacted) serialisable
+  """
+  if value is None or isinstance(value, (bool, int, float)):
+    return value
+  if isinstance(value, str):
+    return value
+  if isinstance(value, Mapping):
+    return {str(k): to_json_safe(v, max_length) for k, v in value.items()}
+  if isinstance(value, (list, tuple, set)):
+    return [to_json_safe(v, max_length) for v in value]
+  if isinstance(value, (datetime.datetime, datetime.date)):
+    return value.isoformat()
+  return redact(str(value), (), max_length)
+
+class SamplingFilter(logging.Filter):
+  """
+  Keeps only a fraction of the records below WARNING from the configured loggers
+  """
+  def __init__(self, rates):
+    logging.Filter.__init__(self)
+    self.rates = rates
+
+  def filter(self, record):
+    if record.levelno >= logging.WARNING or not self.rates:
+      return True
+    rate = self.rates.get(record.name)
+    if rate is None:
+      return True
+    return random.random() < rate
+
+class RedactingFormatter(logging.Formatter):
+  """
+  Formatter which masks sensitive values and truncates large ones before the
+  message is built, so the cost of building it is only paid on the log thread
+  """
+  def __init__(self, fmt=None, redact_keys=(), max_length=1000, max_message_length=4000):
+    logging.Formatter.__init__(self, fmt)
+    self.redact_keys = set(redact_keys)
+    self.max_length = max_length
+    self.max_message_length = max_message_length
+
+  def scrub(self, record):
+    if record.args:
+      record.args = redact(record.args, self.redact_keys, self.max_length)
+    if isinstance(record.msg, (Mapping, list, tuple)):
+      record.msg = redact(record.msg, self.redact_keys, self.max_length)
+
+  def format(self, record):
+    self.scrub(record)
+    return logging.Formatter.format(self, record)
+
+  def formatMessage(self, record):
+    record.message = redact(record.message, (), self.max_message_length)
+    return logging.Formatter.formatMessage(self, record)
+
+class JsonFormatter(RedactingFormatter):
+  """
+  Emits one JSON object per record, fields passed with extra={} are included
+  """
+  def format(self, record):
+    self.scrub(record)
+    entry = {
+      "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+      "level": record.levelname,
+      "logger": record.name,
+      "message": redact(record.getMessage(), (), self.max_message_length)
+    }
+    for key, value in record.__dict__.items():
+      if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+        entry[key] = to_json_safe(redact(value, self.redact_keys, self.max_length), self.max_length)
+    if record.exc_info:
+      entry["exception"] = self.formatException(record.exc_info)
+    if record.stack_info:
+      entry["stack"] = self.formatStack(record.stack_info)
+    return json.dumps(entry, default=str)
+
+class DeferredQueueHandler(QueueHandler):
+  """
+  QueueHandler which leaves most of the formatting to the listener
+
+  The stock QueueHandler formats the whole record in prepare(), i.e. on the
+  calling greenlet. This one only builds the message, from redacted
+  arguments, and leaves the rest to the listener. When the queue is over its
+  limit records are dropped rather than letting memory grow, and a warning
+  with the number dropped is queued once there is room again.
+  """
+  def __init__(self, queue, max_size=10000, redact_keys=(), max_length=1000):
+    QueueHandler.__init__(self, queue)
+    self.max_size = max_size
+    self.redact_keys = set(redact_keys)
+    self.max_length = max_length
+    self.dropped = 0
+
+  def prepare(self, record):
+    record = copy.copy(record)
+    if record.args:
+      record.args = redact(record.args, self.redact_keys, self.max_length)
+    if isinstance(record.msg, (Mapping, list, tuple)):
+      record.msg = redact(record.msg, self.redact_keys, self.max_length)
+    record.msg = record.getMessage()
+    record.args = None
+    return record
+
+  def enqueue(self, record):
+    if self.max_size and self.queue.qsize() >= self.max_size:
+      self.dropped += 1
+      return
+    if self.dropped:
+      self.queue.put_nowait(self.dropped_record())
+    self.queue.put_nowait(record)
+
+  def dropped_record(self):
+    """
+    Gets a warning record for the records dropped so far and resets the count
+    """
+    record = logging.makeLogRecord({
+      "name": __name__,
+      "levelno": logging.WARNING,
+      "levelname": "WARNING",
+      "msg": f"Dropped {self.dropped} log records, the log queue was full",
+      "dropped": self.dropped
+    })
+    self.dropped = 0
+    return record
+
+class ThreadQueueListener(QueueListener):
+  """
+  QueueListener which runs on a real OS thread even under gevent
+  """
+  def start(self):
+    start_new_thread, allocate_lock, _ = originals()
+    self._done = allocate_lock()
+    self._done.acquire()
+    self._thread = start_new_thread(self._run, ())
+
+  def _run(self):
+    try:
+      self._monitor()
+    finally:
+      self._done.release()
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self.enqueue_sentinel()
+    self._done.acquire(True, 5)
+    self._thread = None
+
+def setup_logging():
+  """
+  Replace the root handlers with the queue backed handler and start the writer
+  """
+  global listener, queue_handler, fork_hook_registered
+  level = setting("LOG_LEVEL", default="INFO")
+  fmt = setting("LOG_FORMAT", default="json")
+  max_length = setting("LOG_MAX_FIELD_LENGTH", default=1000, cast=int)
+  max_message_length = setting("LOG_MAX_MESSAGE_LENGTH", default=4000, cast=int)
+  redact_keys = setting("LOG_REDACT_KEYS", default="B64_USER_DATA,user_data,UserData", cast=Csv())
+  rates = parse_rates(setting("LOG_SAMPLE_RATES", default=""))
+
+  if fmt == "json":
+    formatter = JsonFormatter(redact_keys=redact_keys, max_length=max_length, max_message_length=max_message_length)
+  else:
+    formatter = RedactingFormatter(TEXT_FORMAT, redact_keys=redact_keys, max_length=max_length, max_message_length=max_message_length)
+  stream_handler = logging.StreamHandler(sys.stderr)
+  stream_handler.setFormatter(formatter)
+
+  _, _, simple_queue = originals()
+  log_queue = simple_queue()
+  handler = DeferredQueueHandler(log_queue, max_size=setting("LOG_QUEUE_SIZE", default=10000, cast=int), redact_keys=redact_keys, max_length=max_length)
+  handler.addFilter(SamplingFilter(rates))
+
+  if listener:
+    listener.stop()
+  root = logging.getLogger()
+  for existing in list(root.handlers):
+    root.removeHandler(existing)
+  root.addHandler(handler)
+  root.setLevel(level)
+  queue_handler = handler
+
+  listener = ThreadQueueListener(log_queue, stream_handler)
+  listener.start()
+  if not fork_hook_registered:
+    # gunicorn forks workers after this runs in the master, threads do not
+    # survive a fork so each worker needs its own queue and writer
+    os.register_at_fork(after_in_child=restart_after_fork)
+    atexit.register(stop_logging)
+    fork_hook_registered = True
+  return queue_handler
+
+def restart_after_fork():
+  if listener is None:
+    return
+  _, _, simple_queue = originals()
+  log_queue = simple_queue()
+  queue_handler.queue = log_queue
+  listener.queue = log_queue
+  listener.start()
+
+def stop_logging():
+  """
+  Flush what is left on the queue and stop the writer thread
+  """
+  global listener
+  if listener:
+    if queue_handler.dropped:
+      listener.queue.put_nowait(queue_handler.dropped_record())
+    listener.stop()
+    listener = None
@@ -3,21 +3,40 @@ Code which processes messages on SQS topic and sends notifications to client
 """
 
 import json
-import boto3
 import logging
 import queue
+import time
+import random
+import datetime
 from collections import defaultdict
 
+import gevent
 from gevent.queue import Queue
 from gevent.event import Event
 from gevent.lock import BoundedSemaphore
 
-from instance import get_tags_for_instance
+from aws import get_client
+from errors import ServiceUnavailableException
+from settings import setting
+from instance import get_instance_details
+from ecs import get_manifest_results
+from utils import encode_sse
+from serializer import dumps
+from records import InstanceTags
+import registry
+import warmpool
+import prestart
+import readiness
+import usage
+import tasks
+import workqueue
+import localcache
 
 logger = logging.getLogger(__name__)
-sqs = boto3.client("sqs")
 lock = BoundedSemaphore(1)
 message_processor = None
+# pause after an event or poll fails for a reason other than AWS being unavailable
+EVENT_RETRY_SECONDS = 1
 
 class MessageProcessor():
 
@@ -27,69 +46,404 @@ class MessageProcessor():
     self.queues = defaultdict(list)
     self.tag_cache = {}
     self.queueurl = queueurl
+    # events for a user are held this long so superseded states can be dropped
+    self.coalesce_window = setting("EVENT_COALESCE_MS", default=0, cast=int) / 1000.0
+    self.pending = {}
+    # last status sent for each tracked ECS task, when tasks were seen to stop,
+    # and when a task event last came
+    self.task_status = {}
+    self.task_stopped = {}
+    self.task_event_at = 0
+    self.draining = False
+    self.listener_count = 0
+    # display probes of running desktops, by instance id
+    self.probes = {}
   
   def listen(self, username):
-    logger.info(f"Adding queue for {username}")
+    """
+    Adds a listener queue for one of the user's streams
+    Past SSE_MAX_LISTENERS_PER_USER the user's oldest stream is ended, it is
+    most likely a closed tab the heartbeat has not caught yet
+    Past SSE_MAX_LISTENERS for the worker the caller is told to go elsewhere
+    """
+    if self.listener_count >= setting("SSE_MAX_LISTENERS", default=1000, cast=int):
+      raise ServiceUnavailableException("Too many event streams on this server", retry_after=max(1, round(self.retry_after_ms() / 1000)))
+    queues = self.queues[username]
+    if len(queues) >= setting("SSE_MAX_LISTENERS_PER_USER", default=5, cast=int):
+      logger.info("Too many streams for %s, ending the oldest", username)
+      self.end_stream(queues[0])
+      self.unlisten(username, queues[0])
+    logger.info("Adding queue for %s", username)
     q = Queue(maxsize=5)
     self.queues[username].append(q)
+    self.listener_count += 1
     return q
 
+  def unlisten(self, username, q):
+    """
+    Removes a listener queue, safe to call more than once
+    """
+    queues = self.queues.get(username)
+    if not queues or q not in queues:
+      return
+    logger.info("Removing queue for %s", username)
+    queues.remove(q)
+    self.listener_count -= 1
+    if not queues:
+      del self.queues[username]
+
+  def drain(self):
+    """
+    Stops polling for events and ends every listener's stream at a random
+    point within DRAIN_SECONDS, so clients do not all reconnect at once
+    """
+    if self.draining:
+      return
+    self.draining = True
+    self.stoprequest.set()
+    window = setting("DRAIN_SECONDS", default=5, cast=float)
+    listeners = [q for queues in self.queues.values() for q in queues]
+    logger.info("Draining %d listeners over %ss", len(listeners), window)
+    for q in listeners:
+      gevent.spawn_later(random.uniform(0, window), self.end_stream, q)
+
+  @staticmethod
+  def end_stream(q):
+    """
+    Puts the end of stream marker (None) on a listener queue, dropping
+    undelivered events if it is full as the client will reload on reconnect
+    """
+    while True:
+      try:
+        q.put_nowait(None)
+        return
+      except queue.Full:
+        try:
+          q.get_nowait()
+        except queue.Empty:
+          pass
+
+  @staticmethod
+  def retry_after_ms():
+    """
+    Jittered reconnect delay sent to clients as their stream ends
+    """
+    return random.uniform(
+      setting("DRAIN_RETRY_MIN_MS", default=1000, cast=int),
+      setting("DRAIN_RETRY_MAX_MS", default=15000, cast=int)
+    )
+
+  def get_tags(self, instance_id):
+    """
+    Gets the tags for an instance, from the cache shared with other workers,
+    then this worker's cache, then EC2
+    The shared cache comes first as tags change when a warm pool desktop is
+    handed to a user, for the same reason pool desktops are not kept in this
+    worker's cache
+    Returns (tags, details) where details is only set if EC2 was called
+    """
+    details = None
+    cached = self.tag_cache.get(instance_id)
+    tags = localcache.get("instance_tags", instance_id) or cached
+    if warmpool.is_pool_owned(tags):
+      # another host may have handed it to a user since
+      tags = None
+    if not tags:
+      details = get_instance_details(instance_id)
+      tags = details["tags"] if details else None
+      logger.debug("Tags returned for instance %s: %s", instance_id, tags)
+      if tags:
+        localcache.put("instance_tags", instance_id, tags)
+    if tags and tags is not cached and tags.get("Username") != warmpool.pool_username():
+      if cached is None and len(self.tag_cache) >= setting("TAG_CACHE_SIZE", default=20000, cast=int):
+        # the oldest entry goes, dicts keep insertion order
+        del self.tag_cache[next(iter(self.tag_cache))]
+      self.tag_cache[instance_id] = InstanceTags(tags)
+    return tags, details
+
+  def handle_state_change(self, body):
+    """
+    Records an EC2 state change and passes it on to the user's listeners
+    """
+    instance_id = body["detail"]["instance-id"]
+    state = body["detail"]["state"]
+    event_time = parse_event_time(body)
+    logger.info("EC2 instance state change message %s %s", instance_id, state)
+    tags, details = self.get_tags(instance_id)
+    if state == "terminated":
+      self.tag_cache.pop(instance_id, None)
+      localcache.forget_instance(instance_id)
+    if not tags or "Username" not in tags or "DesktopId" not in tags:
+      logger.info("Instance %s is not a desktop, ignoring", instance_id)
+      return
+    username = tags["Username"]
+    desktop_id = tags["DesktopId"]
+    logger.info("Instance %s username %s desktop_id %s", instance_id, username, desktop_id)
+    self.publish(username, {
+      "desktop_id": desktop_id,
+      "state": state,
+      "instance_id": instance_id
+    }, event_time)
+    if state == "running":
+      self.check_ready(instance_id, username, desktop_id, details, event_time)
+    elif instance_id in self.probes:
+      self.probes.pop(instance_id).kill(block=False)
+    self.update_registry(instance_id, state, event_time, tags, details)
+    if tags.get("EnvKey") == setting("ENV_KEY"):
+      try:
+        usage.record_state_change(instance_id, state, event_time, tags)
+      except Exception as err:
+        logger.warning("Could not record usage of %s: %s", desktop_id, err)
+    if state == "pending" and username != warmpool.pool_username():
+      try:
+        prestart.record_start(username, desktop_id, event_time)
+      except Exception as err:
+        logger.warning("Could not record start of %s: %s", desktop_id, err)
+
+  def check_ready(self, instance_id, username, desktop_id, details, event_time):
+    """
+    Starts probing a running desktop's display, if its owner is listening on this worker
+    """
+    if not readiness.probe_enabled() or not self.queues.get(username) or instance_id in self.probes:
+      return
+    self.probes[instance_id] = gevent.spawn(self.probe_display, instance_id, username, desktop_id, details, event_time)
+
+  def probe_display(self, instance_id, username, desktop_id, details, event_time=None):
+    """
+    Sends a "ready" event once the desktop's display takes connections
+    It goes out with the time of the running event, so it is ordered against
+    the desktop's other events by EventBridge's clock
+    """
+    try:
+      details = details or get_instance_details(instance_id)
+      if details and details.get("dns") and readiness.wait_until_ready(details["dns"]):
+        self.publish(username, {
+          "desktop_id": desktop_id,
+          "state": "ready",
+          "instance_id": instance_id
+        }, event_time)
+    except Exception as err:
+      logger.warning("Could not probe display of %s: %s", instance_id, err)
+    finally:
+      if self.probes.get(instance_id) is gevent.getcurrent():
+        del self.probes[instance_id]
+
+  def handle_task_change(self, body):
+    """
+    Passes the progress of a provisioning task on to the owners of its desktops
+    """
+    detail = body["detail"]
+    self.task_event_at = time.time()
+    tracked = tasks.get_task(detail["taskArn"])
+    if not tracked:
+      logger.debug("Task %s is not tracked, ignoring", detail["taskArn"])
+      return
+    self.report_task(tracked, detail, parse_event_time(body))
+
+  def handle_job_change(self, body):
+    """
+    Same as handle_task_change for jobs run by the provisioning workers
+    """
+    detail = body["detail"]
+    self.task_event_at = time.time()
+    job_id = f"{workqueue.JOB_PREFIX}{detail['jobId']}"
+    tracked = tasks.get_task(job_id)
+    if tracked:
+      self.report_task(tracked, dict(workqueue.job_status(detail), taskArn=job_id), parse_event_time(body))
+
+  def report_task(self, tracked, described, event_time=None):
+    """
+    Sends the status of a task to each desktop it was started for, once per change
+    """
+    status = described.get("lastStatus")
+    if self.task_status.get(described["taskArn"]) == status or described["taskArn"] in self.task_stopped:
+      return
+    logger.info("Task %s for %d desktops is %s", described["taskArn"], len(tracked), status)
+    # jobs report results themselves, batched tasks in their manifest
+    results = described.get("results")
+    if status == "STOPPED":
+      self.task_status.pop(described["taskArn"], None)
+      # finished items stay tracked for a while, their stop is only sent once
+      now = time.time()
+      for task_arn, stopped in list(self.task_stopped.items()):
+        if now - stopped > tasks.finished_seconds():
+          del self.task_stopped[task_arn]
+      self.task_stopped[described["taskArn"]] = now
+      manifest_id = tasks.manifest_id(described)
+      if manifest_id and results is None and not all(task.get("finished") for task in tracked):
+        results = get_manifest_results(manifest_id)
+    else:
+      self.task_status[described["taskArn"]] = status
+    for task in tracked:
+      self.publish(task["username"], tasks.progress(task, described, results), event_time)
+
+  def poll_tasks(self):
+    """
+    Polls the tracked tasks while no ECS task events are arriving
+    Run in every worker as each one only reaches its own listeners
+    """
+    interval = setting("TASK_POLL_SECONDS", default=10, cast=int)
+    while not self.stoprequest.isSet():
+      gevent.sleep(interval)
+      # tasks can run quietly for a while, so only poll after a few quiet intervals
+      if time.time() - self.task_event_at < interval * 3:
+        continue
+      try:
+        tracked = tasks.list_tasks()
+        if not tracked:
+          continue
+        by_arn = defaultdict(list)
+        for task in tracked:
+          by_arn[task["task_arn"]].append(task)
+        for task_arn, described in tasks.describe(tracked).items():
+          if task_arn in by_arn:
+            self.report_task(by_arn[task_arn], dict(described, taskArn=task_arn))
+      except Exception as err:
+        logger.warning("Could not poll provisioning tasks: %s", err)
+
+  def update_registry(self, instance_id, state, event_time, tags, details):
+    """
+    Keeps the desktop registry in step with EC2
+    """
+    if not registry.registry_enabled() or tags.get("EnvKey") != setting("ENV_KEY"):
+      return
+    try:
+      registry.update_desktop(
+        username=tags["Username"],
+        desktop_id=tags["DesktopId"],
+        state=state,
+        state_time=event_time,
+        instanceid=instance_id,
+        dns=details["dns"] if details else None,
+        launchtime=datetime.datetime.fromtimestamp(event_time, datetime.timezone.utc).isoformat() if state == "pending" else None,
+        screengeometry=tags.get("ScreenGeometry"),
+        machine_def_id=tags.get("MachineDef"),
+        hibernation=details["hibernation"] if details else None
+      )
+    except Exception as err:
+      logger.warning("Could not update registry for %s: %s", instance_id, err)
+
+  def publish(self, username, payload, event_time=None):
+    """
+    Sends an event to every listener the user has on this worker
+    With EVENT_COALESCE_MS set the events for a user are collected for that
+    long, only the latest state of each desktop is kept, and they are all
+    sent in one write when the window closes
+    event_time is the EventBridge time behind the payload. Only those times
+    are compared, so an event delivered out of order is dropped, payloads
+    without one (e.g. from polling) replace what came before them
+    """
+    if not self.queues.get(username):
+      return
+    if not self.coalesce_window:
+      self.deliver(username, [payload])
+      return
+    pending = self.pending.get(username)
+    if pending is None:
+      pending = self.pending[username] = {}
+      gevent.spawn_later(self.coalesce_window, self.flush, username)
+    current = pending.get(payload["desktop_id"])
+    if current is None or event_time is None or current[0] is None or event_time >= current[0]:
+      # re-inserted so the desktops are sent in the order they last changed
+      pending.pop(payload["desktop_id"], None)
+      pending[payload["desktop_id"]] = (event_time, payload)
+
+  def flush(self, username):
+    pending = self.pending.pop(username, {})
+    self.deliver(username, [payload for _, payload in pending.values()])
+
+  def deliver(self, username, payloads):
+    """
+    Puts the events on each of the user's listener queues as one SSE chunk
+    The chunk is encoded once and the same bytes shared by every listener
+    Listeners which have fallen too far behind are ended, the client reloads
+    its state when it reconnects
+    """
+    queues = self.queues.get(username)
+    if not queues or not payloads:
+      return
+    logger.debug("Sending %d events to %d listeners for %s", len(payloads), len(queues), username)
+    chunk = b"".join(encode_sse(dumps(payload), "message") for payload in payloads)
+    for q in list(queues):
+      try:
+        q.put_nowait(chunk)
+      except queue.Full:
+        self.end_stream(q)
+        self.unlisten(username, q)
+
+  def handle_message(self, message):
+    body = json.loads(json.loads(message["Body"])["Message"])
+    logger.debug("Message body %s", body)
+    detail_type = body["detail-type"]
+    if detail_type == "EC2 Instance State-change Notification":
+      self.handle_state_change(body)
+    elif detail_type == "ECS Task State Change":
+      self.handle_task_change(body)
+    elif detail_type == "Desktop Provisioning Job State Change":
+      self.handle_job_change(body)
+
   def run(self):
+    """
+    Polls the event queue until stopped
+    A message which cannot be handled is left in the queue, SQS delivers it
+    again once its visibility timeout ends
+    """
+    sqs = get_client("sqs")
     while not self.stoprequest.isSet():
       logger.info("Starting long poll of sqs queue...")
-      response = sqs.receive_message(
-        QueueUrl=self.queueurl,
-        MaxNumberOfMessages=1,
-        WaitTimeSeconds=20
-      )
+      try:
+        response = sqs.receive_message(
+          QueueUrl=self.queueurl,
+          MaxNumberOfMessages=1,
+          WaitTimeSeconds=20
+        )
+      except ServiceUnavailableException as err:
+        logger.warning("Cannot poll sqs queue, retrying in %ss: %s", err.retry_after, err)
+        gevent.sleep(err.retry_after)
+        continue
+      except Exception as err:
+        logger.warning("Cannot poll sqs queue, retrying in %ss: %s", EVENT_RETRY_SECONDS, err)
+        gevent.sleep(EVENT_RETRY_SECONDS)
+        continue
       logger.info("Back from long poll")
-      if "Messages" in response:
-        for message in response["Messages"]:
-          body = message["Body"]
-          recphwnd = message["ReceiptHandle"]
-          body = json.loads(body)
-          body = json.loads(body["Message"])
-          logger.info(body)
-          detail_type = body["detail-type"]
-          if detail_type == "EC2 Instance State-change Notification":
-            instance_id = body["detail"]["instance-id"]
-            state = body["detail"]["state"]
-            logger.info(f"EC2 instance state change message {instance_id} {state}")
-            # check cache of tag data
-            if instance_id not in self.tag_cache:
-              new_tags = get_tags_for_instance(instance_id)
-              logger.info(f"Got tags for instance {instance_id}")
-              logger.info(f"Tags returned {new_tags}")
-              if new_tags:
-                logger.info(f"Storing tags in cache for instance {instance_id}")
-                self.tag_cache[instance_id] = new_tags
-            username = self.tag_cache[instance_id]["Username"]
-            desktop_id = self.tag_cache[instance_id]["DesktopId"]
-            logger.info(f"Instance {instance_id} username {username} desktop_id {desktop_id}")
-            if username in self.queues:
-              logger.info(f"User {username} as event listener registered...")
-              for i in reversed(range(len(self.queues[username]))):
-                try:
-                  self.queues[username][i].put_nowait(json.dumps({
-                    "desktop_id": desktop_id,
-                    "state": state,
-                    "instance_id": instance_id
-                  }))
-                except queue.Full:
-                  del self.queues[username][i]
+      if "Messages" not in response:
+        logger.info("Got no messages during long poll")
+        continue
+      for message in response["Messages"]:
+        try:
+          self.handle_message(message)
+        except ServiceUnavailableException as err:
+          logger.warning("Cannot handle event %s yet, retrying in %ss: %s", message.get("MessageId"), err.retry_after, err)
+          gevent.sleep(err.retry_after)
+          continue
+        except Exception:
+          logger.exception("Could not handle event %s, leaving it to be delivered again", message.get("MessageId"))
+          gevent.sleep(EVENT_RETRY_SECONDS)
+          continue
+        try:
           sqs.delete_message(
             QueueUrl=self.queueurl,
-            ReceiptHandle=recphwnd
+            ReceiptHandle=message["ReceiptHandle"]
           )
-      else:
-        logger.info("Got no messages during long poll")
+        except Exception as err:
+          # it will be handled again, which every handler copes with
+          logger.warning("Could not delete event %s: %s", message.get("MessageId"), err)
     logger.info("Exiting from run because stoprequest is set")
   
+def parse_event_time(body):
+  """
+  Gets the time of an EventBridge event as epoch seconds, now if missing
+  """
+  try:
+    return datetime.datetime.strptime(body["time"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc).timestamp()
+  except (KeyError, ValueError):
+    return time.time()
+
 def get_processor(queueurl=None):
   global message_processor
   with lock:
     if message_processor:
-      logger.info("Returning existing backend instance")
+      logger.debug("Returning existing backend instance")
       return message_processor
     else:
       if queueurl:
@@ -0,0 +1,234 @@
+"""
+prestart.py
+
+Starts stopped desktops shortly before their owners usually do.
+
+MessageProcessor passes every EC2 "pending" event here. The first start of a
+desktop on a weekday is recorded as a minute of the day, the last HISTORY of
+them are kept in the config table:
+
+| partition key | sort key                |
+| prestart      | <username>/<desktop_id> | {username, desktop_id, starts, start_day, prestart_day, prestarted_at, idle_day}
+| prestart      | <username>              | {opted_out, seen}
+
+Once a desktop has PRESTART_MIN_STARTS starts and most of them fall within
+PRESTART_WINDOW_MINUTES of each other, its usual start is the earliest of
+those. The scheduler, run by the local cache writer, starts the desktop
+PRESTART_LEAD_MINUTES before that if it is stopped. At most
+PRESTART_MAX_CONCURRENT pre-started desktops boot at once, and a conditional
+write on prestart_day means only one host pre-starts a desktop each day.
+The pending event of a start we made is not a start by the user, it is told
+apart by prestarted_at, any other start that day is recorded as usual.
+
+Opening an event stream marks the user as seen. A pre-started desktop whose
+owner has not been seen PRESTART_IDLE_MINUTES after it was started, and has
+not started it since, is stopped again. 0 turns this off.
+
+Days and weekdays are UTC shifted by PRESTART_UTC_OFFSET_MINUTES. Users can
+opt out with PUT /prestart.
+"""
+import time
+import logging
+import gevent
+from gevent.pool import Pool
+
+from settings import setting
+from data import get_ddb_item, get_ddb_items_with_keys, update_ddb_item
+from instance import get_instances_by_username_and_id, start_instance, stop_instance
+import localcache
+
+logger = logging.getLogger(__name__)
+
+DOMAIN = "prestart"
+HISTORY = 10
+# share of the recorded starts which have to agree before we act on them
+CONSISTENCY = 0.7
+# a pending event this close to when we started a desktop is our own start
+OWN_START_SECONDS = 120
+
+def prestart_enabled():
+  return setting("PRESTART_ENABLED", default=False, cast=bool)
+
+def local_time(timestamp):
+  """
+  Splits a timestamp into (day number, weekday, minute of the day)
+  """
+  local = timestamp + setting("PRESTART_UTC_OFFSET_MINUTES", default=0, cast=int) * 60
+  day = int(local // 86400)
+  # 1 January 1970 was a Thursday
+  return day, (day + 3) % 7, int(local % 86400 // 60)
+
+def desktop_key(username, desktop_id):
+  return {"domain": DOMAIN, "sub_id": f"{username}/{desktop_id}"}
+
+def record_start(username, desktop_id, event_time):
+  """
+  Records the first start of a desktop each weekday
+  Starts we caused are skipped, as are later ones the same day
+  """
+  if not prestart_enabled():
+    return
+  day, weekday, minute = local_time(event_time)
+  if weekday >= 5:
+    return
+  table = setting("TABLE_NAME")
+  key = desktop_key(username, desktop_id)
+  record = get_ddb_item(table, **key) or {}
+  if record.get("start_day", 0) >= day or abs(event_time - record.get("prestarted_at", 0)) < OWN_START_SECONDS:
+    return
+  starts = record.get("starts", [])[-(HISTORY - 1):] + [minute]
+  # every host sees the event, only the first one records it
+  update_ddb_item(
+    table,
+    key,
+    only_if_newer="start_day",
+    allow_equal=False,
+    start_day=day,
+    starts=starts,
+    username=username,
+    desktop_id=desktop_id
+  )
+
+def usual_start(starts):
+  """
+  Minute of the day the desktop is usually started by, None if there is no
+  clear pattern yet
+  """
+  if len(starts) < setting("PRESTART_MIN_STARTS", default=5, cast=int):
+    return None
+  ordered = sorted(starts)
+  median = ordered[len(ordered) // 2]
+  window = setting("PRESTART_WINDOW_MINUTES", default=15, cast=int)
+  cluster = [start for start in ordered if abs(start - median) <= window]
+  if len(cluster) < len(ordered) * CONSISTENCY:
+    return None
+  return cluster[0]
+
+def set_opted_out(username, opted_out):
+  update_ddb_item(setting("TABLE_NAME"), {"domain": DOMAIN, "sub_id": username}, opted_out=opted_out)
+
+def mark_seen(username):
+  """
+  Records that the user is about, so their pre-started desktops are kept running
+  """
+  if not prestart_enabled() or not setting("PRESTART_IDLE_MINUTES", default=90, cast=int):
+    return
+  try:
+    update_ddb_item(setting("TABLE_NAME"), {"domain": DOMAIN, "sub_id": username}, seen=int(time.time()))
+  except Exception as err:
+    logger.warning("Could not mark %s as seen: %s", username, err)
+
+def get_status(username):
+  """
+  Whether pre-start is on for a user and the usual start of each of their desktops
+  """
+  table = setting("TABLE_NAME")
+  opted_out = (get_ddb_item(table, domain=DOMAIN, sub_id=username) or {}).get("opted_out", False)
+  desktops = {}
+  for record in get_ddb_items_with_keys(table, domain=DOMAIN, sub_id__begins_with=f"{username}/"):
+    usual = usual_start(record.get("starts", []))
+    desktops[record["desktop_id"]] = {
+      "usual_start": "{:02d}:{:02d}".format(*divmod(usual, 60)) if usual is not None else None
+    }
+  return {"enabled": prestart_enabled() and not opted_out, "desktops": desktops}
+
+def due_desktops(records, now):
+  """
+  Picks the desktop records which should be pre-started at this time
+  """
+  day, weekday, minute = local_time(now)
+  if weekday >= 5:
+    return []
+  opted_out = {record["sub_id"] for record in records if "/" not in record["sub_id"] and record.get("opted_out")}
+  lead = setting("PRESTART_LEAD_MINUTES", default=10, cast=int)
+  due = []
+  for record in records:
+    if "/" not in record["sub_id"] or record.get("username") in opted_out:
+      continue
+    if record.get("start_day") == day or record.get("prestart_day") == day:
+      continue
+    usual = usual_start(record.get("starts", []))
+    if usual is not None and usual - lead <= minute < usual:
+      due.append(record)
+  return due
+
+def prestart(record):
+  """
+  Starts a stopped desktop and waits for it to boot, so the pool size caps
+  how many pre-started desktops are booting at once
+  """
+  username = record["username"]
+  desktop_id = record["desktop_id"]
+  instance = get_instances_by_username_and_id.fresh(username, desktop_id).get(desktop_id)
+  if not instance or instance["state"] != "stopped":
+    return
+  logger.info("Pre-starting desktop %s for %s", desktop_id, username)
+  update_ddb_item(setting("TABLE_NAME"), desktop_key(username, desktop_id), prestarted_at=int(time.time()))
+  start_instance(instance["instanceid"])
+  deadline = time.time() + setting("PRESTART_BOOT_SECONDS", default=600, cast=int)
+  while time.time() < deadline:
+    gevent.sleep(10)
+    instance = get_instances_by_username_and_id.fresh(username, desktop_id).get(desktop_id)
+    if not instance or instance["state"] != "pending":
+      return
+
+def idle_desktops(records, now):
+  """
+  Picks the desktop records pre-started today which their owners have not
+  started themselves and have not been seen for PRESTART_IDLE_MINUTES since
+  """
+  idle_seconds = setting("PRESTART_IDLE_MINUTES", default=90, cast=int) * 60
+  if not idle_seconds:
+    return []
+  day = local_time(now)[0]
+  seen = {record["sub_id"]: record.get("seen", 0) for record in records if "/" not in record["sub_id"]}
+  idle = []
+  for record in records:
+    if "/" not in record["sub_id"] or record.get("prestart_day") != day:
+      continue
+    if record.get("start_day") == day or record.get("idle_day") == day:
+      continue
+    started = record.get("prestarted_at", 0)
+    if local_time(started)[0] == day and now - started > idle_seconds and seen.get(record["username"], 0) < started:
+      idle.append(record)
+  return idle
+
+def stop_idle(record):
+  """
+  Stops a pre-started desktop nobody has used
+  """
+  username = record["username"]
+  desktop_id = record["desktop_id"]
+  instance = get_instances_by_username_and_id.fresh(username, desktop_id).get(desktop_id)
+  if not instance or instance["state"] != "running":
+    return
+  logger.info("Stopping pre-started desktop %s of %s, it has not been used", desktop_id, username)
+  stop_instance(instance["instanceid"])
+
+def run_due(pool, now=None):
+  now = now or time.time()
+  table = setting("TABLE_NAME")
+  day = local_time(now)[0]
+  records = get_ddb_items_with_keys(table, domain=DOMAIN)
+  for record in due_desktops(records, now):
+    pool.wait_available()
+    # only one host pre-starts a desktop each day
+    if update_ddb_item(table, desktop_key(record["username"], record["desktop_id"]), only_if_newer="prestart_day", allow_equal=False, prestart_day=day):
+      pool.spawn(prestart, record)
+  for record in idle_desktops(records, now):
+    # only one host stops it, and not if its owner has started it since the records were read
+    if update_ddb_item(table, desktop_key(record["username"], record["desktop_id"]), only_if_newer="idle_day", allow_equal=False, expected={"start_day": record["start_day"]}, idle_day=day):
+      pool.spawn(stop_idle, record)
+
+def run_scheduler():
+  """
+  Loop run in every worker, only the local cache writer does anything
+  """
+  pool = Pool(setting("PRESTART_MAX_CONCURRENT", default=5, cast=int))
+  while True:
+    if prestart_enabled() and localcache.is_writer():
+      try:
+        run_due(pool)
+      except Exception as err:
+        logger.warning("Could not run the pre-start scheduler: %s", err)
+    gevent.sleep(setting("PRESTART_CHECK_SECONDS", default=60, cast=int))
@@ -0,0 +1,70 @@
+"""
+readiness.py
+
+Works out when a desktop's remote display will take connections.
+
+EC2 reports an instance running well before the display service on it is
+up. Once MessageProcessor sees the running event for a desktop with
+listeners, it probes DISPLAY_PORT on the instance's private DNS name with a
+plain TCP connect until it succeeds, then sends the listeners a "ready"
+event. Attempts start READINESS_FIRST_DELAY_SECONDS after the event and back
+off, with jitter, up to READINESS_MAX_DELAY_SECONDS apart. At most
+READINESS_MAX_CONCURRENT connects are in flight per worker, and a desktop
+is given up on after READINESS_TIMEOUT_SECONDS. With DISPLAY_PORT unset no
+probes are made.
+"""
+import time
+import random
+import socket
+import logging
+
+import gevent
+from gevent.lock import BoundedSemaphore
+
+from settings import setting
+
+logger = logging.getLogger(__name__)
+
+slots = None
+
+def probe_enabled():
+  return setting("DISPLAY_PORT", default=0, cast=int) > 0
+
+def get_slots():
+  global slots
+  if slots is None:
+    slots = BoundedSemaphore(setting("READINESS_MAX_CONCURRENT", default=20, cast=int))
+  return slots
+
+def can_connect(host, port, timeout):
+  """
+  True if a TCP connection to host:port opens within timeout seconds
+  """
+  with get_slots():
+    try:
+      connection = socket.create_connection((host, port), timeout=timeout)
+    except OSError:
+      return False
+    connection.close()
+    return True
+
+def wait_until_ready(host):
+  """
+  Probes the display port on host until it accepts a connection
+  Returns False if it has not by READINESS_TIMEOUT_SECONDS
+  """
+  port = setting("DISPLAY_PORT", cast=int)
+  delay = setting("READINESS_FIRST_DELAY_SECONDS", default=2, cast=float)
+  max_delay = setting("READINESS_MAX_DELAY_SECONDS", default=15, cast=float)
+  deadline = time.time() + setting("READINESS_TIMEOUT_SECONDS", default=600, cast=float)
+  attempts = 0
+  while time.time() < deadline:
+    # spread out the probes of desktops which started together
+    gevent.sleep(random.uniform(delay / 2, delay))
+    attempts += 1
+    if can_connect(host, port, timeout=min(delay, 5)):
+      logger.info("Display on %s is ready after %d attempts", host, attempts)
+      return True
+    delay = min(delay * 2, max_delay)
+  logger.warning("Display on %s not ready after %d attempts, giving up", host, attempts)
+  return False
@@ -0,0 +1,97 @@
+"""
+records.py
+
+Compact records for desktop state held in memory: in listings, the shared
+read cache and MessageProcessor's tag cache. Each uses __slots__ so there is
+no per-record dict, and strings which repeat across desktops (usernames,
+states, machine definitions, screen geometries) are interned so every record
+shares one copy.
+
+Records support record["field"] and record.get("field") as well as
+attribute access, so they can stand in for the dicts they replace, and the
+serializer writes them out through as_dict().
+"""
+import sys
+
+def intern_value(value):
+  return sys.intern(value) if isinstance(value, str) else value
+
+class Desktop():
+  """
+  A desktop's instance, the fields the instance routes return plus its owner
+  """
+  __slots__ = ("username", "desktop_id", "instanceid", "dns", "launchtime", "state", "screengeometry", "machine_def_id", "hibernation")
+  # what the API returns, the desktop id is the key it is returned under
+  FIELDS = ("instanceid", "dns", "launchtime", "state", "screengeometry", "machine_def_id", "hibernation")
+
+  def __init__(self, username, desktop_id, instanceid, dns, launchtime, state, screengeometry, machine_def_id, hibernation):
+    self.username = intern_value(username)
+    self.desktop_id = desktop_id
+    self.instanceid = instanceid
+    self.dns = dns
+    self.launchtime = launchtime
+    self.state = intern_value(state)
+    self.screengeometry = intern_value(screengeometry)
+    self.machine_def_id = intern_value(machine_def_id)
+    self.hibernation = hibernation
+
+  @classmethod
+  def from_ec2(cls, instance):
+    """
+    Builds a record from an EC2 instance description, reading only the tags we use
+    """
+    tags = {}
+    for tag in instance.get("Tags", []):
+      if tag["Key"] in DESKTOP_TAGS:
+        tags[tag["Key"]] = tag["Value"]
+    return cls(
+      username=tags.get("Username"),
+      desktop_id=tags.get("DesktopId"),
+      instanceid=instance["InstanceId"],
+      dns=instance["PrivateDnsName"],
+      launchtime=instance["LaunchTime"],
+      state=instance["State"]["Name"],
+      screengeometry=tags.get("ScreenGeometry"),
+      machine_def_id=tags.get("MachineDef"),
+      hibernation=instance.get("HibernationOptions", {}).get("Configured", False)
+    )
+
+  def as_dict(self):
+    return {field: getattr(self, field) for field in self.FIELDS}
+
+  def __getitem__(self, key):
+    if key not in self.__slots__:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def get(self, key, default=None):
+    return getattr(self, key) if key in self.__slots__ else default
+
+  def __repr__(self):
+    return f"Desktop({self.username!r}, {self.desktop_id!r}, {self.instanceid!r}, {self.state!r})"
+
+DESKTOP_TAGS = {"Username", "DesktopId", "ScreenGeometry", "MachineDef"}
+
+class InstanceTags():
+  """
+  The tags MessageProcessor needs to route an instance's events, looked up
+  by tag name like the tag dicts they replace
+  """
+  __slots__ = ("Username", "DesktopId", "EnvKey", "ScreenGeometry", "MachineDef")
+
+  def __init__(self, tags):
+    for name in self.__slots__:
+      setattr(self, name, intern_value(tags.get(name)))
+
+  def get(self, name, default=None):
+    value = getattr(self, name, None) if name in self.__slots__ else None
+    return default if value is None else value
+
+  def __getitem__(self, name):
+    value = self.get(name)
+    if value is None:
+      raise KeyError(name)
+    return value
+
+  def __contains__(self, name):
+    return self.get(name) is not None
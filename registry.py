@@ -0,0 +1,189 @@
+"""
+registry.py
+
+Registry of desktops kept in the config table, one partition per user, so
+that ownership checks and listings are a single DynamoDB call instead of a
+tag filtered EC2 scan.
+
+| partition key      | sort key   |
+| desktop#<username> | desktop_id | {instanceid, state, state_time, dns, launchtime, screengeometry, machine_def_id, hibernation}
+
+Records are written when a desktop is requested, kept up to date from the EC2
+state change events MessageProcessor receives and removed when the instance
+is terminated. EC2 is only scanned to reconcile the registry, which the local
+cache writer does every REGISTRY_RECONCILE_SECONDS.
+"""
+import time
+import logging
+import datetime
+from gevent.lock import BoundedSemaphore
+
+from settings import setting
+from data import get_ddb_item, get_ddb_items, get_ddb_items_with_keys, update_ddb_item, del_ddb_item, ddb_create
+from singleflight import shared, forget
+from records import Desktop
+import localcache
+
+logger = logging.getLogger(__name__)
+
+DOMAIN_PREFIX = "desktop#"
+MARKER_DOMAIN = "registry"
+MARKER_ID = "reconciled"
+
+ready = False
+ready_checked_at = 0
+lock = BoundedSemaphore(1)
+
+def domain_for(username):
+  return f"{DOMAIN_PREFIX}{username}"
+
+def registry_enabled():
+  return setting("DESKTOP_REGISTRY", default=True, cast=bool)
+
+def registry_ready():
+  """
+  True once the registry has been reconciled with EC2 at least once, until
+  then lookups have to keep using EC2 because the registry may be incomplete
+  """
+  global ready, ready_checked_at
+  if not registry_enabled():
+    return False
+  if not ready and time.time() - ready_checked_at > 30:
+    with lock:
+      if not ready and time.time() - ready_checked_at > 30:
+        ready = get_ddb_item(setting("TABLE_NAME"), domain=MARKER_DOMAIN, sub_id=MARKER_ID) is not None
+        ready_checked_at = time.time()
+  return ready
+
+def to_instance(record):
+  """
+  Turns a registry record into the record returned by the instance routes
+  """
+  launchtime = record.get("launchtime")
+  if launchtime:
+    launchtime = datetime.datetime.fromisoformat(launchtime)
+  return Desktop(
+    username=record["domain"][len(DOMAIN_PREFIX):],
+    desktop_id=record["sub_id"],
+    instanceid=record.get("instanceid"),
+    dns=record.get("dns"),
+    launchtime=launchtime,
+    state=record.get("state"),
+    screengeometry=record.get("screengeometry"),
+    machine_def_id=record.get("machine_def_id"),
+    hibernation=record.get("hibernation")
+  )
+
+def register_desktop(username, desktop_id, machine_def_id, screen_geometry, state="provisioning"):
+  """
+  Records a desktop which has been requested but may not exist in EC2 yet
+  """
+  logger.info("Registering desktop %s for %s", desktop_id, username)
+  update_ddb_item(
+    setting("TABLE_NAME"),
+    {"domain": domain_for(username), "sub_id": desktop_id},
+    state=state,
+    state_time=int(time.time()),
+    machine_def_id=machine_def_id,
+    screengeometry=screen_geometry
+  )
+  forget(username)
+
+def update_desktop(username, desktop_id, state, state_time, **fields):
+  """
+  Applies a state change, ignored if the record already has a newer one
+  A terminated desktop is removed
+  """
+  if state == "terminated":
+    remove_desktop(username, desktop_id)
+    return True
+  fields = {k: v for k, v in fields.items() if v is not None}
+  updated = update_ddb_item(
+    setting("TABLE_NAME"),
+    {"domain": domain_for(username), "sub_id": desktop_id},
+    only_if_newer="state_time",
+    state=state,
+    state_time=int(state_time),
+    **fields
+  )
+  forget(username)
+  return updated
+
+def remove_desktop(username, desktop_id):
+  logger.info("Removing desktop %s for %s from the registry", desktop_id, username)
+  del_ddb_item(setting("TABLE_NAME"), domain=domain_for(username), sub_id=desktop_id)
+  forget(username)
+
+@shared("registry.get_desktop", scope="username")
+def get_desktop(username, desktop_id):
+  """
+  Gets the registry record for one of the user's desktops, None if not theirs
+  """
+  return get_ddb_item(setting("TABLE_NAME"), domain=domain_for(username), sub_id=desktop_id)
+
+@shared("registry.list_desktops", scope="username")
+def list_desktops(username):
+  """
+  Gets all of the registry records for a user
+  """
+  return get_ddb_items_with_keys(setting("TABLE_NAME"), domain=domain_for(username))
+
+def reconcile():
+  """
+  Makes the registry match what is running in EC2
+  Skipped if any host has reconciled within REGISTRY_RECONCILE_SECONDS
+  """
+  # imported here as instance.py uses this module for its lookups
+  from instance import scan_for_instances_with_tags
+  if not registry_enabled():
+    return
+  table = setting("TABLE_NAME")
+  interval = setting("REGISTRY_RECONCILE_SECONDS", default=900, cast=int)
+  marker = get_ddb_item(table, domain=MARKER_DOMAIN, sub_id=MARKER_ID)
+  if marker and time.time() - marker["reconciled_at"] < interval:
+    logger.info("Registry was reconciled recently, skipping")
+    return
+  logger.info("Reconciling desktop registry with EC2")
+  started = int(time.time())
+  instances = scan_for_instances_with_tags([
+    {
+      "name": "MachineType",
+      "value": "Desktop"
+    },
+    {
+      "name": "EnvKey",
+      "value": setting("ENV_KEY")
+    }
+  ])
+  seen = set()
+  for instance in instances:
+    if not instance.username or not instance.desktop_id:
+      continue
+    seen.add((instance.username, instance.desktop_id))
+    update_desktop(
+      username=instance.username,
+      desktop_id=instance.desktop_id,
+      state=instance.state,
+      state_time=started,
+      instanceid=instance.instanceid,
+      dns=instance.dns,
+      launchtime=instance.launchtime.isoformat(),
+      screengeometry=instance.screengeometry,
+      machine_def_id=instance.machine_def_id,
+      hibernation=instance.hibernation
+    )
+  # anything else is gone, unless it is still being provisioned
+  provisioning_timeout = setting("REGISTRY_PROVISIONING_TIMEOUT_SECONDS", default=3600, cast=int)
+  for record in get_ddb_items(table, domain__begins_with=DOMAIN_PREFIX):
+    username = record["domain"][len(DOMAIN_PREFIX):]
+    if (username, record["sub_id"]) in seen:
+      continue
+    if record.get("state_time", 0) > started:
+      continue
+    if "instanceid" not in record and started - record.get("state_time", 0) < provisioning_timeout:
+      continue
+    remove_desktop(username, record["sub_id"])
+  ddb_create(table, domain=MARKER_DOMAIN, sub_id=MARKER_ID, reconciled_at=started)
+  logger.info("Registry reconciled, %d desktops in EC2", len(seen))
+
+localcache.register_refresh("desktop_registry", reconcile)
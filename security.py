@@ -8,7 +8,7 @@ from functools import wraps
 from flask import request, g
 
 from errors import BadRequestException, AccessDeniedException
-from groups import group_role_map
+from groups import get_group_role_map
 
 logger = logging.getLogger(__name__)
 
@@ -21,14 +21,16 @@ def admin_only(f):
     """
     Function to check headers are present and check their validity
     """
-    if "roles" in kwargs:
-      if "admin" in kwargs["roles"]:
+    # secured passes (username, roles) positionally
+    roles = kwargs["roles"] if "roles" in kwargs else args[1] if len(args) > 1 else None
+    if roles is not None:
+      if "admin" in roles:
         return f(*args, **kwargs)
       else:
         logger.info("User does not have admin role")
         raise AccessDeniedException("Required role is not present")
     else:
-      logger.info("Roles kwarg is missing")
+      logger.info("Roles are missing")
       raise BadRequestException("Could not find role information")
   
   return decorated_function
@@ -43,20 +45,22 @@ def secured(f):
     """
     Function to check headers are present and check their validity
     """
-    logger.info("Secured decorator has started")
-    logger.debug("Details passed to the secured decorator", extra={"headers": request.headers})
+    logger.debug("Secured decorator has started")
+    if logger.isEnabledFor(logging.DEBUG):
+      logger.debug("Details passed to the secured decorator", extra={"headers": dict(request.headers)})
     if "x-remote-user" in request.headers:
       username = request.headers["x-remote-user"]
       if "x-remote-user-groups" in request.headers:
         groups = request.headers["x-remote-user-groups"]
-        logger.info(f"Groups from header: {groups}")
+        logger.debug("Groups from header: %s", groups)
         groups = groups.split(",")
         # map groups to roles
         roles = []
+        group_role_map = get_group_role_map()
         for group in groups:
           if group in group_role_map:
             roles.extend(group_role_map[group])
-        logger.info("Raw roles list: {groups}".format(groups=roles))
+        logger.debug("Raw roles list: %s", roles)
         roles = list(set(roles))
         return f(username, roles, *args, **kwargs)
       else:
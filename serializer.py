@@ -0,0 +1,94 @@
+"""
+serializer.py
+
+JSON encoding for responses and SSE frames.
+
+Uses orjson when it is installed, otherwise the standard library. Either way
+the output matches what flask.jsonify produces: keys sorted, no whitespace,
+datetimes as HTTP dates. SERIALIZER picks the backend ("auto", "orjson" or
+"json"); others can be added with register().
+"""
+import json
+import uuid
+import logging
+import datetime
+
+from settings import setting
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+backends = {}
+current = None
+
+def http_date(value):
+  """
+  Same format as werkzeug.http.http_date, e.g. "Tue, 15 Nov 1994 08:12:31 GMT"
+  """
+  if isinstance(value, datetime.datetime):
+    if value.tzinfo is not None:
+      value = value.astimezone(datetime.timezone.utc)
+  else:
+    value = datetime.datetime(value.year, value.month, value.day)
+  return "{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT".format(
+    WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1], value.year,
+    value.hour, value.minute, value.second
+  )
+
+def default(value):
+  """
+  Encodes the types flask's encoder handles which JSON does not
+  """
+  if isinstance(value, (datetime.datetime, datetime.date)):
+    return http_date(value)
+  if isinstance(value, uuid.UUID):
+    return str(value)
+  if hasattr(value, "as_dict"):
+    # compact records, see records.py
+    return value.as_dict()
+  if hasattr(value, "__html__"):
+    return str(value.__html__())
+  raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def json_dumps(value):
+  return json.dumps(value, default=default, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+def orjson_dumps(value):
+  # datetimes are passed to default() so they keep the HTTP date format
+  return orjson.dumps(value, default=default, option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+def register(name, dumps):
+  """
+  Adds a backend, dumps(value) must return UTF-8 encoded bytes
+  """
+  backends[name] = dumps
+
+def get_dumps():
+  global current
+  if current is None:
+    name = setting("SERIALIZER", default="auto")
+    if name == "auto":
+      name = "orjson" if "orjson" in backends else "json"
+    if name not in backends:
+      logger.warning("Serializer %s is not available, using json", name)
+      name = "json"
+    logger.info("Using the %s serializer", name)
+    current = backends[name]
+  return current
+
+def dumps(value):
+  """
+  Encodes a value as JSON bytes
+  """
+  return get_dumps()(value)
+
+register("json", json_dumps)
+if orjson is not None:
+  register("orjson", orjson_dumps)
@@ -0,0 +1,38 @@
+"""
+settings.py
+
+Lazily read application settings, each one is read from the environment (or
+.env) the first time it is used and then kept for the life of the process
+"""
+import logging
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+REQUIRED = [
+  "TABLE_NAME",
+  "ENV_KEY",
+  "CLUSTER_NAME",
+  "SECURITY_GROUP",
+  "TASK_ARN",
+  "SUBNETS"
+]
+
+values = {}
+
+def setting(name, **kwargs):
+  """
+  Gets a setting, kwargs are passed to decouple's config on the first read
+  """
+  if name not in values:
+    values[name] = config(name, **kwargs)
+  return values[name]
+
+def snapshot():
+  """
+  Reads all of the required settings, fails fast if any are missing
+  """
+  return {name: setting(name) for name in REQUIRED}
+
+def reset_settings():
+  values.clear()
@@ -0,0 +1,109 @@
+"""
+singleflight.py
+
+Collapses identical concurrent lookups into one call.
+
+The first greenlet to ask for a key makes the call, any others asking for the
+same key while it is in flight wait for it and share its result (or its
+exception). With READ_CACHE_MS set results are also kept for that many
+milliseconds. Results are shared, callers must not modify them.
+
+Cached results can be tied to a scope (e.g. a username), forget(scope) makes
+everything cached for it stale, including calls still in flight.
+"""
+import time
+import inspect
+import logging
+import functools
+from gevent.event import AsyncResult
+
+from settings import setting
+
+logger = logging.getLogger(__name__)
+
+MAX_RESULTS = 2048
+
+in_flight = {}
+results = {}
+generations = {}
+
+def freeze(value):
+  """
+  Makes call arguments usable as a dict key
+  """
+  if isinstance(value, (list, tuple)):
+    return tuple(freeze(v) for v in value)
+  if isinstance(value, dict):
+    return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+  return value
+
+def cache_ttl():
+  return setting("READ_CACHE_MS", default=0, cast=int) / 1000.0
+
+def forget(scope=None):
+  """
+  Makes the cached results for a scope stale
+  """
+  generations[scope] = generations.get(scope, 0) + 1
+
+def call(key, fn, args, kwargs, ttl=0, scope=None):
+  """
+  Calls fn(*args, **kwargs) unless the same key is already in flight or cached
+  """
+  generation = generations.get(scope, 0)
+  if ttl:
+    cached = results.get(key)
+    if cached and cached[0] > time.monotonic() and cached[1] == generation:
+      return cached[2]
+  pending = in_flight.get(key)
+  if pending is not None:
+    logger.debug("Sharing in flight call %s", key)
+    return pending.get()
+  pending = in_flight[key] = AsyncResult()
+  try:
+    value = fn(*args, **kwargs)
+  except Exception as err:
+    pending.set_exception(err)
+    raise
+  except BaseException:
+    # killed, the waiters must not be left hanging
+    pending.set_exception(RuntimeError(f"Shared call {key[0]} was interrupted"))
+    raise
+  finally:
+    del in_flight[key]
+  if ttl and generations.get(scope, 0) == generation:
+    if len(results) >= MAX_RESULTS:
+      now = time.monotonic()
+      for old_key in [k for k, v in results.items() if v[0] <= now]:
+        del results[old_key]
+    results[key] = (time.monotonic() + ttl, generation, value)
+  pending.set(value)
+  return value
+
+def shared(name, scope=None):
+  """
+  Decorator to share concurrent calls with the same arguments
+  scope names the argument results are tied to for forget()
+  The undecorated function is available as .fresh, it skips the cache but
+  still joins a call in flight
+  """
+  def decorator(fn):
+    signature = inspect.signature(fn)
+
+    def scope_of(args, kwargs):
+      if scope is None:
+        return None
+      return signature.bind(*args, **kwargs).arguments[scope]
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      key = (name, freeze(args), freeze(kwargs))
+      return call(key, fn, args, kwargs, ttl=cache_ttl(), scope=scope_of(args, kwargs))
+
+    def fresh(*args, **kwargs):
+      key = (name, freeze(args), freeze(kwargs))
+      return call(key, fn, args, kwargs, scope=scope_of(args, kwargs))
+
+    wrapper.fresh = fresh
+    return wrapper
+  return decorator
@@ -1,85 +1,200 @@
-"""
-Code to manage communications with SQS and SNS
-"""
-import logging
-import boto3
-import json
-
-from utils import get_rand_string
-
-logger = logging.getLogger(__name__)
-sqs = boto3.client("sqs")
-sns = boto3.client("sns")
-
-class SqsHandler(object):
-
-  def __init__(self, topic_name, kms_id):
-    """
-    Create object
-    """
-    self.topic_name = topic_name
-    self.kms_id = kms_id
-    self.queue_url = ""
-    self.sub_arn = ""
-
-  def _get_queue_policy(queue_arn, topic_name):
-    """
-    Makes a policy to apply to an SQS queue
-    """
-    queue_policy = {
-      "Statement": [
-        {
-          "Effect": "Allow",
-          "Principal": {
-            "Service": "sns.amazonaws.com"
-          },
-          "Action": "sqs:SendMessage",
-          "Resource": queue_arn,
-          "Condition": {
-            "ArnEquals": {
-              "aws:SourceArn": topic_name
-            }
-          }
-        }
-      ]
-    }
-    return queue_policy
-
-  def unsubscribe_and_delete_queue(self):
-    """
-    Deletes the queue and removes the associated subscription
-    """
-    logger.info("Deleting SQS queue and subscription")
-    sns.unsubscribe(SubscriptionArn=self.sub_arn)
-    sqs.delete_queue(QueueUrl=self.queue_url)
-
-  def create_queue_and_subscribe(self):
-    """
-    Creates an SQS queue and subscribes it to the SNS topic with state change notifications
-    """
-    queue_rand = get_rand_string(8)
-    queue = sqs.create_queue(
-      QueueName=f"ec2_{queue_rand}",
-      Attributes={
-        "KmsMasterKeyId": self.kms_id
-      }
-    )
-    queue_attr = sqs.get_queue_attributes(QueueUrl=queue["QueueUrl"], AttributeNames=["QueueArn"])
-    queue_policy = SqsHandler._get_queue_policy(
-      queue_arn = queue_attr["Attributes"]["QueueArn"],
-      topic_name = self.topic_name
-    )
-    sqs.set_queue_attributes(
-      QueueUrl=queue["QueueUrl"],
-      Attributes={
-        "Policy": json.dumps(queue_policy)
-      }
-    )
-    sns_sub = sns.subscribe(
-      TopicArn=self.topic_name,
-      Protocol="SQS",
-      Endpoint=queue_attr["Attributes"]["QueueArn"]
-    )
-    self.queue_url = queue["QueueUrl"]
-    self.sub_arn = sns_sub["SubscriptionArn"]
-    return queue["QueueUrl"]
\ No newline at end of file
+"""
+Code to manage communications with SQS and SNS
+"""
+import re
+import logging
+import json
+import socket
+import gevent
+
+from aws import get_client
+from settings import setting
+from utils import get_rand_string
+
+logger = logging.getLogger(__name__)
+
+MISSING_QUEUE_CODES = ("AWS.SimpleQueueService.NonExistentQueue", "QueueDoesNotExist")
+
+def durable_queue_name(template):
+  """
+  Expands {hostname} in EVENT_QUEUE_NAME, SQS only allows [A-Za-z0-9_-] up to 80 chars
+  """
+  name = template.format(hostname=socket.gethostname())
+  return re.sub(r"[^A-Za-z0-9_-]", "-", name)[:80]
+
+def queue_arn_from_url(queue_url):
+  """
+  https://sqs.<region>.amazonaws.com/<account>/<name> -> arn:aws:sqs:<region>:<account>:<name>
+  """
+  match = re.match(r"https://sqs\.([a-z0-9-]+)\.amazonaws\.com/(\d+)/(.+)$", queue_url)
+  if not match:
+    return None
+  return "arn:aws:sqs:{}:{}:{}".format(*match.groups())
+
+class SqsHandler(object):
+
+  def __init__(self, topic_name, kms_id, queue_name=None):
+    """
+    Create object
+    If queue_name is given that queue is reused across restarts, otherwise a
+    new queue is made for this process and deleted when it exits
+    """
+    self.topic_name = topic_name
+    self.kms_id = kms_id
+    self.queue_name = queue_name
+    self.durable = bool(queue_name)
+    self.queue_url = ""
+    self.sub_arn = ""
+
+  def _get_queue_policy(queue_arn, topic_name):
+    """
+    Makes a policy to apply to an SQS queue
+    """
+    queue_policy = {
+      "Statement": [
+        {
+          "Effect": "Allow",
+          "Principal": {
+            "Service": "sns.amazonaws.com"
+          },
+          "Action": "sqs:SendMessage",
+          "Resource": queue_arn,
+          "Condition": {
+            "ArnEquals": {
+              "aws:SourceArn": topic_name
+            }
+          }
+        }
+      ]
+    }
+    return queue_policy
+
+  def setup(self):
+    """
+    Gets a queue subscribed to the state change notifications, returns its URL
+    """
+    if self.durable:
+      return self.open_durable_queue()
+    return self.create_queue_and_subscribe()
+
+  def close(self):
+    """
+    Cleans up on exit, a durable queue and its subscription are left in place
+    """
+    if self.durable:
+      logger.info("Leaving queue %s subscribed for the next start", self.queue_url)
+      return
+    self.unsubscribe_and_delete_queue()
+
+  def unsubscribe_and_delete_queue(self):
+    """
+    Deletes the queue and removes the associated subscription
+    """
+    logger.info("Deleting SQS queue and subscription")
+    get_client("sns").unsubscribe(SubscriptionArn=self.sub_arn)
+    get_client("sqs").delete_queue(QueueUrl=self.queue_url)
+
+  def create_queue_and_subscribe(self):
+    """
+    Creates an SQS queue and subscribes it to the SNS topic with state change notifications
+    """
+    sqs = get_client("sqs")
+    sns = get_client("sns")
+    queue_rand = get_rand_string(8)
+    queue = sqs.create_queue(
+      QueueName=f"ec2_{queue_rand}",
+      Attributes={
+        "KmsMasterKeyId": self.kms_id
+      }
+    )
+    queue_attr = sqs.get_queue_attributes(QueueUrl=queue["QueueUrl"], AttributeNames=["QueueArn"])
+    queue_policy = SqsHandler._get_queue_policy(
+      queue_arn = queue_attr["Attributes"]["QueueArn"],
+      topic_name = self.topic_name
+    )
+    sqs.set_queue_attributes(
+      QueueUrl=queue["QueueUrl"],
+      Attributes={
+        "Policy": json.dumps(queue_policy)
+      }
+    )
+    sns_sub = sns.subscribe(
+      TopicArn=self.topic_name,
+      Protocol="SQS",
+      Endpoint=queue_attr["Attributes"]["QueueArn"]
+    )
+    self.queue_url = queue["QueueUrl"]
+    self.sub_arn = sns_sub["SubscriptionArn"]
+    return queue["QueueUrl"]
+
+  def find_subscription(self, queue_arn):
+    """
+    Gets the ARN of an existing subscription of the queue to the topic, if any
+    """
+    sns = get_client("sns")
+    params = {"TopicArn": self.topic_name}
+    while True:
+      response = sns.list_subscriptions_by_topic(**params)
+      for subscription in response.get("Subscriptions", []):
+        if subscription["Protocol"].lower() == "sqs" and subscription["Endpoint"] == queue_arn:
+          return subscription["SubscriptionArn"]
+      if "NextToken" not in response:
+        return None
+      params["NextToken"] = response["NextToken"]
+
+  def open_durable_queue(self):
+    """
+    Gets the named queue, creating it the first time, and only sets the policy
+    and subscribes it when that has not already been done
+    """
+    sqs = get_client("sqs")
+    sns = get_client("sns")
+    try:
+      queue_url = sqs.get_queue_url(QueueName=self.queue_name)["QueueUrl"]
+      logger.info("Reusing queue %s", queue_url)
+    except Exception as err:
+      if getattr(err, "response", {}).get("Error", {}).get("Code") not in MISSING_QUEUE_CODES:
+        raise
+      logger.info("Creating queue %s", self.queue_name)
+      queue_url = sqs.create_queue(
+        QueueName=self.queue_name,
+        Attributes={
+          "KmsMasterKeyId": self.kms_id,
+          # events queued while nothing is reading them are of little use
+          "MessageRetentionPeriod": str(setting("EVENT_QUEUE_RETENTION_SECONDS", default=600, cast=int))
+        }
+      )["QueueUrl"]
+    # look for the subscription while the attributes are read, the ARN is
+    # normally derivable from the URL so neither has to wait for the other
+    expected_arn = queue_arn_from_url(queue_url)
+    subscription = gevent.spawn(self.find_subscription, expected_arn) if expected_arn else None
+    queue_attr = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["QueueArn", "Policy"])
+    queue_arn = queue_attr["Attributes"]["QueueArn"]
+    if queue_arn != expected_arn:
+      if subscription:
+        subscription.kill()
+      subscription = gevent.spawn(self.find_subscription, queue_arn)
+    queue_policy = SqsHandler._get_queue_policy(
+      queue_arn = queue_arn,
+      topic_name = self.topic_name
+    )
+    current_policy = queue_attr["Attributes"].get("Policy")
+    if current_policy is None or json.loads(current_policy) != queue_policy:
+      sqs.set_queue_attributes(
+        QueueUrl=queue_url,
+        Attributes={
+          "Policy": json.dumps(queue_policy)
+        }
+      )
+    sub_arn = subscription.get()
+    if sub_arn is None:
+      sub_arn = sns.subscribe(
+        TopicArn=self.topic_name,
+        Protocol="SQS",
+        Endpoint=queue_arn
+      )["SubscriptionArn"]
+    else:
+      logger.info("Reusing subscription %s", sub_arn)
+    self.queue_url = queue_url
+    self.sub_arn = sub_arn
+    return queue_url
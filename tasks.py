@@ -0,0 +1,193 @@
+"""
+tasks.py
+
+Tracks the Fargate tasks which build and destroy desktops.
+
+Each desktop a task was started for is recorded in the config table, a
+batched task (see ecs.py) has one item per desktop:
+
+| partition key | sort key                |
+| task          | <task arn>#<desktop_id> | {task_arn, username, desktop_id, mode, started, finished, failure}
+
+Progress comes from the ECS task state change events MessageProcessor
+receives. When none have arrived for a while, e.g. the EventBridge rule only
+forwards EC2 events, the tracked tasks are polled with describe_tasks instead,
+up to 100 per call, and jobs given to the provisioning workers (see
+workqueue.py) are read from their job items. Either way the user's listeners get "provisioning" or
+"destroying" events as a task moves on and "failed" if it stops with an
+error. For a batch the manifest results decide which of its desktops failed.
+
+Every worker has listeners of its own, so the first to see a task stop does
+not delete its items. It marks them finished with the outcome, the others
+send the same final event from there, and the local cache writer deletes
+items once they have been finished for TASK_FINISHED_SECONDS.
+"""
+import time
+import logging
+
+from aws import get_client
+from settings import setting
+from data import ddb_create, get_ddb_items_with_keys, update_ddb_item, del_ddb_item
+import workqueue
+import registry
+import localcache
+
+logger = logging.getLogger(__name__)
+
+DOMAIN = "task"
+STATES = {
+  "apply": "provisioning",
+  "destroy": "destroying"
+}
+# describe_tasks accepts at most this many tasks
+BATCH_SIZE = 100
+
+def track(task_arn, username, desktop_id, mode):
+  """
+  Records a task started for a desktop
+  """
+  ddb_create(
+    setting("TABLE_NAME"),
+    domain=DOMAIN,
+    sub_id=f"{task_arn}#{desktop_id}",
+    task_arn=task_arn,
+    username=username,
+    desktop_id=desktop_id,
+    mode=mode,
+    started=int(time.time()),
+    finished=0
+  )
+
+def finished_seconds():
+  return setting("TASK_FINISHED_SECONDS", default=600, cast=int)
+
+def expired(task):
+  return bool(task.get("finished")) and time.time() - task["finished"] > finished_seconds()
+
+def list_tasks():
+  """
+  Every desktop with a task in flight or recently finished
+  """
+  return [task for task in get_ddb_items_with_keys(setting("TABLE_NAME"), domain=DOMAIN) if not expired(task)]
+
+def get_task(task_arn):
+  """
+  The desktops a task was started for
+  """
+  tracked = get_ddb_items_with_keys(setting("TABLE_NAME"), domain=DOMAIN, sub_id__begins_with=f"{task_arn}#")
+  return [task for task in tracked if not expired(task)]
+
+def prune_finished():
+  """
+  Deletes the items of tasks finished for longer than TASK_FINISHED_SECONDS
+  Run by the local cache writer so the partition stays small
+  """
+  table = setting("TABLE_NAME")
+  for task in get_ddb_items_with_keys(table, domain=DOMAIN):
+    if expired(task):
+      del_ddb_item(table, domain=DOMAIN, sub_id=task["sub_id"])
+
+def manifest_id(described):
+  for override in described.get("overrides", {}).get("containerOverrides", []):
+    for variable in override.get("environment", []):
+      if variable["name"] == "MANIFEST_ID":
+        return variable["value"]
+  return None
+
+def task_failure(described):
+  """
+  Why a stopped task failed, None if it succeeded
+  """
+  for container in described.get("containers", []):
+    exit_code = container.get("exitCode")
+    if exit_code is not None:
+      return f"{container.get('name', 'task')} exited with code {exit_code}" if exit_code != 0 else None
+  return described.get("stoppedReason") or "task stopped without running"
+
+def finish(task, failure):
+  """
+  Marks a desktop's task finished with its outcome
+  Returns True for the one caller which marked it, False if another worker did first
+  """
+  keys = {"domain": DOMAIN, "sub_id": task["sub_id"]}
+  if "finished" not in task:
+    # tracked before items were marked finished, nothing else waits for it
+    del_ddb_item(setting("TABLE_NAME"), **keys)
+    return True
+  return update_ddb_item(
+    setting("TABLE_NAME"),
+    keys,
+    expected={"finished": 0},
+    finished=int(time.time()),
+    failure=failure or ""
+  )
+
+def progress(task, described, results=None):
+  """
+  Works out the event for a desktop from its task's ECS description (an event
+  detail or a describe_tasks entry), marks it finished once it has stopped
+  results are the manifest results for a batched task
+  """
+  status = described.get("lastStatus")
+  payload = {
+    "desktop_id": task["desktop_id"],
+    "state": STATES.get(task["mode"], task["mode"]),
+    "task_status": status
+  }
+  if status != "STOPPED":
+    return payload
+  if task.get("finished"):
+    # another worker saw it stop first and kept the outcome
+    failure = task.get("failure") or None
+    first = False
+  else:
+    outcome = (results or {}).get(task["desktop_id"])
+    if outcome is not None:
+      failure = None if outcome == "ok" else outcome
+    else:
+      failure = task_failure(described)
+    first = finish(task, failure)
+  if failure is None:
+    # EC2 state events follow from here
+    return payload
+  if first:
+    logger.warning("Task %s to %s desktop %s failed: %s", task["task_arn"], task["mode"], task["desktop_id"], failure)
+  if first and task["mode"] == "apply" and registry.registry_enabled():
+    record = registry.get_desktop.fresh(task["username"], task["desktop_id"])
+    if record and not record.get("instanceid"):
+      registry.remove_desktop(task["username"], task["desktop_id"])
+  payload.update(state="failed", reason=failure)
+  return payload
+
+def describe(tasks):
+  """
+  Gets the ECS descriptions of tracked tasks, keyed by task arn
+  Finished tasks, tasks ECS no longer knows about, and jobs no worker picked
+  up in time, are described as stopped
+  """
+  ecs = get_client("ecs")
+  cluster = setting("CLUSTER_NAME")
+  running = {task["task_arn"] for task in tasks if not task.get("finished")}
+  arns = sorted(arn for arn in running if not workqueue.is_job(arn))
+  described = workqueue.describe({arn for arn in running if workqueue.is_job(arn)})
+  for task in tasks:
+    if task["task_arn"] not in running:
+      described[task["task_arn"]] = {"lastStatus": "STOPPED"}
+  for i in range(0, len(arns), BATCH_SIZE):
+    batch = arns[i:i + BATCH_SIZE]
+    response = ecs.describe_tasks(cluster=cluster, tasks=batch)
+    for entry in response.get("tasks", []):
+      described[entry["taskArn"]] = entry
+    for failure in response.get("failures", []):
+      if failure.get("reason") == "MISSING":
+        described[failure["arn"]] = {"lastStatus": "STOPPED", "stoppedReason": "task is no longer known to ECS"}
+  timeout = setting("PROVISION_JOB_TIMEOUT_SECONDS", default=3600, cast=int)
+  for task in tasks:
+    if described.get(task["task_arn"], {}).get("lastStatus") == "PENDING" and time.time() - task["started"] > timeout:
+      # a job is cancelled so a worker which gets to it later leaves it alone,
+      # if one has just taken it the next poll sees it running
+      if not workqueue.is_job(task["task_arn"]) or workqueue.cancel(task["task_arn"], "no worker picked the job up"):
+        described[task["task_arn"]] = {"lastStatus": "STOPPED", "stoppedReason": "no worker picked the job up"}
+  return described
+
+localcache.register_refresh("finished_tasks", prune_finished)
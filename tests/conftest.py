@@ -0,0 +1,62 @@
+"""
+Shared fixtures, the app modules run against the in-process AWS stand-in
+from tools/fakeaws.py so no network access is needed
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+import fakeaws
+fakeaws.add_repo_to_path()
+# the settings defaults have to be in place before any app module is imported
+fakeaws.install()
+
+import pytest
+
+def reset_modules():
+  """
+  Clears the per-process state the app modules keep between calls
+  """
+  import settings
+  import aws
+  import governor
+  import singleflight
+  import data
+  import loadshed
+  import localcache
+  settings.reset_settings()
+  aws.reset_clients()
+  governor.reset()
+  singleflight.in_flight.clear()
+  singleflight.results.clear()
+  singleflight.generations.clear()
+  data.table_keys.clear()
+  loadshed.reset()
+  localcache.reset()
+
+@pytest.fixture
+def configure(monkeypatch):
+  """
+  Sets settings for one test, configure(NAME="value", ...)
+  """
+  def configure(**values):
+    import settings
+    for name, value in values.items():
+      monkeypatch.setenv(name, str(value))
+    settings.reset_settings()
+  return configure
+
+@pytest.fixture
+def world(monkeypatch, tmp_path):
+  """
+  A fresh AWS stand-in with the config table seeded, and a local cache of its own
+  """
+  monkeypatch.setenv("LOCAL_CACHE_PATH", str(tmp_path / "cache.db"))
+  reset_modules()
+  world = fakeaws.install()
+  world.fleet = world.seed(table=os.environ["TABLE_NAME"], env_key=os.environ["ENV_KEY"], users=4, desktops_per_user=1, machine_defs=2)
+  yield world
+  reset_modules()
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+import data
+
+def table():
+  return os.environ["TABLE_NAME"]
+
+def test_keys_on_the_table_are_queried(world):
+  plan = data.plan_ddb_query(table(), domain="user", sub_id__begins_with="user00001#")
+  assert (plan.operation, plan.index) == ("query", None)
+  assert "begins_with" in plan.params["KeyConditionExpression"]
+  assert "FilterExpression" not in plan.params
+
+def test_index_is_queried_for_its_hash_key(world):
+  world.indexes = {"by_state": ("state", None)}
+  plan = data.plan_ddb_query(table(), state="running", username="user00001")
+  assert (plan.operation, plan.index) == ("query", "by_state")
+  assert plan.params["IndexName"] == "by_state"
+  assert "FilterExpression" in plan.params
+
+def test_table_wins_a_tie_with_an_index(world):
+  world.indexes = {"by_state": ("state", None)}
+  plan = data.plan_ddb_query(table(), domain="user", state="running")
+  assert (plan.operation, plan.index) == ("query", None)
+
+def test_scan_without_a_hash_key(world):
+  plan = data.plan_ddb_query(table(), state="running", sub_id__begins_with="user")
+  assert (plan.operation, plan.index) == ("scan", None)
+  assert "KeyConditionExpression" not in plan.params
+
+def test_empty_in_list_is_rejected(world):
+  with pytest.raises(ValueError):
+    data.plan_ddb_query(table(), domain="user", state__in=[])
+
+def test_update_helpers(world):
+  keys = {"domain": "test", "sub_id": "item"}
+  assert data.update_ddb_item(table(), keys, only_if_newer="version", version=2, state="new")
+  assert not data.update_ddb_item(table(), keys, only_if_newer="version", version=1, state="stale")
+  assert not data.update_ddb_item(table(), keys, only_if_newer="version", allow_equal=False, version=2, state="same")
+  assert not data.update_ddb_item(table(), keys, expected={"state": "other"}, state="unexpected")
+  data.add_ddb_counters(table(), keys, count=2)
+  data.add_ddb_counters(table(), keys, count=3)
+  assert data.claim_ddb_item(table(), {"state": "other"}, **keys) is None
+  item = data.claim_ddb_item(table(), {"state": "new"}, **keys)
+  assert (item["state"], item["version"], item["count"]) == ("new", 2, 5)
+  assert data.get_ddb_item(table(), **keys) is None
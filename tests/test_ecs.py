@@ -0,0 +1,37 @@
+import os
+
+import gevent
+
+import ecs
+
+def create(n, user_data):
+  return ecs.create_desktop_instance(f"new{n}", "ami-1", "user00000", "1920x1080", f"md{n % 2}", "t3.large", user_data)
+
+def manifests(world):
+  return [item for (domain, _), item in world.tables[os.environ["TABLE_NAME"]].items() if domain == ecs.MANIFEST_DOMAIN]
+
+def test_manifest_holds_user_data_once_per_machine_def(world, configure):
+  configure(PROVISION_BATCH_MS=50)
+  user_data = "I2Jhc2gK" * 2000
+  gevent.joinall([gevent.spawn(create, n, user_data) for n in range(6)])
+  manifest, = manifests(world)
+  desktops = manifest["desktops"]["L"]
+  assert len(desktops) == 6 and all("B64_USER_DATA" not in desktop["M"] for desktop in desktops)
+  assert set(manifest["user_data"]["M"]) == {"md0", "md1"}
+
+def test_batches_are_split_before_the_manifest_gets_too_big(world, configure):
+  configure(PROVISION_BATCH_MS=50, PROVISION_MANIFEST_MAX_BYTES=1000)
+  jobs = [gevent.spawn(create, n, "x" * 300) for n in range(6)]
+  gevent.joinall(jobs)
+  assert all(job.value for job in jobs)
+  # two machine defs fit with a little room for the desktops
+  sizes = sorted(len(manifest["desktops"]["L"]) for manifest in manifests(world))
+  assert sum(sizes) == 6 and len(sizes) > 1
+
+def test_full_batches_are_not_overfilled(world, configure):
+  configure(PROVISION_BATCH_MS=50, PROVISION_BATCH_SIZE=2)
+  jobs = [gevent.spawn(create, n, "I2Jhc2gK") for n in range(5)]
+  gevent.joinall(jobs)
+  assert all(job.value for job in jobs)
+  # the fifth desktop starts on its own, without a manifest
+  assert sorted(len(manifest["desktops"]["L"]) for manifest in manifests(world)) == [2, 2]
@@ -0,0 +1,103 @@
+import time
+
+import pytest
+from botocore.exceptions import EndpointConnectionError, ParamValidationError
+
+import governor
+from errors import ServiceUnavailableException
+
+class Throttled(Exception):
+  response = {"Error": {"Code": "ThrottlingException"}, "ResponseMetadata": {"HTTPStatusCode": 400}}
+
+class Outage(Exception):
+  response = {"Error": {"Code": "InternalError"}, "ResponseMetadata": {"HTTPStatusCode": 500}}
+
+def fails_with(error):
+  def method():
+    raise error()
+  return method
+
+def ok():
+  return "ok"
+
+@pytest.fixture(autouse=True)
+def breaker_settings(configure):
+  configure(GOVERNOR_BREAKER_FAILURES=2, GOVERNOR_BREAKER_SECONDS=0.05, GOVERNOR_MAX_RETRIES=1)
+  governor.reset()
+  yield
+  governor.reset()
+
+def open_breaker():
+  for _ in range(2):
+    with pytest.raises(ServiceUnavailableException):
+      governor.call("svc", "op", fails_with(Outage), (), {})
+  with pytest.raises(ServiceUnavailableException):
+    governor.call("svc", "op", ok, (), {})
+
+def test_breaker_closes_after_a_throttled_trial_call():
+  open_breaker()
+  time.sleep(0.06)
+  # the trial call is retried once, then gives up still throttled
+  with pytest.raises(ServiceUnavailableException):
+    governor.call("svc", "op", fails_with(Throttled), (), {})
+  breaker = governor.get_breaker("svc")
+  assert not breaker.trial
+  time.sleep(0.06)
+  assert governor.call("svc", "op", ok, (), {}) == "ok"
+  assert breaker.opened_at is None
+
+def test_breaker_trial_cleared_when_call_is_interrupted():
+  open_breaker()
+  time.sleep(0.06)
+  def interrupted():
+    raise KeyboardInterrupt()
+  with pytest.raises(KeyboardInterrupt):
+    governor.call("svc", "op", interrupted, (), {})
+  assert not governor.get_breaker("svc").trial
+
+def test_unlisted_operations_are_not_limited():
+  bucket = governor.get_bucket("dynamodb", "get_item")
+  assert bucket.rate is None
+  assert all(bucket.reserve() == 0 for _ in range(1000))
+
+def test_listed_operations_are_limited(configure):
+  configure(GOVERNOR_RATES="ecs.run_task=1")
+  bucket = governor.get_bucket("ecs", "run_task")
+  bucket.reserve()
+  assert bucket.reserve() > 0
+
+def test_unlimited_bucket_limits_after_throttling_then_recovers():
+  bucket = governor.TokenBucket()
+  for _ in range(40):
+    bucket.reserve()
+  bucket.throttled()
+  assert bucket.rate == pytest.approx(bucket.ceiling / 2)
+  assert bucket.ceiling >= 40
+  # a long quiet spell climbs back to where AWS throttled us, then off
+  bucket.adjusted -= 100
+  bucket.succeeded()
+  assert bucket.rate == bucket.ceiling
+  bucket.succeeded()
+  assert bucket.rate is None
+
+def test_server_and_connection_errors_are_retried():
+  for error in (Outage(), EndpointConnectionError(endpoint_url="https://ec2.eu-west-2.amazonaws.com")):
+    attempts = []
+    def flaky():
+      attempts.append(1)
+      if len(attempts) == 1:
+        raise error
+      return "ok"
+    assert governor.call("svc", "op", flaky, (), {}) == "ok"
+    assert len(attempts) == 2
+
+def test_client_side_errors_are_not_outages():
+  invalid = ParamValidationError(report="Missing required parameter")
+  assert not governor.is_outage(invalid)
+  assert governor.is_outage(EndpointConnectionError(endpoint_url="https://ec2.eu-west-2.amazonaws.com"))
+  for _ in range(5):
+    with pytest.raises(ParamValidationError):
+      governor.call("svc", "op", fails_with(lambda: invalid), (), {})
+  # bugs in our own calls leave the breaker closed
+  assert governor.get_breaker("svc").opened_at is None
+  assert governor.call("svc", "op", ok, (), {}) == "ok"
@@ -0,0 +1,47 @@
+import gevent
+import pytest
+from flask import Response
+
+import loadshed
+from errors import ServiceUnavailableException, AWSUnavailableException
+
+def test_requests_over_the_limit_are_shed(world, configure):
+  configure(LOADSHED_LIMITS="read=2")
+  @loadshed.limited("read")
+  def slow():
+    gevent.sleep(0.1)
+  running = [gevent.spawn(slow) for _ in range(2)]
+  gevent.sleep(0)
+  with pytest.raises(ServiceUnavailableException):
+    slow()
+  gevent.joinall(running)
+  slow()
+  assert loadshed.get_limit("read").in_flight == 0
+
+def test_event_streams_hold_their_slot_until_closed(world, configure):
+  configure(LOADSHED_LIMITS="sse=1")
+  @loadshed.limited("sse")
+  def listen():
+    return Response(iter(["data: hello\n\n"]), mimetype="text/event-stream")
+  response = listen()
+  assert loadshed.get_limit("sse").in_flight == 1
+  with pytest.raises(ServiceUnavailableException):
+    listen()
+  response.close()
+  assert loadshed.get_limit("sse").in_flight == 0
+  listen().close()
+
+def test_only_aws_unavailability_cuts_the_limit(world, configure):
+  configure(LOADSHED_LIMITS="read=50")
+  def failing(err):
+    @loadshed.limited("read")
+    def route():
+      raise err
+    return route
+  with pytest.raises(ServiceUnavailableException):
+    failing(ServiceUnavailableException("This server is restarting"))()
+  assert loadshed.get_limit("read").limit == 50
+  with pytest.raises(AWSUnavailableException):
+    failing(AWSUnavailableException("The ec2 service is unavailable"))()
+  assert loadshed.get_limit("read").limit == 40
+  assert loadshed.get_limit("read").in_flight == 0
@@ -0,0 +1,45 @@
+import time
+import sqlite3
+
+import gevent
+
+import localcache
+from messageprocessor import MessageProcessor
+
+def test_a_locked_cache_does_not_stall_other_greenlets(world, configure):
+  configure(LOCAL_CACHE_TIMEOUT_SECONDS=0.5)
+  localcache.put("test", "key", 1)
+  # another worker in the middle of a write
+  other = sqlite3.connect(localcache.cache_path(), isolation_level=None)
+  other.execute("BEGIN IMMEDIATE")
+  ticks = []
+  ticker = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.05)) for _ in range(100)])
+  started = time.time()
+  localcache.put("test", "key", 2)
+  waited = time.time() - started
+  ticker.kill()
+  other.rollback()
+  other.close()
+  # the write gave up after the timeout while the hub kept running
+  assert 0.4 < waited < 2 and len(ticks) >= 5
+  assert localcache.get("test", "key") == 1
+
+def test_terminated_instances_are_forgotten(world):
+  instance_id = next(iter(world.instances))
+  processor = MessageProcessor("events")
+  processor.handle_state_change({"detail": {"instance-id": instance_id, "state": "stopping"}, "time": "2021-03-01T09:00:00Z"})
+  assert localcache.get("instance_tags", instance_id)
+  processor.handle_state_change({"detail": {"instance-id": instance_id, "state": "terminated"}, "time": "2021-03-01T09:01:00Z"})
+  assert localcache.get("instance_tags", instance_id) is None
+
+def test_prune_drops_old_instance_entries(world, configure):
+  configure(LOCAL_CACHE_MAX_AGE_SECONDS=60)
+  localcache.put("instance_tags", "i-old", {"Username": "user00000"})
+  localcache.put("instance_tags", "i-new", {"Username": "user00001"})
+  localcache.put("group_role_map", "map", {"group0": ["role0"]})
+  localcache.execute("UPDATE cache SET updated = ? WHERE key IN ('i-old', 'map')", (time.time() - 120,))
+  localcache.prune()
+  assert localcache.get("instance_tags", "i-old") is None
+  assert localcache.get("instance_tags", "i-new")
+  # only what is kept per instance goes
+  assert localcache.get("group_role_map", "map")
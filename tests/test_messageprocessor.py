@@ -0,0 +1,49 @@
+import gevent
+
+from errors import ServiceUnavailableException
+from messageprocessor import MessageProcessor
+
+def test_event_is_redelivered_after_a_handler_fails(world):
+  sqs = world.client("sqs")
+  url = sqs.create_queue(QueueName="events", Attributes={"VisibilityTimeout": "0.1"})["QueueUrl"]
+  instance_id = next(iter(world.instances))
+  world.enqueue(url, world.state_change_body(instance_id, "stopping"))
+  processor = MessageProcessor(url)
+  handled = []
+  def handle_state_change(body):
+    if not handled:
+      handled.append("unavailable")
+      raise ServiceUnavailableException("breaker open", retry_after=0)
+    if len(handled) == 1:
+      handled.append("error")
+      raise KeyError("boom")
+    handled.append(body["detail"]["state"])
+  processor.handle_state_change = handle_state_change
+  poller = gevent.spawn(processor.run)
+  try:
+    with gevent.Timeout(5):
+      while len(handled) < 3:
+        gevent.sleep(0.05)
+    gevent.sleep(0.2)
+  finally:
+    poller.kill()
+  # the poll loop survived both failures and the message was only handled once it succeeded
+  assert handled == ["unavailable", "error", "stopping"]
+  assert not world.queues[url]["messages"] and not world.queues[url]["inflight"]
+
+def test_coalescing_orders_events_by_eventbridge_time_only(world, configure):
+  configure(EVENT_COALESCE_MS=50)
+  processor = MessageProcessor("events")
+  sent = []
+  processor.deliver = lambda username, payloads: sent.extend(payloads)
+  processor.listen("user00000")
+  def publish(state, event_time):
+    processor.publish("user00000", {"desktop_id": "d1", "state": state}, event_time)
+  # EventBridge times are whole seconds, a payload without one must not outrank them
+  publish("provisioning", None)
+  publish("running", 1614589200)
+  publish("stopping", 1614589201)
+  # delivered late
+  publish("pending", 1614589199)
+  gevent.sleep(0.1)
+  assert sent == [{"desktop_id": "d1", "state": "stopping"}]
@@ -0,0 +1,62 @@
+import gevent
+
+import singleflight
+
+def counted(name, scope=None, delay=0.05, fail=False):
+  calls = []
+  @singleflight.shared(name, scope=scope)
+  def lookup(username):
+    calls.append(username)
+    gevent.sleep(delay)
+    if fail:
+      raise KeyError(username)
+    return {"username": username, "call": len(calls)}
+  return lookup, calls
+
+def test_concurrent_callers_share_one_call(world):
+  lookup, calls = counted("share")
+  callers = [gevent.spawn(lookup, "user00000") for _ in range(5)] + [gevent.spawn(lookup, "user00001")]
+  gevent.joinall(callers)
+  assert sorted(calls) == ["user00000", "user00001"]
+  assert all(caller.value is callers[0].value for caller in callers[:5])
+  assert not singleflight.in_flight
+
+def test_waiters_share_the_exception(world):
+  lookup, calls = counted("fail", fail=True)
+  callers = [gevent.spawn(lookup, "user00000") for _ in range(3)]
+  gevent.joinall(callers)
+  assert len(calls) == 1
+  assert all(isinstance(caller.exception, KeyError) for caller in callers)
+
+def test_waiters_are_released_when_the_caller_is_killed(world):
+  lookup, calls = counted("killed", delay=1)
+  first = gevent.spawn(lookup, "user00000")
+  gevent.sleep(0)
+  waiter = gevent.spawn(lookup, "user00000")
+  gevent.sleep(0)
+  first.kill()
+  with gevent.Timeout(0.5):
+    waiter.join()
+  assert isinstance(waiter.exception, RuntimeError)
+  assert not singleflight.in_flight
+
+def test_results_are_cached_until_their_scope_is_forgotten(world, configure):
+  configure(READ_CACHE_MS=10000)
+  lookup, calls = counted("cached", scope="username", delay=0)
+  assert lookup("user00000")["call"] == 1
+  assert lookup("user00000")["call"] == 1
+  assert lookup("user00001")["call"] == 2
+  # .fresh skips the cache
+  assert lookup.fresh("user00000")["call"] == 3
+  singleflight.forget("user00000")
+  assert lookup("user00000")["call"] == 4
+  assert lookup("user00001")["call"] == 2
+
+def test_a_call_in_flight_when_its_scope_is_forgotten_is_not_cached(world, configure):
+  configure(READ_CACHE_MS=10000)
+  lookup, calls = counted("stale", scope="username")
+  caller = gevent.spawn(lookup, "user00000")
+  gevent.sleep(0)
+  singleflight.forget("user00000")
+  caller.join()
+  assert lookup("user00000")["call"] == 2
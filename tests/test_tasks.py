@@ -0,0 +1,81 @@
+import os
+import json
+
+import gevent
+
+import ecs
+import tasks
+from data import get_ddb_item, update_ddb_item
+from messageprocessor import MessageProcessor
+
+TASK_ARN = "arn:aws:ecs:eu-west-2:123456789012:task/cluster/abc"
+
+def stopped_task(exit_code):
+  return {
+    "taskArn": TASK_ARN,
+    "lastStatus": "STOPPED",
+    "containers": [{"name": "instance-manager", "lastStatus": "STOPPED", "exitCode": exit_code}]
+  }
+
+def event(world, task):
+  return json.loads(json.loads(world.task_change_body(task))["Message"])
+
+def worker(sent):
+  processor = MessageProcessor("events")
+  processor.publish = lambda username, payload, event_time=None: sent.append((username, payload))
+  return processor
+
+def test_every_worker_sends_the_final_event(world):
+  tasks.track(TASK_ARN, "user00000", "new1", "apply")
+  first, second, polling = [], [], []
+  body = event(world, stopped_task(1))
+  worker(first).handle_task_change(body)
+  worker(second).handle_task_change(body)
+  # a worker which only polls sees it too, without asking ECS about a finished task
+  worker(polling).report_task(tasks.list_tasks(), dict(tasks.describe(tasks.list_tasks())[TASK_ARN], taskArn=TASK_ARN))
+  for sent in (first, second, polling):
+    assert sent == [("user00000", {
+      "desktop_id": "new1",
+      "state": "failed",
+      "task_status": "STOPPED",
+      "reason": "instance-manager exited with code 1"
+    })]
+  item = get_ddb_item(os.environ["TABLE_NAME"], domain=tasks.DOMAIN, sub_id=f"{TASK_ARN}#new1")
+  assert item["finished"] and item["failure"] == "instance-manager exited with code 1"
+
+def test_the_final_event_is_sent_once_per_worker(world):
+  tasks.track(TASK_ARN, "user00000", "new1", "apply")
+  sent = []
+  processor = worker(sent)
+  processor.handle_task_change(event(world, stopped_task(0)))
+  processor.report_task(tasks.list_tasks(), {"taskArn": TASK_ARN, "lastStatus": "STOPPED"})
+  assert sent == [("user00000", {"desktop_id": "new1", "state": "provisioning", "task_status": "STOPPED"})]
+
+def test_finished_tasks_are_deleted_after_a_while(world):
+  tasks.track(TASK_ARN, "user00000", "new1", "apply")
+  tasks.track("arn:running", "user00001", "new2", "apply")
+  worker([]).handle_task_change(event(world, stopped_task(0)))
+  assert len(tasks.list_tasks()) == 2
+  update_ddb_item(os.environ["TABLE_NAME"], {"domain": tasks.DOMAIN, "sub_id": f"{TASK_ARN}#new1"}, finished=1)
+  assert [task["desktop_id"] for task in tasks.list_tasks()] == ["new2"]
+  assert tasks.get_task(TASK_ARN) == []
+  tasks.prune_finished()
+  assert get_ddb_item(os.environ["TABLE_NAME"], domain=tasks.DOMAIN, sub_id=f"{TASK_ARN}#new1") is None
+
+def test_a_job_given_up_on_is_not_run_later(world, configure):
+  configure(PROVISION_BACKEND="queue", PROVISION_QUEUE_NAME="provisioning", PROVISION_JOB_TIMEOUT_SECONDS=60)
+  table = os.environ["TABLE_NAME"]
+  queue_url = world.client("sqs").create_queue(QueueName="provisioning")["QueueUrl"]
+  job_id = ecs.start_task({"MODE": "apply", "DESKTOP_ID": "new1", "MACHINE_USERNAME": "user00000", "MACHINE_DEF_ID": "md0", "SCREEN_GEOMETRY": "1920x1080"})
+  tasks.track(job_id, "user00000", "new1", "apply")
+  update_ddb_item(table, {"domain": tasks.DOMAIN, "sub_id": f"{job_id}#new1"}, started=1)
+  assert tasks.describe(tasks.list_tasks())[job_id]["stoppedReason"] == "no worker picked the job up"
+  # a worker gets to it afterwards
+  instances = len(world.instances)
+  world.start_workers(queue_url, 1, 0, table)
+  with gevent.Timeout(2):
+    while world.queues[queue_url]["messages"]:
+      gevent.sleep(0.05)
+  gevent.sleep(0.1)
+  assert len(world.instances) == instances
+  assert get_ddb_item(table, domain="job", sub_id=job_id[len("job/"):])["cancelled"]
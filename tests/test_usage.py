@@ -0,0 +1,44 @@
+import gevent
+import pytest
+
+import usage
+from errors import BadRequestException
+
+# 2026-03-01T23:00:00Z
+LATE = 1772406000
+
+def tags(username="user00001"):
+  return {"Username": username, "DesktopId": "desktop0", "MachineDef": "def0"}
+
+@pytest.fixture
+def enabled(world, configure):
+  configure(USAGE_ENABLED="true")
+  return world
+
+def test_run_across_midnight_is_split(enabled):
+  usage.record_state_change("i-1", "running", LATE, tags())
+  usage.record_state_change("i-1", "stopped", LATE + 7200, tags())
+  assert usage.get_usage("2026-03-01", "2026-03-01")["users"] == {"user00001": 1.0}
+  assert usage.get_usage("2026-03-02", "2026-03-02")["users"] == {"user00001": 1.0}
+  assert usage.get_usage("2026-03-01", "2026-03-02")["machine_defs"] == {"def0": 2.0}
+
+def test_events_from_two_workers_are_counted_once(enabled):
+  for state, event_time in (("running", LATE - 3600), ("stopped", LATE)):
+    workers = [gevent.spawn(usage.record_state_change, "i-1", state, event_time, tags()) for _ in range(2)]
+    gevent.joinall(workers, raise_error=True)
+  assert usage.get_usage("2026-03-01", "2026-03-01")["users"] == {"user00001": 1.0}
+
+def test_warm_pool_desktops_are_not_counted(enabled):
+  usage.record_state_change("i-1", "running", LATE - 3600, tags("warmpool"))
+  usage.record_state_change("i-1", "stopped", LATE, tags("warmpool"))
+  assert usage.get_usage("2026-03-01", "2026-03-01")["users"] == {}
+
+@pytest.mark.parametrize("first_day, last_day", [
+  ("2026-3-1x", "2026-03-01"),
+  ("2026-03-01", None),
+  ("2026-03-02", "2026-03-01"),
+  ("2024-01-01", "2026-03-01")
+])
+def test_usage_dates_are_validated(world, first_day, last_day):
+  with pytest.raises(BadRequestException):
+    usage.get_usage(first_day, last_day)
@@ -0,0 +1,56 @@
+import os
+
+import localcache
+import registry
+import warmpool
+from data import get_ddb_item
+from messageprocessor import MessageProcessor
+
+def add_pooled_desktop(world, configure):
+  configure(WARM_POOL_ENABLED="true")
+  table = os.environ["TABLE_NAME"]
+  instance_id = world.add_instance(warmpool.pool_username(), "pool1", "md0", os.environ["ENV_KEY"], state="stopped")
+  world.put_config(table, domain="warmpool#md0", sub_id="slot0", state="ready", desktop_id="pool1", instanceid=instance_id, created=1)
+  return instance_id, get_ddb_item(table, domain="machine_def", sub_id="md0")
+
+def ec2_tags(world, instance_id):
+  return {tag["Key"]: tag["Value"] for tag in world.instances[instance_id]["Tags"]}
+
+def test_claim_hands_the_desktop_over_and_asks_for_a_refill(world, configure):
+  instance_id, machine_def = add_pooled_desktop(world, configure)
+  assert warmpool.claim("user00000", "new1", machine_def, "1280x720") == instance_id
+  tags = ec2_tags(world, instance_id)
+  assert tags["Username"] == "user00000" and tags["DesktopId"] == "new1"
+  assert tags["ProvisionedUsername"] == warmpool.pool_username() and tags["ProvisionedDesktopId"] == "pool1"
+  assert world.instances[instance_id]["State"]["Name"] != "stopped"
+  assert get_ddb_item(os.environ["TABLE_NAME"], domain="warmpool#md0", sub_id="slot0") is None
+  # the writer refills the pool, not the request
+  assert localcache.get("warmpool", "refill") == "md0"
+
+def test_failed_claim_returns_the_desktop_to_the_pool(world, configure, monkeypatch):
+  instance_id, machine_def = add_pooled_desktop(world, configure)
+  def start_instance(instance_id):
+    raise RuntimeError("InsufficientInstanceCapacity")
+  monkeypatch.setattr(warmpool, "start_instance", start_instance)
+  assert warmpool.claim("user00000", "new1", machine_def, "1280x720") is None
+  slot = get_ddb_item(os.environ["TABLE_NAME"], domain="warmpool#md0", sub_id="slot0")
+  assert slot["state"] == "ready" and slot["instanceid"] == instance_id
+  tags = ec2_tags(world, instance_id)
+  assert tags["Username"] == warmpool.pool_username() and tags["DesktopId"] == "pool1"
+  assert "ProvisionedUsername" not in tags
+  assert localcache.get("instance_tags", instance_id) is None
+  assert registry.get_desktop("user00000", "new1") is None
+  assert registry.get_desktop(warmpool.pool_username(), "pool1")["state"] == "stopped"
+
+def test_tags_cached_before_a_claim_on_another_host_are_read_again(world, configure):
+  instance_id, machine_def = add_pooled_desktop(world, configure)
+  processor = MessageProcessor("events")
+  assert processor.get_tags(instance_id)[0]["Username"] == warmpool.pool_username()
+  # another host claims it, this host's cache still has the pool's tags
+  cached = localcache.get("instance_tags", instance_id)
+  warmpool.claim("user00000", "new1", machine_def, "1280x720")
+  localcache.put("instance_tags", instance_id, cached)
+  tags, details = processor.get_tags(instance_id)
+  assert tags["Username"] == "user00000" and details is not None
+  assert localcache.get("instance_tags", instance_id)["Username"] == "user00000"
+  assert warmpool.provisioned_as(instance_id, "new1", "user00000") == ("pool1", warmpool.pool_username())
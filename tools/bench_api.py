@@ -0,0 +1,295 @@
+"""
+Offline benchmark for every API route
+
+Drives the Flask app against the in-process AWS stand-in from fakeaws.py and
+reports throughput and p50/p99 latency per route and concurrency level. No
+network access is needed.
+
+  python tools/bench_api.py                        # Flask test client
+  python tools/bench_api.py --mode gunicorn        # real gunicorn + gevent workers
+  python tools/bench_api.py --users 2000 --desktops-per-user 3 --latency ec2=0.08,dynamodb=0.006
+  python tools/bench_api.py --registry off --limits ec2:DescribeInstances=20   # AWS throttling
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import logging
+import subprocess
+import http.client
+
+import gevent
+from gevent.pool import Pool
+
+import fakeaws
+from benchlib import summarise, print_table, write_json
+
+fakeaws.add_repo_to_path()
+
+DEFAULT_LATENCY = "dynamodb=0.005,ec2=0.060,ecs=0.150,sqs=0.010,sns=0.010"
+
+
+def routes(fleet, rnd):
+  """
+  Returns (name, method, path builder, body builder, admin) for every route
+  """
+  usernames = list(fleet.keys())
+
+  def any_user():
+    return rnd.choice(usernames)
+
+  def any_desktop(username):
+    return rnd.choice(list(fleet[username]["desktops"].keys()))
+
+  return [
+    ("GET /", "GET", lambda u: "/", None, False),
+    ("GET /entitlement", "GET", lambda u: "/entitlement", None, False),
+    ("GET /instance", "GET", lambda u: "/instance", None, False),
+    ("GET /instance/<id>", "GET", lambda u: f"/instance/{any_desktop(u)}", None, False),
+    ("PATCH /instance/<id>", "PATCH", lambda u: f"/instance/{any_desktop(u)}", lambda u: {"state": rnd.choice(["running", "stopped"])}, False),
+    ("POST /instance", "POST", lambda u: "/instance", lambda u: {"action": "create", "machine_def_id": "md0", "screen_geometry": "1920x1080"}, False),
+    ("DELETE /instance/<id>", "DELETE", lambda u: f"/instance/{any_desktop(u)}", None, False),
+    ("GET /_refresh", "GET", lambda u: "/_refresh", None, True)
+  ], any_user
+
+
+def selected(route_list, names):
+  if not names:
+    return route_list
+  return [r for r in route_list if r[0] in names]
+
+
+def headers_for(fleet, username, admin):
+  groups = fleet[username]["group"]
+  if admin:
+    groups = groups + ",admins"
+  return {
+    "x-remote-user": username,
+    "x-remote-user-groups": groups,
+    "Content-Type": "application/json"
+  }
+
+
+def setup_world(args):
+  world = fakeaws.install(latency=fakeaws.parse_latency(args.latency), limits=fakeaws.parse_latency(args.limits))
+  fleet = world.seed(
+    table=os.environ["TABLE_NAME"],
+    env_key=os.environ["ENV_KEY"],
+    users=args.users,
+    desktops_per_user=args.desktops_per_user,
+    groups=args.groups,
+    roles=args.roles,
+    machine_defs=args.machine_defs
+  )
+  return world, fleet
+
+
+def run_level(name, total, concurrency, one_request):
+  """
+  Run total requests through one_request() with a fixed number of greenlets
+  one_request() returns the HTTP status, 0 if the request failed outright
+  """
+  latencies = []
+  errors = [0]
+  unavailable = [0]
+
+  def task(_):
+    start = time.perf_counter()
+    status = one_request()
+    latencies.append(time.perf_counter() - start)
+    if not status or status >= 400:
+      errors[0] += 1
+    if status == 503:
+      unavailable[0] += 1
+
+  pool = Pool(concurrency)
+  start = time.perf_counter()
+  for i in range(total):
+    pool.spawn(task, i)
+  pool.join()
+  return summarise(name, latencies, time.perf_counter() - start, errors[0], concurrency=concurrency, unavailable=unavailable[0])
+
+
+def prepare_registry(args):
+  """
+  Reconcile the desktop registry up front so lookups use it, as in production
+  """
+  import registry
+  if args.registry == "on":
+    registry.reconcile()
+  else:
+    os.environ["DESKTOP_REGISTRY"] = "False"
+
+
+def bench_test_client(args):
+  world, fleet = setup_world(args)
+  from app import app
+  logging.getLogger().setLevel(args.log_level)
+  prepare_registry(args)
+  world.calls.clear()
+  rnd = random.Random(args.seed)
+  route_list, any_user = routes(fleet, rnd)
+  route_list = selected(route_list, args.routes)
+  rows = []
+  for route_name, method, path, body, admin in route_list:
+    for concurrency in args.concurrency:
+      def one_request():
+        username = any_user()
+        client = app.test_client()
+        response = client.open(
+          path(username),
+          method=method,
+          headers=headers_for(fleet, username, admin),
+          data=json.dumps(body(username)) if body else None
+        )
+        return response.status_code
+      rows.append(run_level(route_name, args.requests, concurrency, one_request))
+  return rows, world
+
+
+def serve(args):
+  """
+  Run the app under gunicorn with gevent workers against the fake
+  """
+  setup_world(args)
+  from wrapper import GUnicornFlaskApplication
+  from app import app
+  logging.getLogger().setLevel(args.log_level)
+  prepare_registry(args)
+  GUnicornFlaskApplication(app).run(
+    worker_class="gevent",
+    workers=args.workers,
+    bind=[f"127.0.0.1:{args.port}"],
+    loglevel="warning"
+  )
+
+
+def wait_for_port(port, timeout=30):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      socket.create_connection(("127.0.0.1", port), timeout=1).close()
+      return True
+    except OSError:
+      time.sleep(0.1)
+  return False
+
+
+def bench_gunicorn(args):
+  # the fleet is rebuilt in the server from the same seed so ids line up
+  world = fakeaws.FakeWorld()
+  fleet = world.seed(
+    table=fakeaws.DEFAULT_ENV["TABLE_NAME"],
+    env_key=fakeaws.DEFAULT_ENV["ENV_KEY"],
+    users=args.users,
+    desktops_per_user=args.desktops_per_user,
+    groups=args.groups,
+    roles=args.roles,
+    machine_defs=args.machine_defs
+  )
+  command = [sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port)] + args.passthrough
+  server = subprocess.Popen(command)
+  try:
+    if not wait_for_port(args.port):
+      raise RuntimeError("gunicorn did not start listening")
+    rnd = random.Random(args.seed)
+    route_list, any_user = routes(fleet, rnd)
+    route_list = selected(route_list, args.routes)
+    rows = []
+    for route_name, method, path, body, admin in route_list:
+      for concurrency in args.concurrency:
+        connections = {}
+
+        def one_request():
+          # one keep-alive connection per greenlet
+          current = gevent.getcurrent()
+          if current not in connections:
+            connections[current] = http.client.HTTPConnection("127.0.0.1", args.port, timeout=60)
+          conn = connections[current]
+          username = any_user()
+          try:
+            conn.request(
+              method,
+              path(username),
+              body=json.dumps(body(username)) if body else None,
+              headers=headers_for(fleet, username, admin)
+            )
+            response = conn.getresponse()
+            response.read()
+            return response.status
+          except (OSError, http.client.HTTPException):
+            conn.close()
+            del connections[current]
+            return 0
+        rows.append(run_level(route_name, args.requests, concurrency, one_request))
+        for conn in connections.values():
+          conn.close()
+    return rows, None
+  finally:
+    server.terminate()
+    server.wait()
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--mode", choices=["testclient", "gunicorn"], default="testclient")
+  parser.add_argument("--requests", type=int, default=50, help="requests per route per concurrency level")
+  parser.add_argument("--routes", help='only run these comma separated routes, e.g. "GET /instance,POST /instance"')
+  parser.add_argument("--concurrency", default="1,10,50", help="comma separated concurrency levels")
+  parser.add_argument("--latency", default=DEFAULT_LATENCY, help="injected seconds per service call, e.g. ec2=0.05")
+  parser.add_argument("--limits", default="", help="calls per second before the fake throttles, e.g. ec2:DescribeInstances=20")
+  parser.add_argument("--users", type=int, default=500)
+  parser.add_argument("--desktops-per-user", type=int, default=2)
+  parser.add_argument("--groups", type=int, default=50)
+  parser.add_argument("--roles", type=int, default=20)
+  parser.add_argument("--machine-defs", type=int, default=8)
+  parser.add_argument("--workers", type=int, default=1, help="gunicorn workers (gunicorn mode)")
+  parser.add_argument("--port", type=int, default=5099)
+  parser.add_argument("--registry", choices=["on", "off"], default="on", help="use the DynamoDB desktop registry or EC2 tag scans")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--log-level", default="WARNING")
+  parser.add_argument("--json", help="also write results to this file")
+  parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+  args.concurrency = [int(c) for c in args.concurrency.split(",")]
+  args.routes = [r.strip() for r in args.routes.split(",")] if args.routes else None
+  # settings the gunicorn server process needs to rebuild the same world
+  args.passthrough = [
+    "--latency", args.latency,
+    "--limits", args.limits,
+    "--users", str(args.users),
+    "--desktops-per-user", str(args.desktops_per_user),
+    "--groups", str(args.groups),
+    "--roles", str(args.roles),
+    "--machine-defs", str(args.machine_defs),
+    "--workers", str(args.workers),
+    "--log-level", args.log_level,
+    "--registry", args.registry
+  ]
+  return args
+
+
+def main(argv=None):
+  args = parse_args(argv if argv is not None else sys.argv[1:])
+  if args.serve:
+    serve(args)
+    return
+  if args.mode == "gunicorn":
+    rows, world = bench_gunicorn(args)
+  else:
+    rows, world = bench_test_client(args)
+  print_table(rows, ["name", "concurrency", "requests", "errors", "unavailable", "rps", "p50_ms", "p99_ms"])
+  if world:
+    print()
+    print("AWS calls: " + ", ".join(f"{k}={v}" for k, v in sorted(world.calls.items())))
+  write_json(args.json, rows)
+
+
+if __name__ == "__main__":
+  main()
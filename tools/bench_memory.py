@@ -0,0 +1,113 @@
+"""
+Desktop record memory benchmark
+
+Seeds the AWS stand-in with --desktops desktops and measures, with
+tracemalloc, what the worker keeps for them: an instance listing built from
+a describe_instances scan (the full tag dict and security groups per
+instance, then a cleaned copy) against Desktop records, and a tag cache of
+full tag dicts against InstanceTags. Also times serialising the listing. No
+network access needed.
+
+  python tools/bench_memory.py --desktops 10000
+"""
+import gc
+import os
+import copy
+import time
+import argparse
+import tracemalloc
+
+import fakeaws
+from benchlib import print_table, write_json
+
+fakeaws.add_repo_to_path()
+
+
+def dict_listing(descriptions):
+  """
+  What instance.scan_for_instances_with_tags and clean_up_instances built before records
+  """
+  details = []
+  for instance in descriptions:
+    details.append({
+      "instanceid": instance["InstanceId"],
+      "dns": instance["PrivateDnsName"],
+      "launchtime": instance["LaunchTime"],
+      "state": instance["State"]["Name"],
+      "tags": {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])},
+      "securitygroups": instance["SecurityGroups"],
+      "hibernation": instance.get("HibernationOptions", {}).get("Configured", False)
+    })
+  return {
+    d["tags"]["DesktopId"]: {
+      "instanceid": d["instanceid"],
+      "dns": d["dns"],
+      "launchtime": d["launchtime"],
+      "state": d["state"],
+      "screengeometry": d["tags"]["ScreenGeometry"],
+      "machine_def_id": d["tags"]["MachineDef"],
+      "hibernation": d["hibernation"]
+    }
+    for d in details
+  }, details
+
+
+def measure(build):
+  """
+  Bytes still allocated by what build returns, and the peak while building it
+  """
+  gc.collect()
+  tracemalloc.start()
+  result = build()
+  kept = tracemalloc.get_traced_memory()[0]
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return result, kept, peak
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--desktops", type=int, default=10000)
+  parser.add_argument("--json", help="also write results to this file")
+  args = parser.parse_args(argv)
+
+  world = fakeaws.install()
+  world.seed(table=os.environ["TABLE_NAME"], env_key=os.environ["ENV_KEY"], users=args.desktops // 2, desktops_per_user=2, machine_defs=5)
+  # a copy as boto3 would return it, the stand-in shares some objects between calls
+  descriptions = copy.deepcopy(list(world.instances.values()))
+  for instance in descriptions:
+    # every instance gets its own strings, as parsed from an API response
+    for tag in instance["Tags"]:
+      tag["Value"] = "".join(tag["Value"])
+    instance["State"]["Name"] = "".join(instance["State"]["Name"])
+
+  from records import Desktop, InstanceTags
+  from instance import clean_up_instances
+  from serializer import json_dumps
+
+  rows = []
+  (listing, _), kept, peak = measure(lambda: dict_listing(descriptions))
+  start = time.perf_counter()
+  json_dumps(listing)
+  rows.append({"case": "listing", "representation": "dicts", "kept_kb": kept // 1024, "peak_kb": peak // 1024, "per_desktop_b": kept // len(descriptions), "dumps_ms": round((time.perf_counter() - start) * 1000, 1)})
+  del listing
+
+  listing, kept, peak = measure(lambda: clean_up_instances([Desktop.from_ec2(instance) for instance in descriptions]))
+  start = time.perf_counter()
+  json_dumps(listing)
+  rows.append({"case": "listing", "representation": "Desktop", "kept_kb": kept // 1024, "peak_kb": peak // 1024, "per_desktop_b": kept // len(descriptions), "dumps_ms": round((time.perf_counter() - start) * 1000, 1)})
+  del listing
+
+  tag_cache, kept, peak = measure(lambda: {i["InstanceId"]: {t["Key"]: t["Value"] for t in i["Tags"]} for i in descriptions})
+  rows.append({"case": "tag cache", "representation": "dicts", "kept_kb": kept // 1024, "peak_kb": peak // 1024, "per_desktop_b": kept // len(descriptions), "dumps_ms": None})
+  del tag_cache
+
+  tag_cache, kept, peak = measure(lambda: {i["InstanceId"]: InstanceTags({t["Key"]: t["Value"] for t in i["Tags"]}) for i in descriptions})
+  rows.append({"case": "tag cache", "representation": "InstanceTags", "kept_kb": kept // 1024, "peak_kb": peak // 1024, "per_desktop_b": kept // len(descriptions), "dumps_ms": None})
+
+  print_table(rows, ["case", "representation", "kept_kb", "peak_kb", "per_desktop_b", "dumps_ms"])
+  write_json(args.json, rows)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,110 @@
+"""
+Provisioning backend benchmark
+
+Runs the app in-process against the AWS stand-in and has --users users each
+request a desktop at once, then reports how long each took from POST
+/instance until GET /instance/<id> returns it. One-shot tasks take
+--cold-start-seconds plus --terraform-seconds; queued jobs on the long-running
+workers only take --terraform-seconds but wait for one of --workers to be
+free. No network access needed.
+
+  python tools/bench_provisioning.py --users 10 --workers 4
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import gevent
+
+import fakeaws
+from benchlib import percentile, print_table, write_json
+
+fakeaws.add_repo_to_path()
+
+CASES = {
+  "task": {"PROVISION_BACKEND": "task"},
+  "queue": {"PROVISION_BACKEND": "queue", "PROVISION_QUEUE_NAME": "provisioning"},
+  "queue+batch": {"PROVISION_BACKEND": "queue", "PROVISION_QUEUE_NAME": "provisioning", "PROVISION_BATCH_MS": "200"}
+}
+
+
+def run(args, case):
+  """
+  One case in a fresh process, prints a JSON result line
+  """
+  os.environ.update(CASES[case])
+  world = fakeaws.install(latency=fakeaws.parse_latency(args.latency))
+  world.emit_events = True
+  world.provision_seconds = args.cold_start_seconds + args.terraform_seconds
+  table = os.environ["TABLE_NAME"]
+  fleet = world.seed(table=table, env_key=os.environ["ENV_KEY"], users=args.users, desktops_per_user=0, machine_defs=1)
+  if case != "task":
+    queue_url = world.client("sqs").create_queue(QueueName="provisioning")["QueueUrl"]
+    world.start_workers(queue_url, args.workers, args.terraform_seconds, table)
+  logging.getLogger().setLevel(args.log_level)
+
+  from app import app
+  from messageprocessor import get_processor
+  from sqs import SqsHandler
+  import registry
+  registry.reconcile()
+  events_url = SqsHandler(topic_name=os.environ["EC2_SNS_TOPIC"], kms_id=os.environ["KMS_KEY_ID"]).setup()
+  gevent.spawn(get_processor(queueurl=events_url).run)
+  client = app.test_client()
+
+  def request_desktop(username):
+    headers = {"x-remote-user": username, "x-remote-user-groups": fleet[username]["group"], "Content-Type": "application/json"}
+    started = time.perf_counter()
+    response = client.post("/instance", headers=headers, data=json.dumps({
+      "action": "create", "machine_def_id": "md0", "screen_geometry": "1280x720"
+    }))
+    desktop_id = response.get_json()["desktop_id"]
+    while client.get(f"/instance/{desktop_id}", headers=headers).status_code != 200:
+      gevent.sleep(0.05)
+    return time.perf_counter() - started
+
+  jobs = [gevent.spawn(request_desktop, username) for username in fleet]
+  gevent.joinall(jobs, raise_error=True)
+  samples = [job.value for job in jobs]
+  print(json.dumps({
+    "case": case,
+    "desktops": len(samples),
+    "p50_s": round(percentile(samples, 50), 3),
+    "max_s": round(max(samples), 3),
+    "run_task_calls": world.calls.get("ecs:RunTask", 0),
+    "jobs_queued": world.calls.get("sqs:SendMessage", 0)
+  }))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--users", type=int, default=10, help="users each asking for one desktop at once")
+  parser.add_argument("--workers", type=int, default=4, help="long-running provisioning workers")
+  parser.add_argument("--cold-start-seconds", type=float, default=2.0, help="scheduling, image pull and terraform init")
+  parser.add_argument("--terraform-seconds", type=float, default=1.0, help="terraform apply itself")
+  parser.add_argument("--latency", default="dynamodb=0.005,ec2=0.060,ecs=0.150,sqs=0.010,sns=0.010")
+  parser.add_argument("--log-level", default="WARNING")
+  parser.add_argument("--json", help="also write results to this file")
+  parser.add_argument("--case", choices=sorted(CASES), help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+  if args.case:
+    run(args, args.case)
+    return
+  import subprocess
+  rows = []
+  for case in CASES:
+    command = [sys.executable, os.path.abspath(__file__), "--case", case] + sys.argv[1:]
+    output = subprocess.run(command, check=True, capture_output=True, text=True, env=dict(os.environ, LOCAL_CACHE_PATH="")).stdout
+    rows.append(json.loads(output.strip().splitlines()[-1]))
+  print_table(rows, ["case", "desktops", "p50_s", "max_s", "run_task_calls", "jobs_queued"])
+  write_json(args.json, rows)
+
+
+if __name__ == "__main__":
+  main()
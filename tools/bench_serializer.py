@@ -0,0 +1,101 @@
+"""
+JSON serialisation benchmark
+
+Compares the old response path (flask.jsonify plus the header override) with
+utils.success_json_response on each serializer backend, for an instance
+listing of --desktops desktops, and the old per-listener json.dumps/format_sse
+fan-out with encoding an SSE frame once and sharing the bytes. Also checks
+that every backend produces the same JSON as jsonify. No network access
+needed.
+
+  python tools/bench_serializer.py --desktops 20 --listeners 50
+"""
+import json
+import time
+import argparse
+import datetime
+
+import fakeaws
+from benchlib import print_table, write_json
+
+fakeaws.add_repo_to_path()
+
+
+def listing(desktops):
+  launched = datetime.datetime(2021, 3, 1, 9, 30, tzinfo=datetime.timezone.utc)
+  return {
+    f"desk{n:04d}": {
+      "instanceid": f"i-{n:017x}",
+      "dns": f"ip-10-0-{n // 250}-{n % 250}.eu-west-2.compute.internal",
+      "launchtime": launched + datetime.timedelta(minutes=n),
+      "state": "running",
+      "screengeometry": "1920x1080",
+      "machine_def_id": f"md{n % 8}"
+    }
+    for n in range(desktops)
+  }
+
+
+def timed(fn, iterations):
+  start = time.perf_counter()
+  for _ in range(iterations):
+    fn()
+  return (time.perf_counter() - start) / iterations
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--desktops", type=int, default=20, help="desktops in the listing response")
+  parser.add_argument("--listeners", type=int, default=50, help="SSE listeners sharing one event")
+  parser.add_argument("--iterations", type=int, default=2000)
+  parser.add_argument("--json", help="also write results to this file")
+  args = parser.parse_args(argv)
+
+  fakeaws.install()
+  from flask import Flask, make_response, jsonify
+  import serializer
+  from utils import success_json_response, format_sse, encode_sse
+
+  app = Flask(__name__)
+  payload = listing(args.desktops)
+  event = {"desktop_id": "desk0001", "state": "running", "instance_id": "i-00000000000000001"}
+  rows = []
+
+  def old_response():
+    response = make_response(jsonify(payload), 200)
+    response.headers["Content-type"] = "application/json"
+    return response
+
+  with app.app_context():
+    expected = old_response().get_data()
+    rows.append({"case": "response", "path": "jsonify", "us": timed(old_response, args.iterations) * 1e6, "same_output": True})
+    for name in sorted(serializer.backends):
+      serializer.current = serializer.backends[name]
+      body = success_json_response(payload).get_data()
+      rows.append({
+        "case": "response",
+        "path": name,
+        "us": timed(lambda: success_json_response(payload), args.iterations) * 1e6,
+        "same_output": json.loads(body) == json.loads(expected) and body == expected
+      })
+
+  def old_fan_out():
+    return [format_sse(json.dumps(event), "message") for _ in range(args.listeners)]
+
+  rows.append({"case": f"sse x{args.listeners}", "path": "json per listener", "us": timed(old_fan_out, args.iterations) * 1e6, "same_output": True})
+  for name in sorted(serializer.backends):
+    dumps = serializer.backends[name]
+
+    def shared_fan_out():
+      chunk = encode_sse(dumps(event), "message")
+      return [chunk for _ in range(args.listeners)]
+    rows.append({"case": f"sse x{args.listeners}", "path": f"{name} once", "us": timed(shared_fan_out, args.iterations) * 1e6, "same_output": True})
+
+  for row in rows:
+    row["us"] = round(row["us"], 2)
+  print_table(rows, ["case", "path", "us", "same_output"])
+  write_json(args.json, rows)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,202 @@
+"""
+Worker startup benchmark
+
+Measures, in fresh processes against the in-process AWS stand-in, how long it
+takes to import the app, to run the warm-up hook, and to answer the first
+requests either cold or after warm-up. The gunicorn mode measures the time
+from process start to the first successful response. The queue mode times
+getting the event queue ready in the gunicorn master, a new queue per start
+against the durable queue on its first and later starts. No network access
+needed.
+
+  python tools/bench_startup.py --runs 10
+  python tools/bench_startup.py --mode gunicorn --latency dynamodb=0.02
+  python tools/bench_startup.py --mode queue --subscriptions 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import http.client
+
+import fakeaws
+from benchlib import percentile, print_table, write_json
+
+DEFAULT_LATENCY = "dynamodb=0.010,ec2=0.060,ecs=0.150,sqs=0.010,sns=0.010"
+HEADERS = {"x-remote-user": "user00000", "x-remote-user-groups": "group0"}
+
+
+def child(args):
+  """
+  One measurement, runs in its own process and prints JSON to stdout
+  """
+  started = time.perf_counter()
+  from gevent import monkey
+  monkey.patch_all()
+  fakeaws.add_repo_to_path()
+  world = fakeaws.install(latency=fakeaws.parse_latency(args.latency))
+  world.seed(table=os.environ["TABLE_NAME"], env_key=os.environ["ENV_KEY"], users=50)
+  import logging
+  logging.disable(logging.CRITICAL)
+  seeded = time.perf_counter()
+
+  import app as app_module
+  imported = time.perf_counter()
+  result = {"import_s": imported - seeded}
+
+  if args.warm:
+    app_module.warm_up()
+    result["warm_up_s"] = time.perf_counter() - imported
+  client = app_module.app.test_client()
+  for name, path in [("first_root_s", "/"), ("first_instance_s", "/instance")]:
+    before = time.perf_counter()
+    response = client.get(path, headers=HEADERS)
+    result[name] = time.perf_counter() - before
+    result[name.replace("_s", "_status")] = response.status_code
+  result["total_s"] = time.perf_counter() - started
+  print(json.dumps(result))
+
+
+def queue_child(args):
+  """
+  Times SqsHandler.setup() with and without a durable queue, prints JSON
+  """
+  from gevent import monkey
+  monkey.patch_all()
+  fakeaws.add_repo_to_path()
+  world = fakeaws.install(latency=fakeaws.parse_latency(args.latency))
+  topic = os.environ["EC2_SNS_TOPIC"]
+  # other hosts' subscriptions which have to be paged past
+  for n in range(args.subscriptions):
+    world.subscriptions[f"{topic}:other{n}"] = {
+      "SubscriptionArn": f"{topic}:other{n}",
+      "TopicArn": topic,
+      "Protocol": "sqs",
+      "Endpoint": f"arn:aws:sqs:{fakeaws.REGION}:{fakeaws.ACCOUNT}:other{n}"
+    }
+  from sqs import SqsHandler
+  result = {}
+  for name, queue_name in [("new_queue_s", None), ("durable_first_s", "bench_events"), ("durable_restart_s", "bench_events")]:
+    handler = SqsHandler(topic_name=topic, kms_id=os.environ["KMS_KEY_ID"], queue_name=queue_name)
+    before = time.perf_counter()
+    handler.setup()
+    result[name] = time.perf_counter() - before
+  print(json.dumps(result))
+
+
+def measure_queue(args):
+  command = [sys.executable, os.path.abspath(__file__), "--queue-child", "--latency", args.latency, "--subscriptions", str(args.subscriptions)]
+  output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_in_process(args, warm):
+  command = [sys.executable, os.path.abspath(__file__), "--child", "--latency", args.latency]
+  if warm:
+    command.append("--warm")
+  output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+  return json.loads(output.strip().splitlines()[-1])
+
+
+def serve(args):
+  from gevent import monkey
+  monkey.patch_all()
+  fakeaws.add_repo_to_path()
+  world = fakeaws.install(latency=fakeaws.parse_latency(args.latency))
+  world.seed(table=os.environ["TABLE_NAME"], env_key=os.environ["ENV_KEY"], users=50)
+  import logging
+  from wrapper import GUnicornFlaskApplication
+  from app import app, warm_up
+  from gevent import Greenlet
+  logging.disable(logging.CRITICAL)
+  GUnicornFlaskApplication(app).run(
+    worker_class="gevent",
+    workers=args.workers,
+    bind=[f"127.0.0.1:{args.port}"],
+    loglevel="warning",
+    post_worker_init=lambda worker: Greenlet.spawn(warm_up)
+  )
+
+
+def measure_gunicorn(args):
+  """
+  Time from spawning gunicorn to the first 200 from GET /
+  """
+  started = time.perf_counter()
+  command = [sys.executable, os.path.abspath(__file__), "--serve", "--latency", args.latency, "--port", str(args.port), "--workers", str(args.workers)]
+  server = subprocess.Popen(command)
+  try:
+    listening = None
+    while time.perf_counter() - started < 60:
+      try:
+        conn = http.client.HTTPConnection("127.0.0.1", args.port, timeout=10)
+        conn.request("GET", "/", headers=HEADERS)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        if listening is None:
+          listening = time.perf_counter() - started
+        if response.status == 200:
+          return {"listening_s": listening, "first_ok_s": time.perf_counter() - started}
+      except (OSError, http.client.HTTPException):
+        time.sleep(0.01)
+    raise RuntimeError("gunicorn did not answer in time")
+  finally:
+    server.terminate()
+    server.wait()
+
+
+def summarise_runs(label, runs):
+  rows = []
+  for key in runs[0]:
+    if key.endswith("_s"):
+      samples = [r[key] for r in runs]
+      rows.append({
+        "case": label,
+        "metric": key[:-2],
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p90_ms": round(percentile(samples, 90) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2)
+      })
+  return rows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--mode", choices=["process", "gunicorn", "queue"], default="process")
+  parser.add_argument("--runs", type=int, default=5)
+  parser.add_argument("--latency", default=DEFAULT_LATENCY)
+  parser.add_argument("--workers", type=int, default=1)
+  parser.add_argument("--port", type=int, default=5097)
+  parser.add_argument("--subscriptions", type=int, default=50, help="other subscriptions on the topic in queue mode")
+  parser.add_argument("--json", help="also write results to this file")
+  parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--warm", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--queue-child", action="store_true", help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+  if args.child:
+    child(args)
+    return
+  if args.serve:
+    serve(args)
+    return
+  if args.queue_child:
+    queue_child(args)
+    return
+  rows = []
+  if args.mode == "queue":
+    rows += summarise_runs("queue", [measure_queue(args) for _ in range(args.runs)])
+  elif args.mode == "gunicorn":
+    rows += summarise_runs("gunicorn", [measure_gunicorn(args) for _ in range(args.runs)])
+  else:
+    rows += summarise_runs("cold", [measure_in_process(args, warm=False) for _ in range(args.runs)])
+    rows += summarise_runs("warmed", [measure_in_process(args, warm=True) for _ in range(args.runs)])
+  print_table(rows, ["case", "metric", "p50_ms", "p90_ms", "max_ms"])
+  write_json(args.json, rows)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,123 @@
+"""
+Warm pool time-to-desktop benchmark
+
+Runs the app in-process against the AWS stand-in with provisioning simulated:
+each instance-manager task creates (or terminates) its instance after
+--provision-seconds and the state change reaches the worker's queue. Requests
+desktops for --users users and reports how long each took from POST /instance
+until GET /instance/<id> returns it, with and without a warm pool of
+--pool-size stopped desktops. No network access needed.
+
+  python tools/bench_warmpool.py --provision-seconds 3 --users 4 --pool-size 4
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import gevent
+
+import fakeaws
+from benchlib import percentile, print_table, write_json
+
+fakeaws.add_repo_to_path()
+
+
+def run(args, pool_size):
+  """
+  One case in a fresh process, prints a JSON result line
+  """
+  os.environ["WARM_POOL_ENABLED"] = "True" if pool_size else "False"
+  world = fakeaws.install(latency=fakeaws.parse_latency(args.latency))
+  world.provision_seconds = args.provision_seconds
+  world.emit_events = True
+  table = os.environ["TABLE_NAME"]
+  fleet = world.seed(table=table, env_key=os.environ["ENV_KEY"], users=args.users, desktops_per_user=0, machine_defs=1)
+  if pool_size:
+    item = world.tables[table][("machine_def", "md0")]
+    item["warm_pool_size"] = {"N": str(pool_size)}
+  logging.getLogger().setLevel(args.log_level)
+
+  from app import app
+  from messageprocessor import get_processor
+  from sqs import SqsHandler
+  import registry
+  import warmpool
+  registry.reconcile()
+  queue_url = SqsHandler(topic_name=os.environ["EC2_SNS_TOPIC"], kms_id=os.environ["KMS_KEY_ID"]).setup()
+  gevent.spawn(get_processor(queueurl=queue_url).run)
+
+  filled = None
+  if pool_size:
+    # provision, stop and mark the pool ready, as the writer would
+    started = time.perf_counter()
+    machine_def = registry.get_ddb_item(table, domain="machine_def", sub_id="md0")
+    while True:
+      warmpool.replenish(machine_def)
+      slots = warmpool.get_slots("md0")
+      if len(slots) == pool_size and all(s["state"] == "ready" for s in slots):
+        break
+      gevent.sleep(0.2)
+      # the fake does not finish stopping instances on its own
+      for instance in world.instances.values():
+        if instance["State"]["Name"] == "stopping":
+          instance["State"] = {"Name": "stopped"}
+          world.emit_state_change(instance["InstanceId"], "stopped")
+    filled = time.perf_counter() - started
+
+  client = app.test_client()
+
+  def request_desktop(username):
+    headers = {"x-remote-user": username, "x-remote-user-groups": fleet[username]["group"], "Content-Type": "application/json"}
+    started = time.perf_counter()
+    response = client.post("/instance", headers=headers, data=json.dumps({
+      "action": "create", "machine_def_id": "md0", "screen_geometry": "1280x720"
+    }))
+    desktop_id = response.get_json()["desktop_id"]
+    while client.get(f"/instance/{desktop_id}", headers=headers).status_code != 200:
+      gevent.sleep(0.05)
+    return time.perf_counter() - started
+
+  jobs = [gevent.spawn(request_desktop, username) for username in fleet]
+  gevent.joinall(jobs, raise_error=True)
+  samples = [job.value for job in jobs]
+  print(json.dumps({
+    "case": f"pool of {pool_size}" if pool_size else "no pool",
+    "desktops": len(samples),
+    "p50_s": round(percentile(samples, 50), 3),
+    "max_s": round(max(samples), 3),
+    "pool_fill_s": round(filled, 3) if filled else None,
+    "run_task_calls": world.calls.get("ecs:RunTask", 0)
+  }))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--provision-seconds", type=float, default=3.0, help="how long a provisioning task takes")
+  parser.add_argument("--users", type=int, default=4, help="users each asking for one desktop at once")
+  parser.add_argument("--pool-size", type=int, default=4)
+  parser.add_argument("--latency", default="dynamodb=0.005,ec2=0.060,ecs=0.150,sqs=0.010,sns=0.010")
+  parser.add_argument("--log-level", default="WARNING")
+  parser.add_argument("--json", help="also write results to this file")
+  parser.add_argument("--case", type=int, help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+  if args.case is not None:
+    run(args, args.case)
+    return
+  import subprocess
+  rows = []
+  for pool_size in (0, args.pool_size):
+    command = [sys.executable, os.path.abspath(__file__), "--case", str(pool_size)] + sys.argv[1:]
+    output = subprocess.run(command, check=True, capture_output=True, text=True, env=dict(os.environ, LOCAL_CACHE_PATH="")).stdout
+    rows.append(json.loads(output.strip().splitlines()[-1]))
+  print_table(rows, ["case", "desktops", "p50_s", "max_s", "pool_fill_s", "run_task_calls"])
+  write_json(args.json, rows)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,75 @@
+"""
+Helpers shared by the benchmark scripts in this directory
+"""
+import json
+import resource
+
+
+def percentile(samples, pct):
+  """
+  Nearest-rank percentile of a list of numbers, None when empty
+  """
+  if not samples:
+    return None
+  ordered = sorted(samples)
+  rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+  return ordered[rank]
+
+
+def summarise(name, latencies, elapsed, errors=0, **extra):
+  """
+  Build a result row from a list of per-request latencies in seconds
+  """
+  row = {
+    "name": name,
+    "requests": len(latencies),
+    "errors": errors,
+    "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    "p50_ms": _ms(percentile(latencies, 50)),
+    "p99_ms": _ms(percentile(latencies, 99))
+  }
+  row.update(extra)
+  return row
+
+
+def _ms(seconds):
+  return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def print_table(rows, columns):
+  """
+  Print rows (list of dicts) as a fixed width table
+  """
+  widths = {c: max(len(c), *(len(_fmt(r.get(c))) for r in rows)) for c in columns} if rows else {c: len(c) for c in columns}
+  print("  ".join(c.ljust(widths[c]) for c in columns))
+  print("  ".join("-" * widths[c] for c in columns))
+  for row in rows:
+    print("  ".join(_fmt(row.get(c)).ljust(widths[c]) for c in columns))
+
+
+def _fmt(value):
+  if value is None:
+    return "-"
+  if isinstance(value, float):
+    return f"{value:.2f}"
+  return str(value)
+
+
+def write_json(path, rows):
+  if path:
+    with open(path, "w") as f:
+      json.dump(rows, f, indent=2, default=str)
+
+
+def rss_mb():
+  """
+  Current resident set size of this process in MB (falls back to peak RSS)
+  """
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1]) / 1024.0
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
@@ -1,19 +1,102 @@
+"""
+Deletes event queues left behind by processes which did not shut down cleanly,
+along with their SNS subscriptions.
+
+Every page of ListQueues is followed and the deletes run concurrently. Queues
+younger than --min-age seconds (default an hour) are kept so a running
+process' queue is not pulled from under it, pass --min-age 0 to delete every
+match. Durable queues (EVENT_QUEUE_NAME) are not matched by the default prefix.
+
+  python tools/delete_queues.py --dry-run
+  python tools/delete_queues.py --topic arn:aws:sns:eu-west-2:123456789012:ec2-state
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 
-sqs = boto3.client("sqs")
-
-def find_and_remove():
-  response = sqs.list_queues(
-    QueueNamePrefix="ec2_",
-    MaxResults=100
-  )
-  if "QueueUrls" in response:
-    for qurl in response["QueueUrls"]:
-      print(f"Going to delete queue @ {qurl} ...")
-      sqs.delete_queue(
-        QueueUrl=qurl
-      )
-      print("...Deleted.")
+# a running process' queue is younger than this, or at least is not worth the risk
+DEFAULT_MIN_AGE = 3600
+
+
+def list_queue_urls(sqs, prefix):
+  params = {"QueueNamePrefix": prefix, "MaxResults": 1000}
+  while True:
+    response = sqs.list_queues(**params)
+    yield from response.get("QueueUrls", [])
+    if "NextToken" not in response:
+      return
+    params["NextToken"] = response["NextToken"]
+
+
+def list_subscriptions(sns, topic):
+  """
+  Maps queue ARN to subscription ARN for the topic's SQS subscriptions
+  """
+  subscriptions = {}
+  params = {"TopicArn": topic}
+  while True:
+    response = sns.list_subscriptions_by_topic(**params)
+    for subscription in response.get("Subscriptions", []):
+      if subscription["Protocol"].lower() == "sqs":
+        subscriptions[subscription["Endpoint"]] = subscription["SubscriptionArn"]
+    if "NextToken" not in response:
+      return subscriptions
+    params["NextToken"] = response["NextToken"]
+
+
+def remove_queue(sqs, sns, queue_url, subscriptions, min_age, dry_run):
+  """
+  Returns True if the queue was (or, with dry_run, would be) deleted
+  """
+  try:
+    attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["QueueArn", "CreatedTimestamp"])["Attributes"]
+  except Exception as err:
+    # deleted since it was listed, e.g. its process shut down cleanly
+    print(f"Skipping {queue_url}: {err}")
+    return False
+  age = time.time() - int(attributes.get("CreatedTimestamp", 0))
+  if age < min_age:
+    print(f"Keeping {queue_url}, only {int(age)}s old")
+    return False
+  sub_arn = subscriptions.get(attributes["QueueArn"])
+  if dry_run:
+    print(f"Would delete {queue_url}" + (f" and {sub_arn}" if sub_arn else ""))
+    return True
+  if sub_arn:
+    sns.unsubscribe(SubscriptionArn=sub_arn)
+  sqs.delete_queue(QueueUrl=queue_url)
+  print(f"Deleted {queue_url}")
+  return True
+
+
+def find_and_remove(prefix="ec2_", topic=None, min_age=DEFAULT_MIN_AGE, concurrency=16, dry_run=False):
+  sqs = boto3.client("sqs")
+  sns = boto3.client("sns")
+  subscriptions = list_subscriptions(sns, topic) if topic else {}
+  # list everything first, deleting while paging makes ListQueues skip queues
+  queue_urls = list(list_queue_urls(sqs, prefix))
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    results = list(pool.map(
+      lambda url: remove_queue(sqs, sns, url, subscriptions, min_age, dry_run),
+      queue_urls
+    ))
+  print(f"{sum(results)} of {len(results)} queues {'would be ' if dry_run else ''}deleted")
+  return sum(results)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--prefix", default="ec2_")
+  parser.add_argument("--topic", default=os.environ.get("EC2_SNS_TOPIC"), help="also remove the queues' subscriptions to this topic")
+  parser.add_argument("--min-age", type=int, default=DEFAULT_MIN_AGE, help="keep queues created less than this many seconds ago, 0 deletes them all")
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--dry-run", action="store_true")
+  args = parser.parse_args(argv)
+  find_and_remove(args.prefix, args.topic, args.min_age, args.concurrency, args.dry_run)
+
 
 if __name__ == "__main__":
-  find_and_remove()
\ No newline at end of file
+  main()
@@ -0,0 +1,967 @@
+"""
+In-process stand-in for the AWS services the API talks to
+
+Used by the benchmark and load tools in this directory so they can drive the
+real app code with no network access. Call install() before the app modules
+make their first AWS call or read their first setting: aws.get_client keeps
+the clients it creates, and settings keeps the values it reads, so anything
+created or read before then talks to real AWS with the real settings.
+
+Every call sleeps for the configured per-service latency, under gevent this is
+a cooperative sleep so it behaves like a real network round trip.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import datetime
+import threading
+from collections import defaultdict, deque
+
+# settings read via decouple by the app modules
+DEFAULT_ENV = {
+  "CLUSTER_NAME": "bench-cluster",
+  "SECURITY_GROUP": "sg-00000000",
+  "TASK_ARN": "arn:aws:ecs:eu-west-2:000000000000:task-definition/instance-manager:1",
+  "SUBNETS": "subnet-00000001,subnet-00000002",
+  "ENV_KEY": "bench",
+  "TABLE_NAME": "bench-config",
+  "EC2_SNS_TOPIC": "arn:aws:sns:eu-west-2:000000000000:ec2-state",
+  "KMS_KEY_ID": "alias/bench",
+  "AWS_DEFAULT_REGION": "eu-west-2",
+  # keep runs independent of each other, set it to measure the shared cache
+  "LOCAL_CACHE_PATH": ""
+}
+
+ACCOUNT = "000000000000"
+REGION = "eu-west-2"
+
+
+class FakeClientError(Exception):
+  """Mimics botocore.exceptions.ClientError closely enough for the app code"""
+  def __init__(self, code, message, operation_name):
+    Exception.__init__(self, f"An error occurred ({code}) when calling the {operation_name} operation: {message}")
+    self.response = {
+      "Error": {"Code": code, "Message": message},
+      "ResponseMetadata": {"HTTPStatusCode": 400}
+    }
+    self.operation_name = operation_name
+
+
+def _unwrap(value):
+  """
+  Convert a DynamoDB typed value into a python value
+  """
+  if "S" in value:
+    return value["S"]
+  if "N" in value:
+    number = value["N"]
+    return float(number) if "." in number else int(number)
+  if "BOOL" in value:
+    return value["BOOL"]
+  if "L" in value:
+    return [_unwrap(v) for v in value["L"]]
+  if "M" in value:
+    return {k: _unwrap(v) for k, v in value["M"].items()}
+  if "SS" in value:
+    return set(value["SS"])
+  if "NULL" in value:
+    return None
+  raise ValueError(f"Unsupported attribute value {value}")
+
+
+def _wrap(value):
+  """
+  Convert a python value into a DynamoDB typed value
+  """
+  if isinstance(value, bool):
+    return {"BOOL": value}
+  if isinstance(value, str):
+    return {"S": value}
+  if isinstance(value, (int, float)):
+    return {"N": str(value)}
+  if isinstance(value, (list, tuple)):
+    return {"L": [_wrap(v) for v in value]}
+  if isinstance(value, dict):
+    return {"M": {k: _wrap(v) for k, v in value.items()}}
+  if value is None:
+    return {"NULL": True}
+  raise ValueError(f"Unsupported python value {value!r}")
+
+
+class _Expression():
+  """
+  Small evaluator for DynamoDB condition expressions
+
+  Supports comparisons, BETWEEN, IN, begins_with, attribute_exists,
+  attribute_not_exists, AND, OR, NOT and parentheses.
+  """
+
+  TOKENS = re.compile(r"\s*(<>|<=|>=|=|<|>|\(|\)|,|[#:]?[A-Za-z0-9_.]+)")
+
+  def __init__(self, text, names, values):
+    self.tokens = self.TOKENS.findall(text)
+    self.names = names or {}
+    self.values = values or {}
+    self.pos = 0
+
+  def _peek(self):
+    return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+  def _take(self, expected=None):
+    token = self._peek()
+    if expected is not None and (token is None or token.upper() != expected):
+      raise ValueError(f"Expected {expected} but got {token}")
+    self.pos += 1
+    return token
+
+  def parse(self):
+    node = self._or()
+    if self._peek() is not None:
+      raise ValueError(f"Unexpected token {self._peek()}")
+    return node
+
+  def _or(self):
+    node = self._and()
+    while self._peek() and self._peek().upper() == "OR":
+      self._take()
+      node = ("or", node, self._and())
+    return node
+
+  def _and(self):
+    node = self._not()
+    while self._peek() and self._peek().upper() == "AND":
+      self._take()
+      node = ("and", node, self._not())
+    return node
+
+  def _not(self):
+    if self._peek() and self._peek().upper() == "NOT":
+      self._take()
+      return ("not", self._not())
+    return self._comparison()
+
+  def _comparison(self):
+    token = self._peek()
+    if token == "(":
+      self._take()
+      node = self._or()
+      self._take(")")
+      return node
+    if token in ("begins_with", "attribute_exists", "attribute_not_exists", "contains"):
+      self._take()
+      self._take("(")
+      args = [self._operand()]
+      while self._peek() == ",":
+        self._take()
+        args.append(self._operand())
+      self._take(")")
+      return ("func", token, args)
+    left = self._operand()
+    op = self._take()
+    if op.upper() == "BETWEEN":
+      low = self._operand()
+      self._take("AND")
+      return ("between", left, low, self._operand())
+    if op.upper() == "IN":
+      self._take("(")
+      options = [self._operand()]
+      while self._peek() == ",":
+        self._take()
+        options.append(self._operand())
+      self._take(")")
+      return ("in", left, options)
+    return ("cmp", op, left, self._operand())
+
+  def _operand(self):
+    token = self._take()
+    if token.startswith(":"):
+      return ("value", _unwrap(self.values[token]))
+    return ("path", self.names.get(token, token))
+
+  @staticmethod
+  def _resolve(operand, item):
+    kind, ref = operand
+    if kind == "value":
+      return ref
+    return _unwrap(item[ref]) if ref in item else None
+
+  def evaluate(self, node, item):
+    kind = node[0]
+    if kind == "and":
+      return self.evaluate(node[1], item) and self.evaluate(node[2], item)
+    if kind == "or":
+      return self.evaluate(node[1], item) or self.evaluate(node[2], item)
+    if kind == "not":
+      return not self.evaluate(node[1], item)
+    if kind == "func":
+      name, args = node[1], node[2]
+      if name == "attribute_exists":
+        return args[0][1] in item
+      if name == "attribute_not_exists":
+        return args[0][1] not in item
+      subject = self._resolve(args[0], item)
+      operand = self._resolve(args[1], item)
+      if subject is None:
+        return False
+      if name == "begins_with":
+        return str(subject).startswith(str(operand))
+      return operand in subject
+    if kind == "between":
+      subject = self._resolve(node[1], item)
+      return subject is not None and self._resolve(node[2], item) <= subject <= self._resolve(node[3], item)
+    if kind == "in":
+      subject = self._resolve(node[1], item)
+      return subject in [self._resolve(o, item) for o in node[2]]
+    op, left, right = node[1], self._resolve(node[2], item), self._resolve(node[3], item)
+    if op == "=":
+      return left == right
+    if op == "<>":
+      return left != right
+    if left is None or right is None:
+      return False
+    return {"<": left < right, "<=": left <= right, ">": left > right, ">=": left >= right}[op]
+
+  @classmethod
+  def matches(cls, text, names, values, item):
+    expression = cls(text, names, values)
+    return expression.evaluate(expression.parse(), item)
+
+
+class FakeService():
+  """
+  Base class for a fake client, adds the injected latency to every call
+  """
+  service_name = None
+
+  def __init__(self, world):
+    self.world = world
+
+  throttle_code = "ThrottlingException"
+
+  def _delay(self, operation):
+    self.world.record(self.service_name, operation)
+    if not self.world.allow(self.service_name, operation):
+      self.world.record(self.service_name, f"{operation}(throttled)")
+      self._error(self.throttle_code, "Rate exceeded", operation)
+    latency = self.world.latency_for(self.service_name)
+    if latency > 0:
+      time.sleep(latency)
+
+  def _error(self, code, message, operation):
+    raise FakeClientError(code, message, operation)
+
+
+class FakeDynamoDB(FakeService):
+  service_name = "dynamodb"
+  throttle_code = "ProvisionedThroughputExceededException"
+
+  def _table(self, name):
+    return self.world.tables[name]
+
+  def _key_of(self, item):
+    hash_key, range_key = self.world.key_schema
+    return (_unwrap(item[hash_key]), _unwrap(item[range_key]) if range_key in item else None)
+
+  def put_item(self, TableName, Item, **kwargs):
+    self._delay("PutItem")
+    self._check_condition(self._table(TableName).get(self._key_of(Item)), kwargs, "PutItem")
+    self._table(TableName)[self._key_of(Item)] = dict(Item)
+    return {}
+
+  def get_item(self, TableName, Key, **kwargs):
+    self._delay("GetItem")
+    item = self._table(TableName).get(self._key_of(Key))
+    return {"Item": dict(item)} if item is not None else {}
+
+  def _check_condition(self, item, params, operation):
+    if "ConditionExpression" in params and not _Expression.matches(
+      params["ConditionExpression"],
+      params.get("ExpressionAttributeNames"),
+      params.get("ExpressionAttributeValues"),
+      item or {}
+    ):
+      self._error("ConditionalCheckFailedException", "The conditional request failed", operation)
+
+  def update_item(self, TableName, Key, UpdateExpression, **params):
+    self._delay("UpdateItem")
+    table = self._table(TableName)
+    key = self._key_of(Key)
+    item = table.get(key)
+    self._check_condition(item, params, "UpdateItem")
+    item = dict(item or Key)
+    names = params.get("ExpressionAttributeNames", {})
+    values = params.get("ExpressionAttributeValues", {})
+    # SET a = :x, b = :y  ADD c :z  REMOVE d, e
+    for clause in re.findall(r"(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)", UpdateExpression.strip()):
+      action, body = clause
+      for part in [p.strip() for p in body.split(",") if p.strip()]:
+        if action == "SET":
+          path, value = [x.strip() for x in part.split("=", 1)]
+          item[names.get(path, path)] = values[value]
+        elif action == "ADD":
+          path, value = part.split()
+          path = names.get(path, path)
+          current = _unwrap(item[path]) if path in item else 0
+          item[path] = _wrap(current + _unwrap(values[value]))
+        else:
+          item.pop(names.get(part, part), None)
+    table[key] = item
+    if params.get("ReturnValues") == "ALL_NEW":
+      return {"Attributes": dict(item)}
+    return {}
+
+  def delete_item(self, TableName, Key, **kwargs):
+    self._delay("DeleteItem")
+    self._check_condition(self._table(TableName).get(self._key_of(Key)), kwargs, "DeleteItem")
+    item = self._table(TableName).pop(self._key_of(Key), None)
+    if kwargs.get("ReturnValues") == "ALL_OLD" and item is not None:
+      return {"Attributes": item}
+    return {}
+
+  def _page(self, items, params):
+    items = sorted(items, key=lambda i: self._key_of(i)[1] or "")
+    start = 0
+    if "ExclusiveStartKey" in params:
+      start = int(_unwrap(params["ExclusiveStartKey"]["_offset"]))
+    limit = params.get("Limit", len(items)) or len(items)
+    page = items[start:start + limit]
+    response = {"Items": page, "Count": len(page)}
+    if start + limit < len(items):
+      response["LastEvaluatedKey"] = {"_offset": {"N": str(start + limit)}}
+    return response
+
+  def describe_table(self, TableName):
+    self._delay("DescribeTable")
+
+    def key_schema(hash_key, range_key):
+      schema = [{"AttributeName": hash_key, "KeyType": "HASH"}]
+      if range_key:
+        schema.append({"AttributeName": range_key, "KeyType": "RANGE"})
+      return schema
+
+    description = {"TableName": TableName, "KeySchema": key_schema(*self.world.key_schema)}
+    if self.world.indexes:
+      description["GlobalSecondaryIndexes"] = [
+        {"IndexName": name, "KeySchema": key_schema(*keys), "Projection": {"ProjectionType": "ALL"}}
+        for name, keys in self.world.indexes.items()
+      ]
+    return {"Table": description}
+
+  def query(self, **params):
+    self._delay("Query")
+    items = self._table(params["TableName"]).values()
+    if "IndexName" in params:
+      # indexes are sparse, items without the index keys are not in them
+      keys = [key for key in self.world.indexes[params["IndexName"]] if key]
+      items = [item for item in items if all(key in item for key in keys)]
+    matched = [
+      item for item in items
+      if _Expression.matches(
+        params["KeyConditionExpression"],
+        params.get("ExpressionAttributeNames"),
+        params.get("ExpressionAttributeValues"),
+        item
+      )
+    ]
+    if "FilterExpression" in params:
+      matched = [
+        item for item in matched
+        if _Expression.matches(
+          params["FilterExpression"],
+          params.get("ExpressionAttributeNames"),
+          params.get("ExpressionAttributeValues"),
+          item
+        )
+      ]
+    return self._page(matched, params)
+
+  def scan(self, **params):
+    self._delay("Scan")
+    items = list(self._table(params["TableName"]).values())
+    if "FilterExpression" in params:
+      items = [
+        item for item in items
+        if _Expression.matches(
+          params["FilterExpression"],
+          params.get("ExpressionAttributeNames"),
+          params.get("ExpressionAttributeValues"),
+          item
+        )
+      ]
+    return self._page(items, params)
+
+
+class FakeEC2(FakeService):
+  service_name = "ec2"
+  throttle_code = "RequestLimitExceeded"
+
+  def describe_instances(self, Filters=None, InstanceIds=None, **kwargs):
+    self._delay("DescribeInstances")
+    instances = []
+    if InstanceIds:
+      instances = [self.world.instances[i] for i in InstanceIds if i in self.world.instances]
+    else:
+      candidates = self.world.instances.values()
+      for f in Filters or []:
+        if f["Name"] == "instance-state-name":
+          candidates = [i for i in candidates if i["State"]["Name"] in f["Values"]]
+        elif f["Name"].startswith("tag:"):
+          tag = f["Name"][4:]
+          values = set(f["Values"])
+          candidates = [i for i in candidates if self.world.tag_value(i, tag) in values]
+      instances = list(candidates)
+    return {"Reservations": [{"Instances": [dict(i)]} for i in instances]}
+
+  def _change_state(self, InstanceIds, target, operation):
+    changes = []
+    for instance_id in InstanceIds:
+      if instance_id not in self.world.instances:
+        self._error("InvalidInstanceID.NotFound", f"The instance ID '{instance_id}' does not exist", operation)
+      instance = self.world.instances[instance_id]
+      previous = instance["State"]["Name"]
+      instance["State"] = {"Name": target}
+      changes.append({
+        "InstanceId": instance_id,
+        "CurrentState": {"Name": target},
+        "PreviousState": {"Name": previous}
+      })
+      self.world.emit_state_change(instance_id, target)
+    return changes
+
+  def start_instances(self, InstanceIds, **kwargs):
+    self._delay("StartInstances")
+    return {"StartingInstances": self._change_state(InstanceIds, "pending", "StartInstances")}
+
+  def stop_instances(self, InstanceIds, Hibernate=False, **kwargs):
+    self._delay("StopInstances")
+    for instance_id in InstanceIds:
+      instance = self.world.instances.get(instance_id)
+      if Hibernate and instance and not instance["HibernationOptions"]["Configured"]:
+        self._error("UnsupportedHibernationConfiguration", f"The instance '{instance_id}' does not have hibernation configured", "StopInstances")
+    return {"StoppingInstances": self._change_state(InstanceIds, "stopping", "StopInstances")}
+
+  def create_tags(self, Resources, Tags, **kwargs):
+    self._delay("CreateTags")
+    for instance_id in Resources:
+      instance = self.world.instances[instance_id]
+      new_keys = {t["Key"] for t in Tags}
+      instance["Tags"] = [t for t in instance["Tags"] if t["Key"] not in new_keys] + [dict(t) for t in Tags]
+    return {}
+
+  def delete_tags(self, Resources, Tags, **kwargs):
+    self._delay("DeleteTags")
+    for instance_id in Resources:
+      instance = self.world.instances[instance_id]
+      keys = {t["Key"] for t in Tags}
+      instance["Tags"] = [t for t in instance["Tags"] if t["Key"] not in keys]
+    return {}
+
+
+class FakeECS(FakeService):
+  service_name = "ecs"
+
+  def run_task(self, **params):
+    self._delay("RunTask")
+    task_id = "%032x" % random.getrandbits(128)
+    task = {
+      "taskArn": f"arn:aws:ecs:{REGION}:{ACCOUNT}:task/{params['cluster']}/{task_id}",
+      "clusterArn": f"arn:aws:ecs:{REGION}:{ACCOUNT}:cluster/{params['cluster']}",
+      "taskDefinitionArn": params["taskDefinition"],
+      "lastStatus": "PROVISIONING",
+      "desiredStatus": "RUNNING",
+      "containers": [{"name": "instance-manager", "lastStatus": "PENDING"}],
+      "overrides": params.get("overrides", {})
+    }
+    self.world.tasks[task["taskArn"]] = task
+    self.world.emit_task_change(task)
+    if self.world.provision_seconds is not None:
+      threading.Timer(self.world.provision_seconds, self.world.run_terraform, (task["taskArn"],)).start()
+    return {"tasks": [dict(task)], "failures": []}
+
+  def describe_tasks(self, cluster, tasks, **kwargs):
+    self._delay("DescribeTasks")
+    if len(tasks) > 100:
+      self._error("InvalidParameterException", "tasks can have at most 100 items", "DescribeTasks")
+    found = [dict(self.world.tasks[arn]) for arn in tasks if arn in self.world.tasks]
+    missing = [{"arn": arn, "reason": "MISSING"} for arn in tasks if arn not in self.world.tasks]
+    return {"tasks": found, "failures": missing}
+
+
+  def describe_services(self, cluster, services, **kwargs):
+    self._delay("DescribeServices")
+    return {"services": [
+      {"serviceName": name, "desiredCount": self.world.ecs_services.get(name, 0)} for name in services
+    ], "failures": []}
+
+  def update_service(self, cluster, service, desiredCount=None, **kwargs):
+    self._delay("UpdateService")
+    if desiredCount is not None:
+      self.world.ecs_services[service] = desiredCount
+    return {"service": {"serviceName": service, "desiredCount": self.world.ecs_services.get(service, 0)}}
+
+
+class FakeSQS(FakeService):
+  service_name = "sqs"
+
+  def create_queue(self, QueueName, Attributes=None, **kwargs):
+    self._delay("CreateQueue")
+    url = f"https://sqs.{REGION}.amazonaws.com/{ACCOUNT}/{QueueName}"
+    if url not in self.world.queues:
+      self.world.queues[url] = {
+        "name": QueueName,
+        "attributes": dict(Attributes or {}),
+        "messages": deque()
+      }
+      self.world.queues[url]["attributes"]["QueueArn"] = f"arn:aws:sqs:{REGION}:{ACCOUNT}:{QueueName}"
+      self.world.queues[url]["attributes"]["CreatedTimestamp"] = str(int(time.time()))
+    return {"QueueUrl": url}
+
+  def get_queue_url(self, QueueName, **kwargs):
+    self._delay("GetQueueUrl")
+    url = f"https://sqs.{REGION}.amazonaws.com/{ACCOUNT}/{QueueName}"
+    if url not in self.world.queues:
+      self._error("AWS.SimpleQueueService.NonExistentQueue", "The specified queue does not exist.", "GetQueueUrl")
+    return {"QueueUrl": url}
+
+  def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+    self._delay("GetQueueAttributes")
+    attributes = self.world.queues[QueueUrl]["attributes"]
+    if AttributeNames and "All" not in AttributeNames:
+      attributes = {k: v for k, v in attributes.items() if k in AttributeNames}
+    return {"Attributes": dict(attributes)}
+
+  def set_queue_attributes(self, QueueUrl, Attributes, **kwargs):
+    self._delay("SetQueueAttributes")
+    self.world.queues[QueueUrl]["attributes"].update(Attributes)
+    return {}
+
+  def list_queues(self, QueueNamePrefix="", MaxResults=1000, NextToken=None, **kwargs):
+    self._delay("ListQueues")
+    urls = sorted(u for u, q in self.world.queues.items() if q["name"].startswith(QueueNamePrefix))
+    start = int(NextToken or 0)
+    page = urls[start:start + MaxResults]
+    response = {"QueueUrls": page} if page else {}
+    if start + MaxResults < len(urls):
+      response["NextToken"] = str(start + MaxResults)
+    return response
+
+  def delete_queue(self, QueueUrl, **kwargs):
+    self._delay("DeleteQueue")
+    self.world.queues.pop(QueueUrl, None)
+    return {}
+
+  def send_message(self, QueueUrl, MessageBody, **kwargs):
+    self._delay("SendMessage")
+    return {"MessageId": self.world.enqueue(QueueUrl, MessageBody)}
+
+  def _return_invisible(self, QueueUrl):
+    # received messages which were not deleted in time are delivered again
+    inflight = self.world.queues[QueueUrl].setdefault("inflight", {})
+    now = time.monotonic()
+    for receipt, (visible_at, message) in list(inflight.items()):
+      if visible_at <= now:
+        del inflight[receipt]
+        self.world.queues[QueueUrl]["messages"].append(message)
+
+  def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=None, **kwargs):
+    self._delay("ReceiveMessage")
+    deadline = time.monotonic() + WaitTimeSeconds
+    queue = self.world.queues[QueueUrl]["messages"]
+    self._return_invisible(QueueUrl)
+    while not queue and time.monotonic() < deadline:
+      time.sleep(self.world.poll_interval)
+      self._return_invisible(QueueUrl)
+    if VisibilityTimeout is None:
+      VisibilityTimeout = float(self.world.queues[QueueUrl]["attributes"].get("VisibilityTimeout", 30))
+    messages = []
+    while queue and len(messages) < MaxNumberOfMessages:
+      message = queue.popleft()
+      messages.append(message)
+      self.world.queues[QueueUrl]["inflight"][message["ReceiptHandle"]] = (time.monotonic() + VisibilityTimeout, message)
+    return {"Messages": messages} if messages else {}
+
+  def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+    self._delay("DeleteMessage")
+    self.world.queues[QueueUrl].setdefault("inflight", {}).pop(ReceiptHandle, None)
+    return {}
+
+
+class FakeSNS(FakeService):
+  service_name = "sns"
+
+  def subscribe(self, TopicArn, Protocol, Endpoint, **kwargs):
+    self._delay("Subscribe")
+    arn = f"{TopicArn}:{'%032x' % random.getrandbits(128)}"
+    self.world.subscriptions[arn] = {
+      "SubscriptionArn": arn,
+      "TopicArn": TopicArn,
+      "Protocol": Protocol.lower(),
+      "Endpoint": Endpoint
+    }
+    return {"SubscriptionArn": arn}
+
+  def unsubscribe(self, SubscriptionArn, **kwargs):
+    self._delay("Unsubscribe")
+    self.world.subscriptions.pop(SubscriptionArn, None)
+    return {}
+
+  def list_subscriptions_by_topic(self, TopicArn, NextToken=None, **kwargs):
+    self._delay("ListSubscriptionsByTopic")
+    subscriptions = [dict(s) for s in self.world.subscriptions.values() if s["TopicArn"] == TopicArn]
+    start = int(NextToken or 0)
+    response = {"Subscriptions": subscriptions[start:start + 100]}
+    if start + 100 < len(subscriptions):
+      response["NextToken"] = str(start + 100)
+    return response
+
+
+class FakeWorld():
+  """
+  Shared state behind all of the fake clients
+  """
+
+  services = {
+    "dynamodb": FakeDynamoDB,
+    "ec2": FakeEC2,
+    "ecs": FakeECS,
+    "sqs": FakeSQS,
+    "sns": FakeSNS
+  }
+
+  def __init__(self, latency=None, key_schema=("domain", "sub_id"), limits=None):
+    self.latency = dict(latency or {})
+    # calls per second allowed for "service:Operation", above that calls are throttled
+    self.limits = dict(limits or {})
+    self._allowance = {}
+    self.key_schema = key_schema
+    # global secondary indexes of every table, {name: (hash key, range key or None)}
+    self.indexes = {}
+    self.tables = defaultdict(dict)
+    self.instances = {}
+    self.tasks = {}
+    self.ecs_services = {}
+    self.queues = {}
+    self.subscriptions = {}
+    self.calls = defaultdict(int)
+    self.poll_interval = 0.01
+    self.emit_events = False
+    # when set, tasks create or terminate their instance after this many seconds
+    self.provision_seconds = None
+    # ECS task state changes are only emitted with emit_events and this set
+    self.task_events = True
+    # exit code of the instance-manager container, anything but 0 fails the task
+    self.terraform_exit_code = 0
+    # desktop ids whose terraform fails within a batch
+    self.failing_desktops = set()
+    self._counter = 0
+    self._lock = threading.Lock()
+
+  def latency_for(self, service):
+    return self.latency.get(service, self.latency.get("default", 0.0))
+
+  def record(self, service, operation):
+    self.calls[f"{service}:{operation}"] += 1
+
+  def allow(self, service, operation):
+    """
+    Token bucket per limited operation, one second of burst
+    """
+    rate = self.limits.get(f"{service}:{operation}", self.limits.get(service))
+    if rate is None:
+      return True
+    with self._lock:
+      now = time.monotonic()
+      tokens, updated = self._allowance.get((service, operation), (rate, now))
+      tokens = min(rate, tokens + (now - updated) * rate)
+      allowed = tokens >= 1
+      self._allowance[(service, operation)] = (tokens - 1 if allowed else tokens, now)
+      return allowed
+
+  def client(self, service_name, *args, **kwargs):
+    if service_name not in self.services:
+      raise ValueError(f"fakeaws does not implement the {service_name} service")
+    return self.services[service_name](self)
+
+  @staticmethod
+  def tag_value(instance, key):
+    for tag in instance.get("Tags", []):
+      if tag["Key"] == key:
+        return tag["Value"]
+    return None
+
+  def next_id(self):
+    with self._lock:
+      self._counter += 1
+      return self._counter
+
+  # -- data seeding --------------------------------------------------------
+
+  def put_config(self, table, **attributes):
+    item = {k: _wrap(v) for k, v in attributes.items()}
+    hash_key, range_key = self.key_schema
+    self.tables[table][(attributes[hash_key], attributes.get(range_key))] = item
+
+  def add_instance(self, username, desktop_id, machine_def, env_key, state="running", screen_geometry="1920x1080", instance_id=None, hibernation=False):
+    instance_id = instance_id or "i-%017x" % self.next_id()
+    self.instances[instance_id] = {
+      "InstanceId": instance_id,
+      "InstanceType": "t3.large",
+      "PrivateDnsName": f"ip-10-0-{self._counter // 250 % 250}-{self._counter % 250}.{REGION}.compute.internal",
+      "LaunchTime": datetime.datetime(2021, 3, 1, 9, 0, tzinfo=datetime.timezone.utc),
+      "State": {"Name": state},
+      "HibernationOptions": {"Configured": hibernation},
+      "SecurityGroups": [{"GroupName": "desktop", "GroupId": "sg-00000001"}],
+      "Tags": [
+        {"Key": "MachineType", "Value": "Desktop"},
+        {"Key": "Username", "Value": username},
+        {"Key": "DesktopId", "Value": desktop_id},
+        {"Key": "EnvKey", "Value": env_key},
+        {"Key": "ScreenGeometry", "Value": screen_geometry},
+        {"Key": "MachineDef", "Value": machine_def},
+        {"Key": "Name", "Value": f"desktop-{desktop_id}"}
+      ]
+    }
+    return instance_id
+
+  def seed(self, table, env_key, users=100, desktops_per_user=2, groups=20, roles=10, machine_defs=5, seed=1):
+    """
+    Populate config and fleet data of a realistic shape
+
+    Each user belongs to one group, each group maps to two roles, each role
+    grants every machine def through its own entitlement.
+    """
+    rnd = random.Random(seed)
+    for m in range(machine_defs):
+      self.put_config(
+        table,
+        domain="machine_def",
+        sub_id=f"md{m}",
+        ami_id=f"ami-{m:017x}",
+        instance_type="t3.large",
+        user_data="I2Jhc2gKZWNobyBoZWxsbwo=" * 40
+      )
+    for r in range(roles):
+      entitlements = []
+      for m in range(machine_defs):
+        entitlement_id = f"ent-r{r}-md{m}"
+        entitlements.append(entitlement_id)
+        self.put_config(table, domain="entitlement", sub_id=entitlement_id, machine_def=f"md{m}", machine_count=desktops_per_user + 2)
+      self.put_config(table, domain="role", sub_id=f"role{r}", entitlements=entitlements)
+    self.put_config(table, domain="role", sub_id="admin", entitlements=[])
+    for g in range(groups):
+      self.put_config(table, domain="group", sub_id=f"group{g}", roles=[f"role{g % roles}", f"role{(g + 1) % roles}"])
+    self.put_config(table, domain="group", sub_id="admins", roles=["admin"])
+    fleet = {}
+    for u in range(users):
+      username = f"user{u:05d}"
+      fleet[username] = {"group": f"group{u % groups}", "desktops": {}}
+      for d in range(desktops_per_user):
+        desktop_id = f"d{u:05d}x{d}"
+        instance_id = self.add_instance(
+          username=username,
+          desktop_id=desktop_id,
+          machine_def=f"md{rnd.randrange(machine_defs)}",
+          env_key=env_key,
+          state=rnd.choice(["running", "stopped"])
+        )
+        fleet[username]["desktops"][desktop_id] = instance_id
+    return fleet
+
+  def run_terraform(self, task_arn):
+    """
+    What the instance-manager task does, applied to the fake fleet
+    """
+    task = self.tasks[task_arn]
+    task.update(lastStatus="RUNNING", containers=[{"name": "instance-manager", "lastStatus": "RUNNING"}])
+    self.emit_task_change(task)
+    environment = {e["name"]: e["value"] for e in task["overrides"]["containerOverrides"][0]["environment"]}
+    if environment["MODE"] == "batch":
+      table = os.environ.get("TABLE_NAME", DEFAULT_ENV["TABLE_NAME"])
+      manifest = self.tables[table][("manifest", environment["MANIFEST_ID"])]
+      results = {}
+      for desktop in _unwrap(manifest["desktops"]):
+        if desktop["DESKTOP_ID"] in self.failing_desktops:
+          results[desktop["DESKTOP_ID"]] = "terraform apply failed"
+        else:
+          self.apply_terraform(desktop)
+          results[desktop["DESKTOP_ID"]] = "ok"
+      manifest["results"] = _wrap(results)
+    elif self.terraform_exit_code == 0:
+      self.apply_terraform(environment)
+    task.update(
+      lastStatus="STOPPED",
+      desiredStatus="STOPPED",
+      stopCode="EssentialContainerExited",
+      stoppedReason="Essential container in task exited",
+      containers=[{"name": "instance-manager", "lastStatus": "STOPPED", "exitCode": self.terraform_exit_code}]
+    )
+    self.emit_task_change(task)
+
+  def apply_terraform(self, environment):
+    env_key = os.environ.get("ENV_KEY", DEFAULT_ENV["ENV_KEY"])
+    if environment["MODE"] == "apply":
+      instance_id = self.add_instance(
+        username=environment["MACHINE_USERNAME"],
+        desktop_id=environment["DESKTOP_ID"],
+        machine_def=environment["MACHINE_DEF_ID"],
+        env_key=env_key,
+        state="running",
+        screen_geometry=environment["SCREEN_GEOMETRY"]
+      )
+      self.emit_state_change(instance_id, "running")
+      return
+    for instance_id, instance in list(self.instances.items()):
+      # terraform state is keyed by the ids the instance was built with
+      desktop_id = self.tag_value(instance, "ProvisionedDesktopId") or self.tag_value(instance, "DesktopId")
+      username = self.tag_value(instance, "ProvisionedUsername") or self.tag_value(instance, "Username")
+      if desktop_id == environment["DESKTOP_ID"] and username == environment["MACHINE_USERNAME"]:
+        instance["State"] = {"Name": "terminated"}
+        self.emit_state_change(instance_id, "terminated")
+
+  def start_workers(self, queue_url, count, job_seconds, table):
+    """
+    Long-running instance-manager workers taking jobs off a work queue, each
+    job takes job_seconds as the container is already warm
+    """
+    def work():
+      messages = self.queues[queue_url]["messages"]
+      while True:
+        if not messages:
+          time.sleep(self.poll_interval)
+          continue
+        job = json.loads(messages.popleft()["Body"])
+        environment = job["environment"]
+        if ("job", job["job_id"]) in self.tables[table]:
+          # given up on before a worker took it
+          continue
+        self.report_job(table, job["job_id"], "RUNNING")
+        time.sleep(job_seconds)
+        desktops = [environment]
+        if environment["MODE"] == "batch":
+          desktops = _unwrap(self.tables[table][("manifest", environment["MANIFEST_ID"])]["desktops"])
+        results = {}
+        for desktop in desktops:
+          if desktop["DESKTOP_ID"] in self.failing_desktops:
+            results[desktop["DESKTOP_ID"]] = "terraform apply failed"
+          else:
+            self.apply_terraform(desktop)
+            results[desktop["DESKTOP_ID"]] = "ok"
+        self.report_job(table, job["job_id"], "STOPPED", results)
+    for _ in range(count):
+      threading.Thread(target=work, daemon=True).start()
+
+  def report_job(self, table, job_id, status, results=None):
+    detail = {"jobId": job_id, "status": status, "results": results or {}}
+    self.put_config(table, domain="job", sub_id=job_id, status=status, results=results or {})
+    if self.task_events:
+      self.emit(json.dumps({"Type": "Notification", "Message": json.dumps({
+        "detail-type": "Desktop Provisioning Job State Change",
+        "source": "desktops.provisioning",
+        "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "detail": detail
+      })}))
+
+  # -- event injection -----------------------------------------------------
+
+  def enqueue(self, queue_url, body):
+    message_id = "%032x" % random.getrandbits(128)
+    self.queues[queue_url]["messages"].append({
+      "MessageId": message_id,
+      "ReceiptHandle": message_id,
+      "Body": body
+    })
+    return message_id
+
+  def state_change_body(self, instance_id, state):
+    """
+    Builds an SNS wrapped EventBridge EC2 state change as SQS would deliver it
+    """
+    event = {
+      "version": "0",
+      "id": "%032x" % random.getrandbits(128),
+      "detail-type": "EC2 Instance State-change Notification",
+      "source": "aws.ec2",
+      "account": ACCOUNT,
+      "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+      "region": REGION,
+      "resources": [f"arn:aws:ec2:{REGION}:{ACCOUNT}:instance/{instance_id}"],
+      "detail": {"instance-id": instance_id, "state": state}
+    }
+    return json.dumps({"Type": "Notification", "Message": json.dumps(event)})
+
+  def task_change_body(self, task):
+    """
+    Builds an SNS wrapped EventBridge ECS task state change
+    """
+    event = {
+      "version": "0",
+      "id": "%032x" % random.getrandbits(128),
+      "detail-type": "ECS Task State Change",
+      "source": "aws.ecs",
+      "account": ACCOUNT,
+      "time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+      "region": REGION,
+      "resources": [task["taskArn"]],
+      "detail": dict(task)
+    }
+    return json.dumps({"Type": "Notification", "Message": json.dumps(event)})
+
+  def emit(self, body):
+    """
+    Deliver an event to every queue subscribed to a topic, if enabled
+    """
+    if not self.emit_events:
+      return
+    for sub in list(self.subscriptions.values()):
+      for url, queue in self.queues.items():
+        if queue["attributes"].get("QueueArn") == sub["Endpoint"]:
+          self.enqueue(url, body)
+
+  def emit_state_change(self, instance_id, state):
+    self.emit(self.state_change_body(instance_id, state))
+
+  def emit_task_change(self, task):
+    if self.task_events:
+      self.emit(self.task_change_body(task))
+
+
+world = None
+
+
+def install(latency=None, env=None, limits=None):
+  """
+  Replace boto3.client with the fake and set the settings the app needs
+
+  Must be called before the app makes its first AWS call or reads its first
+  setting, see the module docstring.
+  """
+  global world
+  for key, value in dict(DEFAULT_ENV, **(env or {})).items():
+    os.environ.setdefault(key, value)
+  import boto3
+  world = FakeWorld(latency=latency, limits=limits)
+  boto3.client = world.client
+  return world
+
+
+def parse_latency(text):
+  """
+  Parse "ec2=0.05,dynamodb=0.005" into a dict of seconds
+  """
+  latency = {}
+  for part in filter(None, (text or "").split(",")):
+    service, _, seconds = part.partition("=")
+    latency[service.strip()] = float(seconds)
+  return latency
+
+
+def add_repo_to_path():
+  """
+  Make the app modules importable from scripts in tools/
+  """
+  repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  if repo not in sys.path:
+    sys.path.insert(0, repo)
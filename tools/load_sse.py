@@ -0,0 +1,328 @@
+"""
+Load harness for the /event SSE stream and the MessageProcessor fan-out
+
+Starts one API worker (gevent pywsgi, the same server the gunicorn gevent
+worker uses) in a child process against the in-process AWS stand-in, opens
+many concurrent SSE connections to it spread over many usernames, then
+injects synthetic EC2 state-change messages into the worker's SQS queue at a
+fixed rate. Reports delivery latency percentiles, the drop rate and the
+worker's memory with and without the connections. No network access needed.
+
+--burst sends several transitions for a desktop back to back, like the
+pending/running pair of a start, and --coalesce-ms sets EVENT_COALESCE_MS in
+the worker. final_ok is the share of (connection, desktop) pairs whose last
+delivered state is the last state sent.
+
+  python tools/load_sse.py --connections 2000 --users 500 --rate 50 --duration 30
+  python tools/load_sse.py --burst 2 --rate 100 --coalesce-ms 250
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import http.client
+from collections import defaultdict
+
+import gevent
+
+import fakeaws
+from benchlib import percentile, print_table, write_json
+
+fakeaws.add_repo_to_path()
+
+STATES = ["pending", "running", "stopping", "stopped"]
+
+
+def raise_fd_limit():
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_of(pid):
+  """
+  Resident set size in MB of another process
+  """
+  try:
+    with open(f"/proc/{pid}/status") as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1]) / 1024.0
+  except OSError:
+    pass
+  return None
+
+
+def build_world(args, latency=None):
+  world = fakeaws.install(latency=latency)
+  fleet = world.seed(
+    table=os.environ["TABLE_NAME"],
+    env_key=os.environ["ENV_KEY"],
+    users=args.users,
+    desktops_per_user=args.desktops_per_user,
+    groups=10,
+    roles=5,
+    machine_defs=3
+  )
+  return world, fleet
+
+
+# -- worker (child process) --------------------------------------------------
+
+def serve(args):
+  """
+  Run a single API worker plus the message injector
+  """
+  raise_fd_limit()
+  world, fleet = build_world(args, latency=fakeaws.parse_latency(args.latency))
+  import logging
+  from gevent.pywsgi import WSGIServer
+  from app import app
+  from messageprocessor import get_processor
+  from sqs import SqsHandler
+  logging.getLogger().setLevel(args.log_level)
+
+  queue_url = SqsHandler(topic_name=os.environ["EC2_SNS_TOPIC"], kms_id=os.environ["KMS_KEY_ID"]).create_queue_and_subscribe()
+  processor = get_processor(queueurl=queue_url)
+  gevent.spawn(processor.run)
+
+  sent = []
+  targets = [
+    (username, instance_id)
+    for username in fleet
+    for instance_id in fleet[username]["desktops"].values()
+  ]
+
+  def inject():
+    rnd = random.Random(args.seed)
+    interval = 1.0 / args.rate
+    next_send = time.monotonic()
+    end = next_send + args.duration
+    turn = 0
+    transitions = defaultdict(int)
+    while time.monotonic() < end:
+      # walk the fleet in order so an instance never has two bursts in flight
+      username, instance_id = targets[turn % len(targets)]
+      turn += 1
+      for _ in range(args.burst):
+        if args.random_states:
+          state = STATES[rnd.randrange(len(STATES))]
+        else:
+          state = STATES[transitions[instance_id] % len(STATES)]
+          transitions[instance_id] += 1
+        world.enqueue(queue_url, world.state_change_body(instance_id, state))
+        sent.append({"username": username, "instance_id": instance_id, "state": state, "t": time.time()})
+        next_send += interval
+      gevent.sleep(max(0.0, next_send - time.monotonic()))
+    with open(args.events_file, "w") as f:
+      json.dump({"sent": sent, "listeners": {u: len(q) for u, q in processor.queues.items()}}, f)
+
+  def start_injecting():
+    gevent.spawn(inject)
+
+  gevent.signal_handler(signal.SIGUSR1, start_injecting)
+  WSGIServer(("127.0.0.1", args.port), app, log=None).serve_forever()
+
+
+# -- load generator (parent process) -----------------------------------------
+
+def wait_for_port(port, timeout=30):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    try:
+      socket.create_connection(("127.0.0.1", port), timeout=1).close()
+      return True
+    except OSError:
+      time.sleep(0.1)
+  return False
+
+
+def open_stream(port, connection, username, group, received, failures):
+  """
+  Hold one SSE connection open and timestamp every event that arrives
+  """
+  conn = http.client.HTTPConnection("127.0.0.1", port, timeout=None)
+  try:
+    conn.request("GET", "/event", headers={
+      "x-remote-user": username,
+      "x-remote-user-groups": group,
+      "Accept": "text/event-stream"
+    })
+    response = conn.getresponse()
+    if response.status != 200:
+      failures.append(response.status)
+      return
+    while True:
+      line = response.readline()
+      if not line:
+        break
+      if line.startswith(b"data:"):
+        now = time.time()
+        payload = json.loads(line[5:].strip())
+        received.append((connection, username, payload["instance_id"], payload["state"], now))
+  except (OSError, http.client.HTTPException, ValueError):
+    failures.append("disconnected")
+  finally:
+    conn.close()
+
+
+def analyse(sent, received, connections):
+  """
+  Match every delivery to the send it came from and work out latency, drops
+  and whether each connection ended up with the right state for each desktop
+  """
+  by_instance = defaultdict(list)
+  for event in sent:
+    by_instance[event["instance_id"]].append(event)
+  last_received = {}
+  latencies = []
+  for connection, username, instance_id, state, t in received:
+    last_received[(connection, instance_id)] = state
+    # the latest send of this state for the instance before it arrived
+    match = None
+    for event in reversed(by_instance.get(instance_id, [])):
+      if event["state"] == state and event["t"] <= t:
+        match = event
+        break
+    if match:
+      latencies.append(t - match["t"])
+  connections_per_user = defaultdict(list)
+  for connection, username in enumerate(connections):
+    connections_per_user[username].append(connection)
+  expected = sum(len(connections_per_user[e["username"]]) for e in sent)
+  final = [
+    last_received.get((connection, instance_id)) == events[-1]["state"]
+    for instance_id, events in by_instance.items()
+    for connection in connections_per_user[events[-1]["username"]]
+  ]
+  final_ok = 100.0 * sum(final) / len(final) if final else None
+  return latencies, expected, final_ok
+
+
+def run(args):
+  raise_fd_limit()
+  # the fleet is rebuilt in the worker from the same seed so ids line up
+  _, fleet = build_world(args)
+  usernames = list(fleet.keys())
+  events_file = args.events_file or os.path.join(tempfile.mkdtemp(), "sent.json")
+  command = [
+    sys.executable, os.path.abspath(__file__), "--serve",
+    "--port", str(args.port),
+    "--users", str(args.users),
+    "--desktops-per-user", str(args.desktops_per_user),
+    "--rate", str(args.rate),
+    "--duration", str(args.duration),
+    "--latency", args.latency,
+    "--log-level", args.log_level,
+    "--events-file", events_file,
+    "--seed", str(args.seed),
+    "--burst", str(args.burst)
+  ] + (["--random-states"] if args.random_states else [])
+  worker = subprocess.Popen(command, env=dict(os.environ, EVENT_COALESCE_MS=str(args.coalesce_ms)))
+  try:
+    if not wait_for_port(args.port):
+      raise RuntimeError("worker did not start listening")
+    rss_idle = rss_of(worker.pid)
+
+    received = []
+    failures = []
+    streams = []
+    connections = []
+    for n in range(args.connections):
+      username = usernames[n % len(usernames)]
+      connections.append(username)
+      streams.append(gevent.spawn(open_stream, args.port, n, username, fleet[username]["group"], received, failures))
+      if n % 200 == 199:
+        gevent.sleep(0.05)
+    gevent.sleep(args.settle)
+    rss_connected = rss_of(worker.pid)
+
+    os.kill(worker.pid, signal.SIGUSR1)
+    gevent.sleep(args.duration)
+    deadline = time.monotonic() + args.drain + 10
+    while not os.path.exists(events_file) and time.monotonic() < deadline:
+      gevent.sleep(0.2)
+    gevent.sleep(args.drain)
+    rss_loaded = rss_of(worker.pid)
+    gevent.killall(streams, block=False)
+
+    with open(events_file) as f:
+      report = json.load(f)
+    latencies, expected, final_ok = analyse(report["sent"], received, connections)
+    live_listeners = sum(report["listeners"].values())
+    row = {
+      "connections": args.connections,
+      "users": args.users,
+      "events": len(report["sent"]),
+      "rate": args.rate,
+      "expected": expected,
+      "delivered": len(received),
+      "drop_pct": 100.0 * (expected - len(received)) / expected if expected else 0.0,
+      "evicted": args.connections - live_listeners,
+      "final_ok_pct": final_ok,
+      "failed": len(failures),
+      "p50_ms": _ms(percentile(latencies, 50)),
+      "p90_ms": _ms(percentile(latencies, 90)),
+      "p99_ms": _ms(percentile(latencies, 99)),
+      "max_ms": _ms(max(latencies) if latencies else None),
+      "rss_idle_mb": rss_idle,
+      "rss_conn_mb": rss_connected,
+      "rss_load_mb": rss_loaded,
+      "kb_per_conn": 1024.0 * (rss_connected - rss_idle) / args.connections if rss_idle and rss_connected else None
+    }
+    columns = list(row.keys())
+    print_table([row], columns[:11])
+    print()
+    print_table([row], columns[11:])
+    write_json(args.json, [row])
+  finally:
+    worker.terminate()
+    worker.wait()
+
+
+def _ms(seconds):
+  return None if seconds is None else round(seconds * 1000.0, 2)
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--connections", type=int, default=1000, help="concurrent SSE connections")
+  parser.add_argument("--users", type=int, default=250, help="usernames the connections are spread over")
+  parser.add_argument("--desktops-per-user", type=int, default=2)
+  parser.add_argument("--rate", type=float, default=20.0, help="injected state-change messages per second")
+  parser.add_argument("--duration", type=float, default=20.0, help="seconds to inject for")
+  parser.add_argument("--settle", type=float, default=3.0, help="seconds to wait after connecting before injecting")
+  parser.add_argument("--drain", type=float, default=5.0, help="seconds to wait for deliveries after injecting")
+  parser.add_argument("--random-states", action="store_true", help="pick states at random instead of cycling them")
+  parser.add_argument("--burst", type=int, default=1, help="transitions sent back to back for each desktop")
+  parser.add_argument("--coalesce-ms", type=int, default=0, help="EVENT_COALESCE_MS for the worker")
+  parser.add_argument("--latency", default="sqs=0.005,ec2=0.040", help="injected seconds per service call")
+  parser.add_argument("--port", type=int, default=5098)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--log-level", default="WARNING")
+  parser.add_argument("--events-file", help=argparse.SUPPRESS)
+  parser.add_argument("--json", help="also write results to this file")
+  parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv if argv is not None else sys.argv[1:])
+  if args.serve:
+    serve(args)
+  else:
+    run(args)
+
+
+if __name__ == "__main__":
+  main()
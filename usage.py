@@ -0,0 +1,163 @@
+"""
+usage.py
+
+Running time of desktops per user and per machine definition.
+
+With USAGE_ENABLED set, MessageProcessor passes every EC2 state change of a
+desktop here. The change is appended to a log partitioned by UTC day, and a
+desktop's time in the running state is added to daily totals as soon as it
+leaves that state, so reports only read the totals:
+
+| partition key      | sort key                     |
+| usagelog#<day>     | <time>#<instance id>#<state> | {username, desktop_id, machine_def_id}
+| usage              | <instance id>                | {state, since, username, desktop_id, machine_def_id}
+| usage#<day>        | user#<username>              | {seconds}
+| usage#<day>        | machine_def#<machine_def>    | {seconds}
+
+Days are YYYY-MM-DD, a run spanning midnight is split between the two days.
+Every host sees each event, conditional writes on the per-instance item mean
+only one of them adds a run to the totals, and stale or repeated events are
+dropped the same way. Runs still in progress are counted up to now when
+reporting.
+"""
+import time
+import logging
+import datetime
+from collections import defaultdict
+
+from gevent.pool import Pool
+
+from settings import setting
+from data import ddb_create, get_ddb_item, get_ddb_items_with_keys, update_ddb_item, add_ddb_counters, del_ddb_item
+from errors import BadRequestException
+from warmpool import pool_username
+
+logger = logging.getLogger(__name__)
+
+DOMAIN = "usage"
+LOG_DOMAIN = "usagelog"
+# the state a desktop is billed in, any other state ends a run
+RUNNING = "running"
+DAY_FORMAT = "%Y-%m-%d"
+
+def usage_enabled():
+  return setting("USAGE_ENABLED", default=False, cast=bool)
+
+def day_of(timestamp):
+  return datetime.datetime.utcfromtimestamp(timestamp).strftime(DAY_FORMAT)
+
+def parse_day(day):
+  """
+  Gets the timestamp a YYYY-MM-DD day starts at
+  """
+  try:
+    return datetime.datetime.strptime(day, DAY_FORMAT).replace(tzinfo=datetime.timezone.utc).timestamp()
+  except (TypeError, ValueError):
+    raise BadRequestException(f"{day} is not a date in the form YYYY-MM-DD")
+
+def split_by_day(start, end):
+  """
+  Splits the time from start to end into (day, seconds) for each day it touches
+  """
+  while start < end:
+    next_day = (start // 86400 + 1) * 86400
+    yield day_of(start), min(end, next_day) - start
+    start = next_day
+
+def record_state_change(instance_id, state, event_time, tags):
+  """
+  Logs a desktop's state change and, if it ends a run, adds the run to the totals
+  """
+  if not usage_enabled():
+    return
+  if tags["Username"] == pool_username():
+    # a warm pool desktop is not anyone's yet, its time is counted from hand over
+    return
+  table = setting("TABLE_NAME")
+  event_time = int(event_time)
+  desktop = {
+    "username": tags["Username"],
+    "desktop_id": tags["DesktopId"],
+    "machine_def_id": tags.get("MachineDef") or "unknown"
+  }
+  # every host writes the same item, so the log holds each event once
+  ddb_create(
+    table,
+    domain=f"{LOG_DOMAIN}#{day_of(event_time)}",
+    sub_id=f"{event_time}#{instance_id}#{state}",
+    **desktop
+  )
+  current = get_ddb_item(table, domain=DOMAIN, sub_id=instance_id) or {}
+  if state == RUNNING:
+    if current.get("state") == RUNNING:
+      # another host got here first, or the event ending the last run was lost
+      return
+    update_ddb_item(
+      table,
+      {"domain": DOMAIN, "sub_id": instance_id},
+      only_if_newer="since",
+      allow_equal=False,
+      state=state,
+      since=event_time,
+      **desktop
+    )
+    return
+  if current.get("state") == RUNNING and event_time > current["since"]:
+    # only the host which moves the item out of running adds the run
+    if update_ddb_item(
+      table,
+      {"domain": DOMAIN, "sub_id": instance_id},
+      expected={"state": RUNNING, "since": current["since"]},
+      state=state,
+      since=event_time
+    ):
+      add_run(table, current, current["since"], event_time)
+  if state == "terminated":
+    del_ddb_item(table, domain=DOMAIN, sub_id=instance_id)
+
+def add_run(table, run, start, end):
+  logger.info("Desktop %s of %s ran for %ds", run["desktop_id"], run["username"], end - start)
+  for day, seconds in split_by_day(start, end):
+    add_ddb_counters(table, {"domain": f"{DOMAIN}#{day}", "sub_id": f"user#{run['username']}"}, seconds=seconds)
+    add_ddb_counters(table, {"domain": f"{DOMAIN}#{day}", "sub_id": f"machine_def#{run['machine_def_id']}"}, seconds=seconds)
+
+def get_usage(first_day, last_day):
+  """
+  Running hours per user and per machine definition from the start of
+  first_day to the end of last_day, including runs still in progress
+  """
+  start = parse_day(first_day)
+  end = parse_day(last_day) + 86400
+  days = int((end - start) // 86400)
+  if days < 1:
+    raise BadRequestException("The end of the range is before its start")
+  if days > setting("USAGE_MAX_DAYS", default=366, cast=int):
+    raise BadRequestException("The range covers too many days")
+  table = setting("TABLE_NAME")
+  totals = {"user": defaultdict(int), "machine_def": defaultdict(int)}
+
+  def add(kind, name, seconds):
+    totals[kind][name] += seconds
+
+  def read_day(day):
+    return get_ddb_items_with_keys(table, domain=f"{DOMAIN}#{day}")
+
+  # one partition per day, read several at once
+  pool = Pool(setting("USAGE_READ_CONCURRENCY", default=8, cast=int))
+  for items in pool.imap(read_day, [day_of(start + n * 86400) for n in range(days)]):
+    for item in items:
+      kind, name = item["sub_id"].split("#", 1)
+      add(kind, name, item.get("seconds", 0))
+  now = time.time()
+  for run in get_ddb_items_with_keys(table, domain=DOMAIN):
+    if run.get("state") != RUNNING:
+      continue
+    seconds = max(0, min(end, now) - max(start, run["since"]))
+    add("user", run["username"], seconds)
+    add("machine_def", run["machine_def_id"], seconds)
+  return {
+    "from": first_day,
+    "to": last_day,
+    "users": {name: round(seconds / 3600, 2) for name, seconds in sorted(totals["user"].items())},
+    "machine_defs": {name: round(seconds / 3600, 2) for name, seconds in sorted(totals["machine_def"].items())}
+  }
@@ -4,7 +4,8 @@ Useful bits of code
 import logging
 import sys
 import random
-from flask import make_response, jsonify
+from flask import current_app
+from serializer import dumps
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +15,27 @@ def format_sse(data: str, event=None) -> str:
     msg = f'event: {event}\n{msg}'
   return msg
 
+def encode_sse(data: bytes, event=None) -> bytes:
+  """
+  format_sse for data which is already encoded
+  """
+  msg = b"data: " + data + b"\n\n"
+  if event is not None:
+    msg = b"event: " + event.encode("utf-8") + b"\n" + msg
+  return msg
+
+def encode_retry(milliseconds) -> bytes:
+  """
+  SSE field telling the client how long to wait before reconnecting
+  """
+  return f"retry: {int(milliseconds)}\n\n".encode("utf-8")
+
+def encode_comment(text) -> bytes:
+  """
+  SSE comment, ignored by clients but keeps proxies from closing idle streams
+  """
+  return f": {text}\n\n".encode("utf-8")
+
 def get_rand_string(number_of_characters):
     chars = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
     rnd = random.SystemRandom()
@@ -34,13 +56,18 @@ def check_for_keys(dict, keys):
   else:
     return False
 
+def json_response(payload, code):
+  """
+  Turns payload into a JSON response, encoded the same way as flask.jsonify
+  but through the (possibly faster) serializer module
+  """
+  return current_app.response_class(dumps(payload) + b"\n", status=code, mimetype="application/json")
+
 def success_json_response(payload):
   """
   Turns payload into a JSON HTTP200 response
   """
-  response = make_response(jsonify(payload), 200)
-  response.headers["Content-type"] = "application/json"
-  return response
+  return json_response(payload, 200)
 
 def generic_exception_json_response(code):
     """
@@ -51,9 +78,7 @@ def generic_exception_json_response(code):
         "message": "An unknown error occured",
         "code": code
     }
-    resp = make_response(jsonify(payload), code)
-    resp.headers["Content-type"] = "application/json"
-    return resp
+    return json_response(payload, code)
 
 def exception_to_json_response(exception, code):
     """
@@ -64,6 +89,4 @@ def exception_to_json_response(exception, code):
         "message": str(exception),
         "code": code
     }
-    resp = make_response(jsonify(payload), code)
-    resp.headers["Content-type"] = "application/json"
-    return resp
\ No newline at end of file
+    return json_response(payload, code)
\ No newline at end of file
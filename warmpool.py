@@ -0,0 +1,265 @@
+"""
+warmpool.py
+
+Optional pool of pre-built, stopped desktops for each machine definition.
+
+A machine_def item with warm_pool_size > 0 gets that many slots in the config
+table:
+
+| partition key           | sort key |
+| warmpool#<machine_def>  | slot<n>  | {state, desktop_id, instanceid, created}
+
+The replenisher, run by the local cache writer, fills empty slots with the
+usual provisioning task for a desktop owned by WARM_POOL_USERNAME, stops the
+instance once it is up and marks the slot ready. Slots are created with a
+conditional put so two hosts never provision the same slot. POST /instance
+claims a ready slot with a conditional delete, re-tags the instance for the
+user and starts it, then asks the writer to refill the slot. If handing the
+desktop over fails part way it goes back to the pool and the request
+provisions a desktop as usual.
+
+Hosts cache instance tags, so tags naming the pool as owner are always read
+again from EC2, the desktop may have been claimed on another host.
+
+A claimed instance keeps the desktop id and username terraform built it with
+in its ProvisionedDesktopId and ProvisionedUsername tags, so destroying it
+later finds the right terraform state.
+"""
+import time
+import logging
+import gevent
+
+from aws import get_client
+from settings import setting
+from data import get_ddb_items_with_keys, ddb_create, claim_ddb_item, update_ddb_item, del_ddb_item
+from ecs import create_desktop_instance
+from instance import get_instances_by_username, get_instance_details, start_instance, stop_instance
+from utils import get_rand_string
+import registry
+import localcache
+
+logger = logging.getLogger(__name__)
+
+DOMAIN_PREFIX = "warmpool#"
+
+def pool_enabled():
+  return setting("WARM_POOL_ENABLED", default=False, cast=bool)
+
+def pool_username():
+  return setting("WARM_POOL_USERNAME", default="warmpool")
+
+def domain_for(machine_def_id):
+  return f"{DOMAIN_PREFIX}{machine_def_id}"
+
+def get_slots(machine_def_id):
+  return get_ddb_items_with_keys(setting("TABLE_NAME"), domain=domain_for(machine_def_id))
+
+def fill_slot(machine_def, slot_id):
+  """
+  Starts provisioning a desktop for an empty slot, unless another host got there first
+  """
+  table = setting("TABLE_NAME")
+  desktop_id = get_rand_string(8)
+  if not ddb_create(
+    table,
+    only_if_absent=True,
+    domain=domain_for(machine_def["sub_id"]),
+    sub_id=slot_id,
+    state="provisioning",
+    desktop_id=desktop_id,
+    created=int(time.time())
+  ):
+    return
+  logger.info("Provisioning %s for the %s warm pool", desktop_id, machine_def["sub_id"])
+  started = create_desktop_instance(
+    desktop_id=desktop_id,
+    ami_id=machine_def["ami_id"],
+    machine_username=pool_username(),
+    screen_geometry=setting("WARM_POOL_SCREEN_GEOMETRY", default="1920x1080"),
+    machine_def_id=machine_def["sub_id"],
+    instance_type=machine_def["instance_type"],
+    user_data=machine_def["user_data"]
+  )
+  if not started:
+    logger.warning("Could not start provisioning for warm pool slot %s of %s", slot_id, machine_def["sub_id"])
+    del_ddb_item(table, domain=domain_for(machine_def["sub_id"]), sub_id=slot_id)
+
+def check_slot(machine_def, slot, instance):
+  """
+  Moves a provisioning slot on once its instance exists, it is ready when stopped
+  """
+  table = setting("TABLE_NAME")
+  if instance is None:
+    if time.time() - slot.get("created", 0) > setting("WARM_POOL_PROVISIONING_TIMEOUT_SECONDS", default=3600, cast=int):
+      logger.warning("Warm pool desktop %s was never provisioned, freeing its slot", slot["desktop_id"])
+      del_ddb_item(table, domain=slot["domain"], sub_id=slot["sub_id"])
+    return
+  if instance["state"] in ("pending", "running"):
+    logger.info("Stopping warm pool desktop %s", slot["desktop_id"])
+    stop_instance(instance["instanceid"])
+  elif instance["state"] == "stopped":
+    logger.info("Warm pool desktop %s is ready", slot["desktop_id"])
+    update_ddb_item(table, {"domain": slot["domain"], "sub_id": slot["sub_id"]}, state="ready", instanceid=instance["instanceid"])
+
+def replenish(machine_def):
+  """
+  Brings the pool for a machine definition up to its warm_pool_size
+  """
+  size = machine_def.get("warm_pool_size", 0)
+  slots = {slot["sub_id"]: slot for slot in get_slots(machine_def["sub_id"])}
+  pooled = get_instances_by_username.fresh(pool_username())
+  for n in range(size):
+    slot = slots.get(f"slot{n}")
+    if slot is None:
+      fill_slot(machine_def, f"slot{n}")
+    elif slot.get("state") == "provisioning":
+      check_slot(machine_def, slot, pooled.get(slot["desktop_id"]))
+  tracked = {slot.get("desktop_id") for slot in slots.values()}
+  for desktop_id, instance in pooled.items():
+    if desktop_id not in tracked and instance["machine_def_id"] == machine_def["sub_id"]:
+      logger.warning("Warm pool desktop %s (%s) has no slot", desktop_id, instance["instanceid"])
+
+def replenish_all():
+  for machine_def in get_ddb_items_with_keys(setting("TABLE_NAME"), domain="machine_def"):
+    if machine_def.get("warm_pool_size", 0) > 0:
+      try:
+        replenish(machine_def)
+      except Exception as err:
+        logger.warning("Could not replenish the %s warm pool: %s", machine_def["sub_id"], err)
+
+def request_refill(machine_def_id):
+  """
+  Asks the local cache writer to refill the pools now rather than at its next check
+  """
+  localcache.put("warmpool", "refill", machine_def_id)
+
+def run_replenisher():
+  """
+  Loop run in every worker, only the local cache writer does anything
+  It checks every WARM_POOL_CHECK_SECONDS, or sooner when a claim asks it to
+  """
+  checked = 0
+  refill_seen = None
+  while True:
+    if pool_enabled() and localcache.is_writer():
+      requested = localcache.get_updated("warmpool", "refill")
+      if time.time() - checked >= setting("WARM_POOL_CHECK_SECONDS", default=60, cast=int) or requested != refill_seen:
+        checked = time.time()
+        refill_seen = requested
+        replenish_all()
+    gevent.sleep(setting("WARM_POOL_SIGNAL_SECONDS", default=1, cast=float))
+
+def is_pool_owned(tags):
+  return bool(tags) and tags.get("Username") == pool_username()
+
+def remember_tags(instance_id, tags):
+  """
+  Makes the message processors on this host see the new owner straight away
+  """
+  cached = localcache.get("instance_tags", instance_id)
+  if cached is None:
+    details = get_instance_details(instance_id)
+    cached = details["tags"] if details else {}
+  localcache.put("instance_tags", instance_id, dict(cached, **tags))
+
+def claim(username, desktop_id, machine_def, screen_geometry):
+  """
+  Hands a ready pooled desktop to a user and starts it
+  Returns the instance id, None if the pool has nothing ready or the hand
+  over failed, either way the caller provisions a desktop instead
+  """
+  table = setting("TABLE_NAME")
+  for slot in get_slots(machine_def["sub_id"]):
+    if slot.get("state") != "ready":
+      continue
+    claimed = claim_ddb_item(table, {"state": "ready"}, domain=slot["domain"], sub_id=slot["sub_id"])
+    if claimed is None:
+      # another request got it first
+      continue
+    logger.info("Giving warm pool desktop %s (%s) to %s as %s", claimed["desktop_id"], claimed["instanceid"], username, desktop_id)
+    try:
+      hand_over(claimed, username, desktop_id, machine_def, screen_geometry)
+    except Exception as err:
+      logger.warning("Could not give warm pool desktop %s to %s, returning it to the pool: %s", claimed["desktop_id"], username, err)
+      give_back(claimed, username, desktop_id, machine_def)
+      return None
+    request_refill(machine_def["sub_id"])
+    return claimed["instanceid"]
+  return None
+
+def hand_over(claimed, username, desktop_id, machine_def, screen_geometry):
+  """
+  Re-tags a claimed desktop for the user, moves it in the registry and starts it
+  """
+  instance_id = claimed["instanceid"]
+  tags = {
+    "Username": username,
+    "DesktopId": desktop_id,
+    "ScreenGeometry": screen_geometry,
+    "ProvisionedUsername": pool_username(),
+    "ProvisionedDesktopId": claimed["desktop_id"]
+  }
+  get_client("ec2").create_tags(
+    Resources=[instance_id],
+    Tags=[{"Key": key, "Value": value} for key, value in tags.items()]
+  )
+  remember_tags(instance_id, tags)
+  if registry.registry_enabled():
+    pooled = registry.get_desktop(pool_username(), claimed["desktop_id"]) or {}
+    registry.remove_desktop(pool_username(), claimed["desktop_id"])
+    registry.update_desktop(
+      username=username,
+      desktop_id=desktop_id,
+      state="pending",
+      state_time=time.time(),
+      instanceid=instance_id,
+      dns=pooled.get("dns"),
+      launchtime=pooled.get("launchtime"),
+      hibernation=pooled.get("hibernation"),
+      screengeometry=screen_geometry,
+      machine_def_id=machine_def["sub_id"]
+    )
+  start_instance(instance_id)
+
+def give_back(claimed, username, desktop_id, machine_def):
+  """
+  Undoes a failed hand_over, the desktop goes back to its slot owned by the pool
+  """
+  instance_id = claimed["instanceid"]
+  try:
+    ec2 = get_client("ec2")
+    ec2.create_tags(
+      Resources=[instance_id],
+      Tags=[
+        {"Key": "Username", "Value": pool_username()},
+        {"Key": "DesktopId", "Value": claimed["desktop_id"]},
+        {"Key": "ScreenGeometry", "Value": setting("WARM_POOL_SCREEN_GEOMETRY", default="1920x1080")}
+      ]
+    )
+    ec2.delete_tags(Resources=[instance_id], Tags=[{"Key": "ProvisionedUsername"}, {"Key": "ProvisionedDesktopId"}])
+    localcache.delete("instance_tags", instance_id)
+    if registry.registry_enabled():
+      registry.remove_desktop(username, desktop_id)
+      registry.update_desktop(
+        username=pool_username(),
+        desktop_id=claimed["desktop_id"],
+        state="stopped",
+        state_time=time.time(),
+        instanceid=instance_id,
+        machine_def_id=machine_def["sub_id"]
+      )
+    ddb_create(setting("TABLE_NAME"), **claimed)
+  except Exception as err:
+    logger.error("Could not return warm pool desktop %s (%s) to its slot, it needs cleaning up: %s", claimed["desktop_id"], instance_id, err)
+
+def provisioned_as(instance_id, desktop_id, username):
+  """
+  Gets the (desktop_id, username) terraform built an instance with, which
+  differ from the current ones for desktops taken from the warm pool
+  """
+  tags = localcache.get("instance_tags", instance_id)
+  if tags is None or tags.get("Username") != username:
+    # not cached, or cached before another host gave the desktop to this user
+    details = get_instance_details(instance_id)
+    tags = details["tags"] if details else {}
+  return tags.get("ProvisionedDesktopId", desktop_id), tags.get("ProvisionedUsername", username)
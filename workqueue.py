@@ -0,0 +1,127 @@
+"""
+workqueue.py
+
+Provisioning through a pool of long-running instance-manager workers.
+
+With PROVISION_BACKEND=queue, ecs.start_task sends each job (one desktop, or
+a batch manifest) to the PROVISION_QUEUE_NAME SQS queue instead of starting a
+Fargate task. The workers, an ECS service kept at PROVISION_WORKERS tasks,
+take jobs off the queue and report on them in the config table:
+
+| partition key | sort key | written by the worker
+| job           | job id   | {status: RUNNING or STOPPED, results: {desktop_id: "ok" or error}, error, cancelled}
+
+A worker takes a job by creating its item with status RUNNING, on condition
+that there is none yet. A job nobody took within PROVISION_JOB_TIMEOUT_SECONDS
+is given up on by creating the item the same way, STOPPED and cancelled, so
+whichever write comes second loses. A worker which finds the item already
+there deletes the message without running the job, the desktop's owner has
+been told it failed.
+
+They can also publish a "Desktop Provisioning Job State Change" event with
+detail {jobId, status, results, error} to the events topic, otherwise the
+job items are polled (see tasks.py). Job ids are tracked like task ARNs with
+a "job/" prefix so the rest of the code does not need to know which backend
+started a desktop.
+"""
+import json
+import logging
+
+from aws import get_client
+from settings import setting
+from data import get_ddb_item, ddb_create
+from utils import get_rand_string
+import localcache
+
+logger = logging.getLogger(__name__)
+
+DOMAIN = "job"
+JOB_PREFIX = "job/"
+
+queue_url = None
+
+def queue_enabled():
+  return setting("PROVISION_BACKEND", default="task") == "queue"
+
+def is_job(task_id):
+  return task_id.startswith(JOB_PREFIX)
+
+def get_queue_url():
+  global queue_url
+  if queue_url is None:
+    queue_url = get_client("sqs").get_queue_url(QueueName=setting("PROVISION_QUEUE_NAME"))["QueueUrl"]
+  return queue_url
+
+def enqueue(environment):
+  """
+  Sends a job to the workers, returns its id
+  """
+  job_id = get_rand_string(16)
+  get_client("sqs").send_message(
+    QueueUrl=get_queue_url(),
+    MessageBody=json.dumps({"job_id": job_id, "environment": environment})
+  )
+  logger.info("Queued provisioning job %s", job_id)
+  return f"{JOB_PREFIX}{job_id}"
+
+def job_status(job):
+  """
+  A job item (or event detail) in the shape of an ECS task description
+  """
+  described = {
+    "lastStatus": job.get("status", "PENDING"),
+    "results": job.get("results", {})
+  }
+  if job.get("error"):
+    described["stoppedReason"] = job["error"]
+  elif described["lastStatus"] == "STOPPED":
+    # stopped without an error, desktops with no result did not fail
+    described["containers"] = [{"name": "worker", "exitCode": 0}]
+  return described
+
+def cancel(task_id, reason):
+  """
+  Gives up on a job no worker has taken
+  Returns False if a worker took it first
+  """
+  cancelled = ddb_create(
+    setting("TABLE_NAME"),
+    only_if_absent=True,
+    domain=DOMAIN,
+    sub_id=task_id[len(JOB_PREFIX):],
+    status="STOPPED",
+    error=reason,
+    cancelled=True
+  )
+  if cancelled:
+    logger.warning("Gave up on provisioning job %s: %s", task_id, reason)
+  return cancelled
+
+def describe(job_ids):
+  """
+  Gets the status of jobs keyed by job id, a job no worker has picked up yet is PENDING
+  """
+  table = setting("TABLE_NAME")
+  described = {}
+  for task_id in job_ids:
+    job = get_ddb_item(table, domain=DOMAIN, sub_id=task_id[len(JOB_PREFIX):]) or {}
+    described[task_id] = job_status(job)
+  return described
+
+def ensure_workers():
+  """
+  Keeps the worker service at PROVISION_WORKERS tasks, run by the local cache writer
+  """
+  service = setting("PROVISION_WORKER_SERVICE", default="")
+  if not queue_enabled() or not service:
+    return
+  workers = setting("PROVISION_WORKERS", default=2, cast=int)
+  ecs = get_client("ecs")
+  cluster = setting("CLUSTER_NAME")
+  response = ecs.describe_services(cluster=cluster, services=[service])
+  for described in response.get("services", []):
+    if described["desiredCount"] != workers:
+      logger.info("Scaling provisioning workers from %d to %d", described["desiredCount"], workers)
+      ecs.update_service(cluster=cluster, service=service, desiredCount=workers)
+
+localcache.register_refresh("provision_workers", ensure_workers)
@@ -3,17 +3,25 @@ monkey.patch_all()
 
 import logging
 import atexit
-from decouple import config
 from gunicorn.app.base import Application, Config
-from app import app
+from gunicorn.workers.ggevent import GeventWorker
+from logconfig import setup_logging
+from app import app, warm_up
 from messageprocessor import get_processor
-from sqs import SqsHandler
+from sqs import SqsHandler, durable_queue_name
+from settings import setting
+import localcache
+import warmpool
+import prestart
 
+import gevent
 from gevent import Greenlet
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] (%(threadName)-10s) %(message)s")
+setup_logging()
 logger = logging.getLogger(__name__)
 
+sqs_handler = sqs_queue_url = message_processor = mpg = None
+
 class GUnicornFlaskApplication(Application):
   def __init__(self, app):
     self.usage, self.callable, self.prog, self.app = None, None, None, app
@@ -25,48 +33,54 @@ class GUnicornFlaskApplication(Application):
 
   load = lambda self:self.app
 
+class DrainingGeventWorker(GeventWorker):
+  """
+  Gevent worker which ends its SSE streams before a graceful shutdown, rather
+  than holding them until the graceful timeout cuts every one at once
+  """
+  def handle_exit(self, sig, frame):
+    if message_processor:
+      gevent.spawn(message_processor.drain)
+    super().handle_exit(sig, frame)
+
 def starting(server):
   logger.info("on_starting called")
   
   global sqs_handler, sqs_queue_url, message_processor, mpg
+  queue_name = setting("EVENT_QUEUE_NAME", default="")
   sqs_handler = SqsHandler(
-    topic_name=config("EC2_SNS_TOPIC"),
-    kms_id=config("KMS_KEY_ID")
+    topic_name=setting("EC2_SNS_TOPIC"),
+    kms_id=setting("KMS_KEY_ID"),
+    queue_name=durable_queue_name(queue_name) if queue_name else None
   )
-  sqs_queue_url = sqs_handler.create_queue_and_subscribe()
-  logger.info(f"Queue created, URL: {sqs_queue_url}")
+  sqs_queue_url = sqs_handler.setup()
+  logger.info("Queue ready, URL: %s", sqs_queue_url)
 
 def start_listener(worker):
-  logging.info("post_worker_init called")
+  logger.info("post_worker_init called")
   global sqs_handler, sqs_queue_url, message_processor, mpg
+  # don't hold up the worker, anything not ready yet is created on first use
+  Greenlet.spawn(warm_up)
+  Greenlet.spawn(localcache.run_writer)
+  Greenlet.spawn(warmpool.run_replenisher)
+  Greenlet.spawn(prestart.run_scheduler)
   message_processor = get_processor(
     queueurl=sqs_queue_url
   )
   mpg = Greenlet(message_processor.run)
   mpg.start()
+  Greenlet.spawn(message_processor.poll_tasks)
 
 def stopping(server):
   logger.info("on_exit called")
-  global sqs_handler
+  # workers have drained by now, a durable queue is kept for the next start
   if sqs_handler:
-    sqs_handler.unsubscribe_and_delete_queue()
-  """
-  global sqs_handler, message_processor, mpg
-  if message_processor:
-    message_processor.stoprequest.set()
-  if mpg:
-    mpg.join()
-  if sqs_handler:
-    sqs_handler.unsubscribe_and_delete_queue()
-  """
-
-#atexit.register(new_stopping)
-
+    sqs_handler.close()
 
 if __name__ == "__main__":
   g_app = GUnicornFlaskApplication(app)
   g_app.run(
-    worker_class="gevent",
+    worker_class=DrainingGeventWorker,
     on_starting=starting,
     post_worker_init=start_listener,
     on_exit=stopping,